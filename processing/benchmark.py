@@ -0,0 +1,915 @@
+#!/usr/bin/env python3
+"""
+Benchmark delle fasi della pipeline di elaborazione degli spartiti
+
+Confronta le implementazioni vettoriali con le versioni originali in Python puro
+sulle pagine di esempio in resources/samples, verificando che i risultati coincidano.
+
+Uso:
+    python benchmark.py                 # esegue tutti i benchmark
+    python benchmark.py ref_lengths     # esegue solo il benchmark indicato
+"""
+
+import contextlib
+import copy
+import io
+import math
+import os
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+import cv2
+import numpy as np
+
+from src.deskewing import get_ref_lengths
+from src.staffline_detection import find_staffline_rows, find_staffline_columns, create_staffs
+from src.box import BoundingBox, BoxArray
+from src.staff import Staff
+from src.utils import (
+    CorrelationImage, correlate, locate_templates, locate_template_banks, merge_boxes,
+    merge_box_arrays, predict_scales, pyramid_factor, spectrum_cache, template_cache,
+)
+from src import detection, pdf_utils
+from src.overlays import draw_annotation
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+samples_dir = os.path.join(current_dir, "resources", "samples")
+input_dir = os.path.join(current_dir, "input")
+
+
+def load_sample_pages():
+    """Carica e binarizza le pagine di esempio come nella pipeline principale"""
+    pages = {}
+    for filename in sorted(os.listdir(samples_dir)):
+        if not filename.lower().endswith((".jpg", ".jpeg", ".png")):
+            continue
+        img = cv2.imread(os.path.join(samples_dir, filename), 0)
+        if img is None:
+            continue
+        img = cv2.fastNlMeansDenoising(img, None, 10, 7, 21)
+        _, img = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        pages[filename] = img
+    return pages
+
+
+def timed(func, *args):
+    """
+    Esegue func(*args) e restituisce (risultato, secondi impiegati).
+
+    Un'eccezione sollevata da func viene restituita come risultato (tipo e messaggio),
+    così da poter confrontare anche i fallimenti tra le due implementazioni.
+    """
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+    except Exception as e:
+        result = (type(e).__name__, str(e))
+    return result, time.perf_counter() - start
+
+
+def pages_with_ref_lengths(pages):
+    """Restituisce (nome, immagine, line_width, line_spacing) per le pagine analizzabili"""
+    for name, img in pages.items():
+        try:
+            line_width, line_spacing = get_ref_lengths(img)
+        except AssertionError:
+            print(f"  {name:<20} saltata: lunghezze di riferimento non coerenti")
+            continue
+        yield name, img, line_width, line_spacing
+
+
+def sample_staffs(pages):
+    """Restituisce (nome, pentagrammi) per le pagine in cui i pentagrammi vengono individuati"""
+    for name, img, line_width, line_spacing in pages_with_ref_lengths(pages):
+        rows = find_staffline_rows(img, line_width, line_spacing)
+        try:
+            columns = find_staffline_columns(img, rows, line_width, line_spacing)
+            with contextlib.redirect_stdout(io.StringIO()):
+                staffs = create_staffs(rows, columns, line_width, line_spacing, img)
+        except IndexError:
+            print(f"  {name:<20} saltata: pentagrammi non individuati")
+            continue
+        yield name, staffs
+
+
+def template_banks():
+    """Banchi di template usati da find_clef_time_signature e find_primitive"""
+    d = detection
+    banks = {}
+    for clef in d.clef_imgs:
+        banks[f"clef {clef}"] = (d.clef_imgs[clef], d.clef_lower, d.clef_upper, d.clef_thresh, d.clef_spacing[clef])
+    for time_name in d.time_imgs:
+        banks[f"time {time_name}"] = (d.time_imgs[time_name], d.time_lower, d.time_upper, d.time_thresh, d.time_spacing[time_name])
+    banks.update({
+        "sharp": (d.sharp_imgs, d.sharp_lower, d.sharp_upper, d.sharp_thresh, d.sharp_spacing),
+        "flat": (d.flat_imgs, d.flat_lower, d.flat_upper, d.flat_thresh, d.flat_spacing),
+        "quarter note": (d.quarter_note_imgs, d.quarter_note_lower, d.quarter_note_upper, d.quarter_note_thresh, d.quarter_note_spacing),
+        "half note": (d.half_note_imgs, d.half_note_lower, d.half_note_upper, d.half_note_thresh, d.half_note_spacing),
+        "whole note": (d.whole_note_imgs, d.whole_note_lower, d.whole_note_upper, d.whole_note_thresh, d.whole_note_spacing),
+        "eighth rest": (d.eighth_rest_imgs, d.eighth_rest_lower, d.eighth_rest_upper, d.eighth_rest_thresh, d.eighth_rest_spacing),
+        "quarter rest": (d.quarter_rest_imgs, d.quarter_rest_lower, d.quarter_rest_upper, d.quarter_rest_thresh, d.quarter_rest_spacing),
+        "half rest": (d.half_rest_imgs, d.half_rest_lower, d.half_rest_upper, d.half_rest_thresh, d.half_rest_spacing),
+        "whole rest": (d.whole_rest_imgs, d.whole_rest_lower, d.whole_rest_upper, d.whole_rest_thresh, d.whole_rest_spacing),
+        "eighth flag": (d.eighth_flag_imgs, d.eighth_flag_lower, d.eighth_flag_upper, d.eighth_flag_thresh, d.eighth_flag_spacing),
+        "bar line": (d.bar_imgs, d.bar_lower, d.bar_upper, d.bar_thresh, d.bar_spacing),
+    })
+    return banks
+
+
+def print_row(name, legacy_time, new_time, match):
+    speedup = legacy_time / new_time if new_time > 0 else float("inf")
+    status = "OK" if match else "DIVERSO"
+    print(
+        f"  {name:<20} originale {legacy_time:9.3f}s   nuovo {new_time:8.4f}s   "
+        f"speedup {speedup:8.1f}x   {status}"
+    )
+
+
+# -------------------------------------------------------------------------------
+# Implementazioni originali (riferimento)
+# -------------------------------------------------------------------------------
+
+
+def legacy_get_ref_lengths(img):
+    """Versione originale pixel per pixel di get_ref_lengths"""
+    num_rows = img.shape[0]
+    num_cols = img.shape[1]
+    rle_image_white_runs = []
+    rle_image_black_runs = []
+    sum_all_consec_runs = []
+
+    for i in range(num_cols):
+        col = img[:, i]
+        rle_col = []
+        rle_white_runs = []
+        rle_black_runs = []
+        run_val = 0
+        run_type = col[0]
+        for j in range(num_rows):
+            if col[j] == run_type:
+                run_val += 1
+            else:
+                rle_col.append(run_val)
+                if run_type == 0:
+                    rle_black_runs.append(run_val)
+                else:
+                    rle_white_runs.append(run_val)
+                run_type = col[j]
+                run_val = 1
+
+        rle_col.append(run_val)
+        if run_type == 0:
+            rle_black_runs.append(run_val)
+        else:
+            rle_white_runs.append(run_val)
+
+        sum_rle_col = [sum(rle_col[i : i + 2]) for i in range(len(rle_col))]
+
+        rle_image_white_runs.extend(rle_white_runs)
+        rle_image_black_runs.extend(rle_black_runs)
+        sum_all_consec_runs.extend(sum_rle_col)
+
+    line_spacing = Counter(rle_image_white_runs).most_common(1)[0][0]
+    line_width = Counter(rle_image_black_runs).most_common(1)[0][0]
+    width_spacing_sum = Counter(sum_all_consec_runs).most_common(1)[0][0]
+
+    assert (line_spacing + line_width == width_spacing_sum), "Lo spessore stimato della linea + lo spazio non corrisponde con la somma più comune"
+
+    return line_width, line_spacing
+
+
+def legacy_find_staffline_rows(img, line_width, line_spacing):
+    """Versione originale con istogramma pixel per pixel di find_staffline_rows"""
+    num_rows = img.shape[0]
+    num_cols = img.shape[1]
+    row_black_pixel_histogram = []
+
+    for i in range(num_rows):
+        row = img[i]
+        num_black_pixels = 0
+        for j in range(len(row)):
+            if row[j] == 0:
+                num_black_pixels += 1
+        row_black_pixel_histogram.append(num_black_pixels)
+
+    all_staff_row_indices = []
+    num_stafflines = 5
+    threshold = 0.4
+    staff_length = num_stafflines * (line_width + line_spacing) - line_spacing
+    iter_range = num_rows - staff_length + 1
+
+    current_row = 0
+    while current_row < iter_range:
+        staff_lines = [row_black_pixel_histogram[j : j + line_width] for j in
+                       range(current_row, current_row + (num_stafflines - 1) * (line_width + line_spacing) + 1,
+                             line_width + line_spacing)]
+
+        for line in staff_lines:
+            if sum(line) / line_width < threshold * num_cols:
+                current_row += 1
+                break
+        else:
+            staff_row_indices = [list(range(j, j + line_width)) for j in
+                                 range(current_row,
+                                       current_row + (num_stafflines - 1) * (line_width + line_spacing) + 1,
+                                       line_width + line_spacing)]
+            all_staff_row_indices.append(staff_row_indices)
+            current_row = current_row + staff_length
+
+    return all_staff_row_indices
+
+
+def legacy_find_staffline_columns(img, all_staffline_vertical_indices, line_width, line_spacing):
+    """Versione originale colonna per colonna di find_staffline_columns"""
+    num_cols = img.shape[1]
+    all_staff_extremes = []
+
+    for i in range(len(all_staffline_vertical_indices)):
+        begin_list = []
+        end_list = []
+
+        for j in range(num_cols // 2):
+            first_staff_rows_isolated = img[all_staffline_vertical_indices[i][0][0]:all_staffline_vertical_indices[i][4][
+                line_width - 1], j]
+            num_black_pixels = len(list(filter(lambda x: x == 0, first_staff_rows_isolated)))
+            if num_black_pixels == 0:
+                begin_list.append(j)
+
+        list.sort(begin_list, reverse=True)
+        begin = begin_list[0]
+
+        for j in range(num_cols // 2, num_cols):
+            first_staff_rows_isolated = img[all_staffline_vertical_indices[i][0][0]:all_staffline_vertical_indices[i][4][
+                line_width - 1], j]
+            num_black_pixels = len(list(filter(lambda x: x == 0, first_staff_rows_isolated)))
+            if num_black_pixels == 0:
+                end_list.append(j)
+
+        list.sort(end_list)
+        end = end_list[0]
+
+        all_staff_extremes.append((begin, end))
+
+    return all_staff_extremes
+
+
+def legacy_merge_boxes(boxes, threshold):
+    """Versione originale di merge_boxes su liste di BoundingBox"""
+    filtered_boxes = []
+    while len(boxes) > 0:
+        r = boxes.pop(0)
+        boxes.sort(key=lambda box: box.distance(r))
+        merged = True
+        while merged:
+            merged = False
+            i = 0
+            for _ in range(len(boxes)):
+                if r.overlap(boxes[i]) > threshold or boxes[i].overlap(r) > threshold:
+                    r = r.merge(boxes.pop(i))
+                    merged = True
+                elif boxes[i].distance(r) > r.w / 2 + boxes[i].w / 2:
+                    break
+                else:
+                    i += 1
+        filtered_boxes.append(r)
+    return filtered_boxes
+
+
+def legacy_get_pitch(staff, note_center_y):
+    """Versione originale di Staff.getPitch: liste di righe e scansione delle linee addizionali"""
+    # Informazioni sulle altezze delle note in base alla chiave musicale
+    clef_info = {
+        "treble": [("F5", "E5", "D5", "C5", "B4", "A4", "G4", "F4", "E4"), (5,3), (4,2)],  # Chiave di violino
+        "bass": [("A3", "G3", "F3", "E3", "D3", "C3", "B2", "A2", "G2"), (3,5), (2,4)]     # Chiave di basso
+    }
+    note_names = ["C", "D", "E", "F", "G", "A", "B"]  # Nomi delle note musicali
+
+    #print("[getPitch] Using {} clef".format(staff.clef))
+
+    # Controlla prima se la nota è all'interno del pentagramma
+    if (note_center_y in staff.line_one):
+        return clef_info[staff.clef][0][0]
+    elif (note_center_y in list(range(staff.line_one[-1] + 1, staff.line_two[0]))):
+        return clef_info[staff.clef][0][1]
+    elif (note_center_y in staff.line_two):
+        return clef_info[staff.clef][0][2]
+    elif (note_center_y in list(range(staff.line_two[-1] + 1, staff.line_three[0]))):
+        return clef_info[staff.clef][0][3]
+    elif (note_center_y in staff.line_three):
+        return clef_info[staff.clef][0][4]
+    elif (note_center_y in list(range(staff.line_three[-1] + 1, staff.line_four[0]))):
+        return clef_info[staff.clef][0][5]
+    elif (note_center_y in staff.line_four):
+        return clef_info[staff.clef][0][6]
+    elif (note_center_y in list(range(staff.line_four[-1] + 1, staff.line_five[0]))):
+        return clef_info[staff.clef][0][7]
+    elif (note_center_y in staff.line_five):
+        return clef_info[staff.clef][0][8]
+    else:
+        # print("[getPitch] Note was not within staff")
+        if (note_center_y < staff.line_one[0]):
+            # print("[getPitch] Note above staff ")
+            # Controlla sopra il pentagramma
+            line_below = staff.line_one
+            current_line = [pixel - staff.line_spacing for pixel in staff.line_one] # Va alla linea sopra
+            octave = clef_info[staff.clef][1][0]  # Numero dell'ottava alla prima linea
+            note_index = clef_info[staff.clef][1][1]  # La posizione della prima linea nell'array note_names
+
+            while (current_line[0] > 0):
+                if (note_center_y in current_line):
+                    # Prende la nota due posizioni sopra
+                    octave = octave + 1 if (note_index + 2 >= 7) else octave
+                    note_index = (note_index + 2) % 7
+                    return note_names[note_index] + str(octave)
+                elif (note_center_y in range(current_line[-1] + 1, line_below[0])):
+                    # Prende la nota una posizione sopra
+                    octave = octave + 1 if (note_index + 1 >= 7) else octave
+                    note_index = (note_index + 1) % 7
+                    return note_names[note_index] + str(octave)
+                else:
+                    # Controlla la prossima linea sopra
+                    octave = octave + 1 if (note_index + 2 >= 7) else octave
+                    note_index = (note_index + 2) % 7
+                    line_below = current_line.copy()
+                    current_line = [pixel - staff.line_spacing for pixel in current_line]
+
+            assert False, "[ERRORE] La nota è sopra il pentagramma, ma non è stata trovata"
+        elif (note_center_y > staff.line_five[-1]):
+            # print("[getPitch] Note below staff ")
+            # Controlla sotto il pentagramma
+            line_above = staff.line_five
+            current_line = [pixel + staff.line_spacing for pixel in staff.line_five]  # Va alla linea sotto
+            octave = clef_info[staff.clef][2][0]  # Numero dell'ottava alla quinta linea
+            note_index = clef_info[staff.clef][2][1]  # La posizione della quinta linea nell'array note_names
+
+            while (current_line[-1] < staff.img.shape[0]):
+                if (note_center_y in current_line):
+                    # Prende la nota due posizioni sotto
+                    octave = octave - 1 if (note_index - 2 <= 7) else octave
+                    note_index = (note_index - 2) % 7
+                    return note_names[note_index] + str(octave)
+                elif (note_center_y in range(line_above[-1] + 1, current_line[0])):
+                    # Prende la nota una posizione sotto
+                    octave = octave - 1 if (note_index - 1 >= 7) else octave
+                    note_index = (note_index - 1) % 7
+                    return note_names[note_index] + str(octave)
+                else:
+                    # Controlla la prossima linea sotto
+                    octave = octave - 1 if (note_index - 2 <= 7) else octave
+                    note_index = (note_index - 2) % 7
+                    line_above = current_line.copy()
+                    current_line = [pixel + staff.line_spacing for pixel in current_line]
+            assert False, "[ERRORE] La nota è sotto il pentagramma, ma non è stata trovata"
+        else:
+            # Non dovremmo mai arrivare qui
+            assert False, "[ERRORE] La nota non è né dentro, né sopra, né sotto il pentagramma"
+
+
+class LegacyBoundingBox(object):
+    """BoundingBox originale: attributi in un dict per istanza, centro e area precalcolati"""
+    def __init__(self, x, y, w, h, score=None):
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.score = score
+        self.middle = self.x + self.w/2, self.y + self.h/2
+        self.area = self.w * self.h
+
+    def overlap(self, other):
+        overlap_x = max(0, min(self.x + self.w, other.x + other.w) - max(self.x, other.x))
+        overlap_y = max(0, min(self.y + self.h, other.y + other.h) - max(self.y, other.y))
+        return overlap_x * overlap_y / self.area
+
+    def distance(self, other):
+        dx = self.middle[0] - other.middle[0]
+        dy = self.middle[1] - other.middle[1]
+        return math.sqrt(dx*dx + dy*dy)
+
+
+# -------------------------------------------------------------------------------
+# Benchmark
+# -------------------------------------------------------------------------------
+
+
+def bench_ref_lengths(pages):
+    """get_ref_lengths: scansione pixel per pixel contro run-length NumPy"""
+    print("[INFO] Benchmark get_ref_lengths")
+    for name, img in pages.items():
+        legacy, legacy_time = timed(legacy_get_ref_lengths, img)
+        new, new_time = timed(get_ref_lengths, img)
+        print_row(name, legacy_time, new_time, legacy == new)
+
+
+def bench_staff_rows(pages):
+    """find_staffline_rows: istogramma pixel per pixel contro proiezione e somme prefisse"""
+    print("[INFO] Benchmark find_staffline_rows")
+    for name, img, line_width, line_spacing in pages_with_ref_lengths(pages):
+        legacy, legacy_time = timed(legacy_find_staffline_rows, img, line_width, line_spacing)
+        new, new_time = timed(find_staffline_rows, img, line_width, line_spacing)
+        print_row(name, legacy_time, new_time, legacy == new)
+
+
+def bench_staff_columns(pages):
+    """find_staffline_columns: scansione per colonna contro occupazione delle fasce"""
+    print("[INFO] Benchmark find_staffline_columns")
+    for name, img, line_width, line_spacing in pages_with_ref_lengths(pages):
+        rows = find_staffline_rows(img, line_width, line_spacing)
+        legacy, legacy_time = timed(legacy_find_staffline_columns, img, rows, line_width, line_spacing)
+        new, new_time = timed(find_staffline_columns, img, rows, line_width, line_spacing)
+        print_row(f"{name} ({len(rows)})", legacy_time, new_time, legacy == new)
+
+
+def bench_scale_prediction(pages):
+    """locate_templates: esplorazione completa delle scale contro scale previste dall'interlinea"""
+    print("[INFO] Benchmark scale previste in locate_templates")
+    banks = template_banks()
+
+    def positions(boxes):
+        merged = merge_boxes([b for group in boxes for b in group], 0.5)
+        return [b.getCorner() + (b.getWidth(), b.getHeight()) for b in merged]
+
+    for name, staffs in sample_staffs(pages):
+        sweep_time = predicted_time = 0.0
+        sweep_found = predicted_found = 0
+        same = True
+        for staff in staffs:
+            staff_img = staff.getImage()
+            for templates, lower, upper, thresh, spacing in banks.values():
+                boxes, elapsed = timed(locate_templates, staff_img, templates, lower, upper, thresh)
+                sweep_time += elapsed
+                sweep = positions(boxes)
+                boxes, elapsed = timed(
+                    locate_templates, staff_img, templates, lower, upper, thresh,
+                    staff.getLineSpacing(), spacing,
+                )
+                predicted_time += elapsed
+                predicted = positions(boxes)
+                sweep_found += len(sweep)
+                predicted_found += len(predicted)
+                # Confronta le posizioni dei riquadri, non solo il loro numero
+                same = same and sweep == predicted
+        print_row(name, sweep_time, predicted_time, same)
+        print(f"  {'':<20} simboli trovati: completa {sweep_found}, prevista {predicted_found}")
+
+
+def bench_template_cache(pages):
+    """Cache dei template ridimensionati: cv2.resize a ogni richiesta contro cache LRU"""
+    print("[INFO] Benchmark cache dei template ridimensionati")
+    banks = template_banks()
+    staffs = [staff for _, page_staffs in sample_staffs(pages) for staff in page_staffs]
+
+    # Sequenza di (template, scala) richiesta da match su tutti i pentagrammi
+    requests = []
+    for staff in staffs:
+        for templates, lower, upper, thresh, spacing in banks.values():
+            for scale_set in predict_scales(staff.getLineSpacing(), spacing, lower, upper):
+                requests.extend(zip(templates, scale_set))
+
+    def resize_all():
+        for template, scale in requests:
+            cv2.resize(template, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+
+    def cached_all():
+        for template, scale in requests:
+            template_cache.get(template, scale)
+
+    template_cache.clear()
+    _, resize_time = timed(resize_all)
+    _, cached_time = timed(cached_all)
+    print_row(f"{len(staffs)} pentagrammi", resize_time, cached_time, True)
+    print(f"  {'':<20} {template_cache.stats()}")
+
+
+def synthetic_boxes(num_boxes, seed=0):
+    """Riquadri sintetici raggruppati come i risultati di matchTemplate intorno ai glifi"""
+    rng = np.random.default_rng(seed)
+    num_glyphs = max(1, num_boxes // 50)
+    centers = rng.uniform([0, 0], [20000, 200], size=(num_glyphs, 2))
+    glyph = rng.integers(0, num_glyphs, size=num_boxes)
+    xy = centers[glyph] + rng.integers(-4, 5, size=(num_boxes, 2))
+    return np.column_stack([xy, np.full(num_boxes, 20.0), np.full(num_boxes, 18.0)])
+
+
+def box_tuples(boxes):
+    """Coordinate e punteggio dei riquadri, per confrontare i risultati di merge_boxes"""
+    return [(box.x, box.y, box.w, box.h, box.score) for box in boxes]
+
+
+def mixed_boxes(num_boxes, seed=0):
+    """Riquadri sintetici di dimensioni diverse che formano catene di sovrapposizioni"""
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform([0, 0], [num_boxes * 2, 120], size=(num_boxes, 2))
+    wh = rng.uniform(5, 40, size=(num_boxes, 2))
+    return np.column_stack([xy, wh, rng.uniform(0.5, 1.0, num_boxes)])
+
+
+def bench_merge_boxes(pages):
+    """merge_boxes: liste di BoundingBox contro BoxArray (stesse coordinate e stesso ordine)"""
+    print("[INFO] Benchmark merge_boxes")
+    banks = template_banks()
+    for name, staffs in sample_staffs(pages):
+        legacy_time = new_time = 0.0
+        num_candidates = legacy_found = new_found = 0
+        same = True
+        for staff in staffs:
+            for templates, lower, upper, thresh, spacing in banks.values():
+                groups = locate_templates(staff.getImage(), templates, lower, upper, thresh,
+                                          staff.getLineSpacing(), spacing)
+                boxes = BoxArray.concatenate(groups)
+                num_candidates += len(boxes)
+                legacy, elapsed = timed(legacy_merge_boxes, list(boxes), 0.5)
+                legacy_time += elapsed
+                legacy_found += len(legacy)
+                # Come in detection: i candidati arrivano già come BoxArray
+                new, elapsed = timed(merge_boxes, boxes, 0.5)
+                new_time += elapsed
+                new_found += len(new)
+                same = same and box_tuples(legacy) == box_tuples(new)
+        print_row(name, legacy_time, new_time, same)
+        print(f"  {'':<20} riquadri: candidati {num_candidates}, originale {legacy_found}, nuovo {new_found}")
+
+    synthetic = [
+        ("sintetici 5000", synthetic_boxes(5000)),
+        ("sintetici 50000", synthetic_boxes(50000)),
+        ("misti 2000", mixed_boxes(2000)),
+    ]
+    for label, coords in synthetic:
+        new, new_time = timed(merge_box_arrays, coords, 0.5)
+        if len(coords) <= 5000:
+            boxes = [BoundingBox(*c) for c in coords.tolist()]
+            legacy, legacy_time = timed(legacy_merge_boxes, boxes, 0.5)
+            columns = 5 if coords.shape[1] == 5 else 4
+            same = [t[:columns] for t in box_tuples(legacy)] == [tuple(row) for row in new.tolist()]
+        else:
+            legacy, legacy_time, same = None, float("nan"), True
+        print_row(label, legacy_time, new_time, same)
+        print(f"  {'':<20} riquadri uniti: originale {len(legacy) if legacy is not None else '-'}, "
+              f"nuovo {len(new)}")
+
+
+def traced(func, *args):
+    """Esegue func(*args) e restituisce (risultato, secondi, byte allocati e ancora in uso)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, elapsed, allocated
+
+
+def bench_box_arrays(pages):
+    """Riquadri candidati: un oggetto per riquadro contro colonne NumPy (BoxArray)"""
+    print("[INFO] Benchmark BoxArray")
+    for num_boxes in (5000, 50000):
+        # Posizioni come le restituisce match: righe, colonne e punteggi
+        coords = synthetic_boxes(num_boxes)
+        ys, xs = coords[:, 1].astype(np.int64), coords[:, 0].astype(np.int64)
+        scores = np.linspace(0.5, 1.0, num_boxes, dtype=np.float32)
+        legacy, legacy_time, legacy_bytes = traced(lambda: [
+            LegacyBoundingBox(x, y, 20.0, 18.0, score)
+            for y, x, score in zip(ys.tolist(), xs.tolist(), scores.tolist())
+        ])
+        boxes, new_time, new_bytes = traced(
+            lambda: BoxArray(xs, ys, np.full(num_boxes, 20.0), np.full(num_boxes, 18.0), scores))
+        print_row(f"creazione {num_boxes}", legacy_time, new_time, len(legacy) == len(boxes))
+        print(f"  {'':<20} memoria per riquadro: originale {legacy_bytes / num_boxes:.0f} B, "
+              f"nuovo {new_bytes / num_boxes:.0f} B")
+
+        reference = legacy[0]
+        legacy, legacy_time = timed(
+            lambda: [(box.overlap(reference), box.distance(reference)) for box in legacy])
+        new, new_time = timed(lambda: (boxes.overlap(boxes[0]), boxes.distance(boxes[0])))
+        match = np.allclose(np.array(legacy), np.column_stack(new))
+        print_row(f"overlap+distance {num_boxes}", legacy_time, new_time, match)
+
+
+def bench_pitch_lookup(pages):
+    """Staff.getPitch: liste ricostruite a ogni nota contro tabella y -> altezza"""
+    print("[INFO] Benchmark tabella delle altezze")
+
+    def pitch_or_error(get_pitch, staff, y):
+        try:
+            return get_pitch(staff, y)
+        except AssertionError as e:
+            return str(e)
+
+    for name, staffs in sample_staffs(pages):
+        legacy_time = new_time = vector_time = 0.0
+        same = True
+        num_rows = 0
+        for staff in staffs:
+            rows = list(range(staff.getImage().shape[0]))
+            num_rows += len(rows)
+            for clef in ("treble", "bass"):
+                staff.setClef(clef)
+                legacy, elapsed = timed(lambda: [pitch_or_error(legacy_get_pitch, staff, y) for y in rows])
+                legacy_time += elapsed
+                new, elapsed = timed(lambda: [pitch_or_error(Staff.getPitch, staff, y) for y in rows])
+                new_time += elapsed
+                same = same and legacy == new
+                valid = [y for y, pitch in zip(rows, legacy) if not pitch.startswith("[ERRORE]")]
+                vector, elapsed = timed(staff.getPitches, np.array(valid))
+                vector_time += elapsed
+                same = same and vector == [legacy[y] for y in valid]
+        print_row(f"{name} ({num_rows} righe)", legacy_time, new_time, same)
+        print(f"  {'':<20} per nota: originale {1e6 * legacy_time / (2 * num_rows):.1f} us, "
+              f"tabella {1e6 * new_time / (2 * num_rows):.2f} us, "
+              f"getPitches {1e6 * vector_time / (2 * num_rows):.3f} us")
+
+
+def same_symbols(full, peak):
+    """True se ogni simbolo trovato con i picchi cade in un simbolo diverso trovato con tutte le posizioni"""
+    if len(full) != len(peak):
+        return False
+    matched = set()
+    for box in peak:
+        cx, cy = box.getCenter()
+        for i, other in enumerate(full):
+            if i not in matched and other.x <= cx <= other.x + other.w and other.y <= cy <= other.y + other.h:
+                matched.add(i)
+                break
+    return len(matched) == len(full)
+
+
+def bench_peaks(pages):
+    """locate_templates + merge_boxes: tutte le posizioni sopra soglia contro i soli massimi locali"""
+    print("[INFO] Benchmark estrazione dei picchi")
+    banks = template_banks()
+
+    def locate_and_merge(staff, templates, lower, upper, thresh, spacing, peaks):
+        boxes = locate_templates(staff.getImage(), templates, lower, upper, thresh,
+                                 staff.getLineSpacing(), spacing, peaks=peaks)
+        boxes = [b for group in boxes for b in group]
+        merged, elapsed = timed(merge_boxes, boxes, 0.5)
+        return len(boxes), list(merged), elapsed
+
+    for name, staffs in sample_staffs(pages):
+        full_time = peak_time = full_merge = peak_merge = 0.0
+        full_candidates = peak_candidates = full_found = peak_found = 0
+        same = True
+        for staff in staffs:
+            for templates, lower, upper, thresh, spacing in banks.values():
+                (candidates, full, merge_time), elapsed = timed(
+                    locate_and_merge, staff, templates, lower, upper, thresh, spacing, False)
+                full_time += elapsed
+                full_merge += merge_time
+                full_candidates += candidates
+                full_found += len(full)
+                (candidates, peak, merge_time), elapsed = timed(
+                    locate_and_merge, staff, templates, lower, upper, thresh, spacing, True)
+                peak_time += elapsed
+                peak_merge += merge_time
+                peak_candidates += candidates
+                peak_found += len(peak)
+                same = same and same_symbols(full, peak)
+        print_row(name, full_time, peak_time, same)
+        print(f"  {'':<20} candidati: tutti {full_candidates}, picchi {peak_candidates}; "
+              f"simboli: tutti {full_found}, picchi {peak_found}")
+        print(f"  {'':<20} unione: tutti {full_merge:.4f}s, picchi {peak_merge:.4f}s")
+
+
+def bench_template_banks(pages):
+    """find_primitive: una chiamata a locate_templates per classe contro un'unica scansione"""
+    print("[INFO] Benchmark rilevamento multi-classe")
+    banks = [bank for bank, _, _, _ in detection.primitive_classes]
+
+    def per_class(staff):
+        candidates = {}
+        for bank in banks:
+            boxes = locate_templates(staff.getImage(), bank.templates, bank.start_percent,
+                                     bank.stop_percent, bank.threshold,
+                                     staff.getLineSpacing(), bank.reference_spacings)
+            candidates[bank.getName()] = [b for group in boxes for b in group]
+        return candidates
+
+    def as_tuples(candidates):
+        return {name: [(b.x, b.y, b.w, b.h, b.score) for b in boxes] for name, boxes in candidates.items()}
+
+    for name, staffs in sample_staffs(pages):
+        legacy_time = new_time = 0.0
+        same = True
+        for staff in staffs:
+            legacy, elapsed = timed(per_class, staff)
+            legacy_time += elapsed
+            new, elapsed = timed(locate_template_banks, staff.getImage(), banks, staff.getLineSpacing())
+            new_time += elapsed
+            same = same and as_tuples(legacy) == as_tuples(new)
+        print_row(name, legacy_time, new_time, same)
+
+
+def bench_correlation(pages):
+    """Correlazione per template: cv2.matchTemplate contro FFT con spettro dell'immagine condiviso"""
+    print("[INFO] Benchmark backend di correlazione")
+    banks = template_banks()
+    by_area = {}
+    for name, staffs in sample_staffs(pages):
+        spatial_time = fft_time = 0.0
+        max_error = 0.0
+        same = True
+        spectrum_cache.clear()
+        for staff in staffs:
+            image = CorrelationImage(staff.getImage())
+            for templates, lower, upper, thresh, spacing in banks.values():
+                for scale_set in predict_scales(staff.getLineSpacing(), spacing, lower, upper):
+                    for template, scale in zip(templates, scale_set):
+                        template = template_cache.get(template, scale)
+                        if template.shape[0] > image.height or template.shape[1] > image.width:
+                            continue
+                        spatial, spatial_elapsed = timed(correlate, image, template, "spatial")
+                        fft, fft_elapsed = timed(correlate, image, template, "fft")
+                        spatial_time += spatial_elapsed
+                        fft_time += fft_elapsed
+                        max_error = max(max_error, float(np.abs(spatial - fft).max()))
+                        same = same and np.array_equal(spatial >= thresh, fft >= thresh)
+                        area_class = 1 << int(np.log2(template.size))
+                        times = by_area.setdefault(area_class, [0, 0.0, 0.0])
+                        times[0] += 1
+                        times[1] += spatial_elapsed
+                        times[2] += fft_elapsed
+        print_row(name, spatial_time, fft_time, same)
+        print(f"  {'':<20} errore massimo {max_error:.2e}, {spectrum_cache.stats()}")
+
+    print("  area del template    matchTemplate (ms)     FFT (ms)")
+    for area_class in sorted(by_area):
+        count, spatial_time, fft_time = by_area[area_class]
+        print(f"  {area_class:>6}-{2 * area_class - 1:<8} {1000 * spatial_time / count:>16.2f} "
+              f"{1000 * fft_time / count:>12.2f}   ({count} template)")
+
+
+def detect_page(staffs, **options):
+    """Esegue find_clef_time_signature e find_primitive e restituisce le primitive trovate"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        staffs = detection.find_clef_time_signature(staffs, **options)
+        staffs = detection.find_primitive(staffs, **options)
+    return [
+        (i, primitive.getPrimitive(), primitive.getDuration(), primitive.getPitch(),
+         primitive.getBox().getCenter())
+        for i, staff in enumerate(staffs)
+        for bar in staff.getBars()
+        for primitive in bar.getPrimitives()
+    ]
+
+
+def count_matching(reference, found, tolerance=5):
+    """Numero di primitive di reference ritrovate in found (stesso tipo e centro entro tolerance)"""
+    remaining = list(found)
+    matched = 0
+    for staff, name, duration, pitch, (x, y) in reference:
+        for k, (other_staff, other_name, other_duration, other_pitch, (ox, oy)) in enumerate(remaining):
+            if ((staff, name, duration, pitch) == (other_staff, other_name, other_duration, other_pitch)
+                    and abs(x - ox) <= tolerance and abs(y - oy) <= tolerance):
+                matched += 1
+                del remaining[k]
+                break
+    return matched
+
+
+def bench_pyramid(pages):
+    """Rilevamento completo: ricerca esaustiva contro coarse-to-fine"""
+    print(f"[INFO] Benchmark ricerca coarse-to-fine (fattore {pyramid_factor})")
+    for name, staffs in sample_staffs(pages):
+        pyramid_staffs = copy.deepcopy(staffs)
+        exhaustive, exhaustive_time = timed(lambda: detect_page(staffs, pyramid=False))
+        pyramid, pyramid_time = timed(lambda: detect_page(pyramid_staffs, pyramid=True))
+        if isinstance(exhaustive, tuple) or isinstance(pyramid, tuple):
+            print(f"  {name:<20} errore: esaustiva {exhaustive if isinstance(exhaustive, tuple) else 'ok'}, "
+                  f"coarse-to-fine {pyramid if isinstance(pyramid, tuple) else 'ok'}")
+            continue
+        matched = count_matching(exhaustive, pyramid)
+        recall = matched / len(exhaustive) if exhaustive else 1.0
+        precision = matched / len(pyramid) if pyramid else 1.0
+        print_row(name, exhaustive_time, pyramid_time, matched == len(exhaustive) == len(pyramid))
+        print(f"  {'':<20} primitive: esaustiva {len(exhaustive)}, coarse-to-fine {len(pyramid)}; "
+              f"richiamo {recall:.3f}, precisione {precision:.3f}")
+
+
+def bench_staff_workers(pages):
+    """Rilevamento completo: pentagrammi in sequenza contro pool di thread"""
+    workers = os.cpu_count() or 1
+    print(f"[INFO] Benchmark pentagrammi in parallelo ({workers} thread)")
+    for name, staffs in sample_staffs(pages):
+        parallel_staffs = copy.deepcopy(staffs)
+        sequential, sequential_time = timed(lambda: detect_page(staffs, workers=1))
+        parallel, parallel_time = timed(lambda: detect_page(parallel_staffs, workers=workers))
+        print_row(f"{name} ({len(staffs)})", sequential_time, parallel_time, sequential == parallel)
+
+
+def detect_with_overlays(staffs, render):
+    """
+    Rilevamento completo di una pagina; con render riproduce il rilevamento
+    precedente alla modalità headless: copia a colori di ogni pentagramma
+    allocata prima della ricerca, simboli disegnati e immagini conservate fino
+    alla fine
+
+    Returns:
+        Tupla (primitive trovate, secondi, secondi spesi a disegnare, picco e
+        memoria trattenuta alla fine in byte)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    overlays = [cv2.cvtColor(staff.getImage(), cv2.COLOR_GRAY2RGB) for staff in staffs] if render else []
+    found = detect_page(staffs)
+    draw_start = time.perf_counter()
+    for img, staff in zip(overlays, staffs):
+        for annotation in staff.getAnnotations():
+            draw_annotation(img, *annotation)
+    end = time.perf_counter()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del overlays
+    return found, end - start, end - draw_start, peak, retained
+
+
+def bench_headless(pages):
+    """Rilevamento con le immagini dei pentagrammi contro rilevamento headless"""
+    print("[INFO] Benchmark rilevamento headless")
+    for name, staffs in sample_staffs(pages):
+        # Primo passaggio fuori misura: riempie le cache di template e spettri
+        warmup, _ = timed(detect_page, copy.deepcopy(staffs))
+        if isinstance(warmup, tuple):
+            print(f"  {name:<20} errore: {warmup}")
+            continue
+        rendered, rendered_time, draw_time, rendered_peak, rendered_retained = detect_with_overlays(
+            copy.deepcopy(staffs), True
+        )
+        headless, headless_time, _, headless_peak, headless_retained = detect_with_overlays(
+            copy.deepcopy(staffs), False
+        )
+        print_row(f"{name} ({len(staffs)})", rendered_time, headless_time, rendered == headless)
+        primitives = max(1, len(headless))
+        megabytes_per_staff = 2**20 * len(staffs)
+        print(f"  {'':<20} per primitiva: {1000 * rendered_time / primitives:.2f} ms contro "
+              f"{1000 * headless_time / primitives:.2f} ms, di cui disegno "
+              f"{1000 * draw_time / primitives:.3f} ms ({len(headless)} primitive)")
+        print(f"  {'':<20} per pentagramma: picco {rendered_peak / megabytes_per_staff:.2f} MB contro "
+              f"{headless_peak / megabytes_per_staff:.2f} MB, trattenuti "
+              f"{rendered_retained / megabytes_per_staff:.2f} MB contro "
+              f"{headless_retained / megabytes_per_staff:.2f} MB")
+
+
+def render_pdf_pages(pdf_path, extract):
+    """Pagine di un PDF da iter_pdf_pages, copiate, con o senza estrazione delle immagini incorporate"""
+    previous = pdf_utils.extract_embedded_images
+    pdf_utils.extract_embedded_images = extract
+    try:
+        return [img.copy() for _, img, _ in pdf_utils.iter_pdf_pages(pdf_path) if img is not None]
+    finally:
+        pdf_utils.extract_embedded_images = previous
+
+
+def bench_pdf_pages(pages):
+    """Pagine dei PDF in input: rendering a 300 dpi contro estrazione dell'immagine incorporata"""
+    print("[INFO] Benchmark acquisizione delle pagine dei PDF")
+    for filename in sorted(os.listdir(input_dir)):
+        if not pdf_utils.is_pdf(filename):
+            continue
+        pdf_path = os.path.join(input_dir, filename)
+        rendered, render_time = timed(render_pdf_pages, pdf_path, False)
+        extracted, extract_time = timed(render_pdf_pages, pdf_path, True)
+        # I decodificatori JPEG di MuPDF e OpenCV possono differire di qualche livello
+        match = len(rendered) == len(extracted) and all(
+            a.shape == b.shape and np.abs(a.astype(np.int16) - b).mean() < 1
+            for a, b in zip(rendered, extracted)
+        )
+        print_row(f"{filename[:14]} ({len(rendered)})", render_time, extract_time, match)
+
+
+BENCHMARKS = {
+    "ref_lengths": bench_ref_lengths,
+    "staff_rows": bench_staff_rows,
+    "staff_columns": bench_staff_columns,
+    "scale_prediction": bench_scale_prediction,
+    "template_cache": bench_template_cache,
+    "merge_boxes": bench_merge_boxes,
+    "box_arrays": bench_box_arrays,
+    "pitch_lookup": bench_pitch_lookup,
+    "peaks": bench_peaks,
+    "template_banks": bench_template_banks,
+    "correlation": bench_correlation,
+    "pyramid": bench_pyramid,
+    "staff_workers": bench_staff_workers,
+    "headless": bench_headless,
+    "pdf_pages": bench_pdf_pages,
+}
+
+
+def main():
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    unknown = [name for name in selected if name not in BENCHMARKS]
+    if unknown:
+        print(f"[ERRORE] Benchmark sconosciuti: {', '.join(unknown)}")
+        print(f"[INFO] Disponibili: {', '.join(BENCHMARKS)}")
+        sys.exit(1)
+
+    pages = load_sample_pages()
+    print(f"[INFO] Caricate {len(pages)} pagine di esempio da {samples_dir}")
+    for name in selected:
+        BENCHMARKS[name](pages)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
 import os
+from functools import partial
 import cv2
 from src.deskewing import get_ref_lengths
-from src.pdf_utils import is_pdf, pdf_to_images
+from src.pdf_utils import is_pdf, iter_pdf_pages, page_snapshot_dir, save_page_snapshots
 from src.staffline_detection import find_staffline_rows, find_staffline_columns, create_staffs
 from src.detection import find_clef_time_signature, find_primitive
+from src.parallel import map_pages
+from src.overlays import draw_detected_staffs, draw_staff_annotations, save_detections
+
+# Livello degli artefatti (none, summary o debug, vedi src.overlays): dalla riga
+# di comando per default vengono scritte tutte le immagini intermedie
+cli_artifact_level = os.environ.get("ARTIFACT_LEVEL", "debug")
 
 def process_image(img_file, output_dir):
     """Elabora una singola immagine di spartito musicale
@@ -21,36 +28,53 @@ def process_image(img_file, output_dir):
         print(f"[ERRORE] Impossibile leggere l'immagine {img_file}")
         return
     
+    img_basename = os.path.basename(img_file).split('.')[0]
+    return process_image_array(original_img, img_basename, output_dir)
+
+def process_image_array(original_img, img_basename, output_dir, artifact_level=cli_artifact_level):
+    """Elabora un'immagine di spartito già caricata in memoria
+
+    Usata per i file immagine (dopo la lettura da disco) e per le pagine dei PDF,
+    che arrivano direttamente dal renderer in scala di grigi. original_img non
+    viene modificata. Le immagini intermedie vengono scritte solo con
+    artifact_level "debug"; con "summary" vengono salvati solo i risultati del
+    rilevamento, da cui src.overlays può disegnarle in seguito.
+    """
     # Crea una directory per l'output di questa specifica immagine
     # Questo aiuta a mantenere organizzati i risultati di ciascuna elaborazione
-    img_basename = os.path.basename(img_file).split('.')[0]
     img_output_dir = os.path.join(output_dir, img_basename)
-    os.makedirs(img_output_dir, exist_ok=True)
+    if artifact_level != "none":
+        os.makedirs(img_output_dir, exist_ok=True)
+    debug = artifact_level == "debug"
     
     # Salva l'immagine originale prima di qualsiasi modifica
     # Utile per confronti e debug durante il processo di sviluppo
-    cv2.imwrite(os.path.join(img_output_dir, 'original.jpg'), original_img)
+    if debug:
+        cv2.imwrite(os.path.join(img_output_dir, 'original.jpg'), original_img)
     
     # Converti in scala di grigi se l'immagine è a colori
     # La conversione in scala di grigi semplifica l'elaborazione e riduce la dimensionalità
     if len(original_img.shape) == 3:
         img = cv2.cvtColor(original_img, cv2.COLOR_BGR2GRAY)
     else:
-        img = original_img.copy()
+        # Il denoising produce una nuova immagine: non serve copiare l'originale
+        img = original_img
 
     # ============ Rimozione del Rumore ============
     # Utilizziamo il filtro Non-Local Means per rimuovere il rumore mantenendo i bordi
     # Questo è particolarmente importante per gli spartiti musicali dove i dettagli fini come
     # le note e le linee devono essere preservati
     img = cv2.fastNlMeansDenoising(img, None, 10, 7, 21)
-    cv2.imwrite(os.path.join(img_output_dir, 'denoised.jpg'), img)
+    if debug:
+        cv2.imwrite(os.path.join(img_output_dir, 'denoised.jpg'), img)
     print("[INFO] Applicata rimozione del rumore")
 
     # Sogliatura di Otsu
     # Questo algoritmo determina automaticamente il valore ottimale di soglia
     # per binarizzare l'immagine, separando chiaramente lo sfondo dal testo/note
     retval, img = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
-    cv2.imwrite(os.path.join(img_output_dir, 'binarized.jpg'), img)
+    if debug:
+        cv2.imwrite(os.path.join(img_output_dir, 'binarized.jpg'), img)
     print("[INFO] Applicata sogliatura di Otsu " + str(retval))
 
     # ============ Deskewing (Raddrizzamento) ============
@@ -85,34 +109,49 @@ def process_image(img_file, output_dir):
     staffs = create_staffs(all_staffline_vertical_indices, all_staffline_horizontal_indices, line_width, line_spacing, img)
     print("[INFO] Trovati pentagrammi: ", len(staffs))
 
-    staff_boxes_img = img.copy()
-    staff_boxes_img = cv2.cvtColor(staff_boxes_img, cv2.COLOR_GRAY2RGB)
-    red = (0, 0, 255)
-    box_thickness = 2
-    for staff in staffs:
-        box = staff.getBox()
-        box.draw(staff_boxes_img, red, box_thickness)
-        x = int(box.getCorner()[0] + (box.getWidth() // 2))
-        y = int(box.getCorner()[1] + box.getHeight() + 35)
-        cv2.putText(staff_boxes_img, "Staff", (x, y), cv2.FONT_HERSHEY_DUPLEX, 0.9 , red)
-
     # Salva l'immagine con le linee del pentagramma rilevate
-    staff_boxes_img_path = os.path.join(img_output_dir, 'detected_staffs.jpg')
-    cv2.imwrite(staff_boxes_img_path, staff_boxes_img)
-    # open_file('output/detected_staffs.jpg')
-    print("[INFO] Saving detected staffs onto disk")
+    if debug:
+        staff_boxes_img = draw_detected_staffs(img, [staff.getBox() for staff in staffs])
+        staff_boxes_img_path = os.path.join(img_output_dir, 'detected_staffs.jpg')
+        cv2.imwrite(staff_boxes_img_path, staff_boxes_img)
+        # open_file('output/detected_staffs.jpg')
+        print("[INFO] Saving detected staffs onto disk")
 
-    staffs, staff_imgs_color = find_clef_time_signature(staffs)
+    staffs = find_clef_time_signature(staffs)
 
-    staffs, staff_imgs_color = find_primitive(staffs, staff_imgs_color)
+    staffs = find_primitive(staffs)
     
-    # Salva l'immagine con le linee del pentagramma rilevate
-    for i in range(len(staffs)):
-        staff_img_color = staff_imgs_color[i]
-        cv2.imwrite(os.path.join(img_output_dir, "staff_{}_primitives.jpg".format(i+1)), staff_img_color)
+    # Disegna e salva le immagini dei pentagrammi con i simboli rilevati
+    if debug:
+        for i in range(len(staffs)):
+            staff_img_color = draw_staff_annotations(staffs[i])
+            cv2.imwrite(os.path.join(img_output_dir, "staff_{}_primitives.jpg".format(i+1)), staff_img_color)
+
+    # Risultati del rilevamento e pagina binarizzata per disegnare le immagini in seguito
+    if artifact_level != "none":
+        save_detections(img_output_dir, img, staffs, line_width=line_width,
+                        line_spacing=line_spacing, threshold_value=retval)
 
     return img
 
+def process_page(page, output_dir):
+    """Elabora una pagina di un PDF, eventualmente in un processo del pool
+
+    page è la terna (numero di pagina, immagine, dpi) prodotta da iter_pdf_pages.
+    Gli errori di una pagina non interrompono le altre. Restituisce solo
+    l'esito, così l'immagine binarizzata non viene copiata tra i processi.
+    """
+    page_number, page_img, dpi = page
+    if page_img is None:
+        print(f"[ERRORE] Pagina {page_number} non renderizzata, nessuna elaborazione")
+        return False
+    print(f"[🤖] Elaborazione della pagina {page_number} ({dpi} dpi)")
+    try:
+        return process_image_array(page_img, f"page_{page_number:03d}", output_dir) is not None
+    except Exception as e:
+        print(f"[ERRORE] Elaborazione della pagina {page_number} non riuscita: {e}")
+        return False
+
 def main(file_path):
     """Funzione principale che gestisce il flusso di elaborazione
     
@@ -125,21 +164,17 @@ def main(file_path):
     file_name = os.path.basename(file_path).split('.')[0]
     output_dir = os.path.join(output_dir, file_name)
     if is_pdf(file_path):
-        # Se è un PDF, converti tutte le pagine in JPG
+        # Se è un PDF, le pagine vengono renderizzate in memoria una alla volta
         # Molti spartiti musicali sono distribuiti in formato PDF e devono essere
         # convertiti in immagini per l'elaborazione
         print(f"[INFO] Il file di input è un PDF, conversione in immagini in corso")
-        image_paths = pdf_to_images(file_path, output_dir)
+        snapshot_dir = page_snapshot_dir(file_path, output_dir) if save_page_snapshots else None
+        pages = iter_pdf_pages(file_path, snapshot_dir=snapshot_dir)
         
-        # Processa ogni immagine estratta dal PDF
-        # Ogni pagina viene elaborata individualmente
-
-        print(f"[INFO] Trovate {len(image_paths)} pagine nel PDF")
-        # process only the first page
-        image_paths = image_paths[:1]
-
-        for img_path in image_paths:
-            process_image(img_path, output_dir)
+        # Processa ogni pagina del PDF man mano che viene renderizzata
+        # Ogni pagina viene elaborata individualmente, su un pool di processi
+        processed = map_pages(partial(process_page, output_dir=output_dir), pages)
+        print(f"[INFO] Elaborate {sum(processed)} pagine su {len(processed)}")
     else:
         # Se non è un PDF, processa come una singola immagine
         process_image(file_path, output_dir)
@@ -2,17 +2,26 @@ import os
 import json
 import uuid
 import shutil
-from flask import Flask, request, jsonify, send_file, render_template_string
+from flask import Flask, Response, request, jsonify, render_template_string, send_file
 from flask_cors import CORS
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 import cv2
-import base64
 from datetime import datetime
-import zipfile
-import tempfile
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # Import delle funzioni di processamento esistenti
-from src.pdf_utils import is_pdf, pdf_to_images
+from src.pdf_utils import (
+    is_pdf,
+    iter_pdf_pages,
+    page_snapshot_dir,
+    pdf_page_count,
+    save_page_snapshots,
+)
 from src.deskewing import get_ref_lengths
 from src.staffline_detection import (
     find_staffline_rows,
@@ -20,6 +29,28 @@ from src.staffline_detection import (
     create_staffs,
 )
 from src.detection import find_clef_time_signature, find_primitive
+from src.utils import template_cache, spectrum_cache
+from src.parallel import map_pages, page_event_queue, page_workers
+from src.zip_stream import ZipManifest, ZipStream, write_manifest
+from src.artifacts import get_thumbnail, list_artifacts, thumbnail_sizes
+from src.overlays import (
+    artifact_level,
+    artifact_levels,
+    draw_detected_staffs,
+    draw_staff_annotations,
+    render_image,
+    render_missing_images,
+    save_detections,
+)
+from src.job_events import JobEventRegistry
+from src.job_index import JobIndex, job_index_path, jobs_page_size, sort_expressions
+from src.result_cache import (
+    ResultCache,
+    pipeline_fingerprint,
+    result_cache_dir,
+    result_cache_size_mb,
+    save_stream,
+)
 
 app = Flask(__name__)
 CORS(app, origins=["*"])  # Permetti accesso da qualsiasi origine per la demo
@@ -29,6 +60,16 @@ UPLOAD_FOLDER = "uploads"
 OUTPUT_FOLDER = "output"
 MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB max file size
 
+# Lavori elaborati contemporaneamente in background (le pagine di ogni lavoro
+# sono già distribuite sul pool di processi) e lavori che possono attendere in
+# coda: oltre questo limite /upload risponde 503
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 1))
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", 16))
+
+# Durata (in secondi) per cui i client possono riusare un artefatto senza
+# rivalidarlo; dopo la scadenza la richiesta condizionale riceve 304
+ARTIFACT_MAX_AGE = int(os.environ.get("ARTIFACT_MAX_AGE", 3600))
+
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["OUTPUT_FOLDER"] = OUTPUT_FOLDER
 app.config["MAX_CONTENT_LENGTH"] = MAX_FILE_SIZE
@@ -40,6 +81,28 @@ os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 # Estensioni di file permesse
 ALLOWED_EXTENSIONS = {"pdf", "png", "jpg", "jpeg", "gif", "bmp", "tiff", "tif"}
 
+# Coda dei lavori: i thread di job_executor eseguono la pipeline, job_slots
+# limita i lavori accettati (in elaborazione + in coda), queued_jobs conserva
+# l'ordine dei lavori in attesa per riportarne la posizione
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+job_slots = threading.BoundedSemaphore(JOB_WORKERS + MAX_QUEUED_JOBS)
+queued_jobs = []
+jobs_lock = threading.Lock()
+
+# Eventi di avanzamento dei lavori per /process/<job_id>/events
+job_events = JobEventRegistry()
+
+# Cache dei risultati: un file già elaborato con la stessa pipeline (stesso
+# codice, template e impostazioni) riusa gli artefatti esistenti
+result_cache = ResultCache(result_cache_dir, result_cache_size_mb * 1024 * 1024)
+PIPELINE_FINGERPRINT = pipeline_fingerprint(extra_files=[os.path.abspath(__file__)])
+
+# Indice dei lavori per /jobs, aggiornato a ogni salvataggio dei metadati. Se è
+# vuoto (primo avvio) o JOB_INDEX_REBUILD=true viene ricostruito dai metadata.json
+job_index = JobIndex(job_index_path)
+if job_index.count() == 0 or os.environ.get("JOB_INDEX_REBUILD", "false").lower() == "true":
+    print(f"[INFO] Indice dei lavori ricostruito: {job_index.rebuild(OUTPUT_FOLDER)} lavori")
+
 
 def allowed_file(filename):
     """Verifica se il file ha un'estensione permessa"""
@@ -59,16 +122,6 @@ def get_file_info(filepath):
     }
 
 
-def encode_image_to_base64(image_path):
-    """Converte un'immagine in base64 per la risposta JSON"""
-    try:
-        with open(image_path, "rb") as img_file:
-            return base64.b64encode(img_file.read()).decode("utf-8")
-    except Exception as e:
-        print(f"Errore nell'encoding dell'immagine {image_path}: {e}")
-        return None
-
-
 @app.route("/", methods=["GET"])
 def home():
     """Endpoint di benvenuto - serve la demo HTML se richiesta nel browser"""
@@ -250,6 +303,10 @@ def get_inline_demo_html():
 
                 if (response.ok) {
                     currentJobId = result.job_id;
+                    const job = await waitForJob(currentJobId);
+                    if (job.status !== 'completed') {
+                        throw new Error(job.error || 'Processamento fallito');
+                    }
                     showStatus(`Elaborazione completata! Job ID: ${currentJobId}`, 'success');
                     await loadResults(currentJobId);
                 } else {
@@ -263,6 +320,41 @@ def get_inline_demo_html():
             }
         }
 
+        function waitForJob(jobId) {
+            // Il lavoro viene elaborato in background: segue gli eventi di avanzamento
+            // (il browser si ricollega da solo se la connessione cade) e al termine
+            // legge lo stato finale
+            return new Promise((resolve, reject) => {
+                const source = new EventSource(`${API_BASE}/process/${jobId}/events`);
+                const finish = async () => {
+                    source.close();
+                    try {
+                        const response = await fetch(`${API_BASE}/process/${jobId}`);
+                        const job = await response.json();
+                        if (!response.ok) {
+                            throw new Error(job.error || 'Lavoro non trovato');
+                        }
+                        resolve(job);
+                    } catch (error) {
+                        reject(error);
+                    }
+                };
+                source.addEventListener('queued', event => {
+                    const data = JSON.parse(event.data);
+                    showStatus(`In coda (posizione ${data.queue_position || '-'})...`, 'success');
+                });
+                source.addEventListener('stage', event => {
+                    const data = JSON.parse(event.data);
+                    showStatus(`Pagina ${data.page}: fase ${data.stage} completata (${data.elapsed.toFixed(1)} s)`, 'success');
+                });
+                source.addEventListener('page', event => {
+                    const data = JSON.parse(event.data);
+                    showStatus(`Elaborazione in corso: ${data.pages_done}/${data.pages_total} pagine (${data.elapsed.toFixed(1)} s)`, 'success');
+                });
+                ['completed', 'failed', 'cancelled'].forEach(type => source.addEventListener(type, finish));
+            });
+        }
+
         async function loadResults(jobId) {
             try {
                 const response = await fetch(`${API_BASE}/process/${jobId}?include_images=true`);
@@ -293,13 +385,16 @@ def get_inline_demo_html():
 
             // Mostra immagini risultato
             resultsGrid.innerHTML = '';
-            if (result.images) {
-                Object.entries(result.images).forEach(([path, base64]) => {
+            if (result.artifacts) {
+                result.artifacts.filter(artifact => artifact.thumbnails).forEach(artifact => {
+                    const preview = artifact.thumbnails.preview;
                     const card = document.createElement('div');
                     card.className = 'result-card';
                     card.innerHTML = `
-                        <h4>${path}</h4>
-                        <img src="data:image/jpeg;base64,${base64}" class="result-image" alt="${path}">
+                        <h4>${artifact.path}</h4>
+                        <a href="${API_BASE}${artifact.url}" target="_blank">
+                            <img src="${API_BASE}${preview.url}" width="${preview.width}" height="${preview.height}" loading="lazy" class="result-image" alt="${artifact.path}">
+                        </a>
                     `;
                     resultsGrid.appendChild(card);
                 });
@@ -329,17 +424,183 @@ def health():
             "timestamp": datetime.now().isoformat(),
             "upload_folder": os.path.exists(UPLOAD_FOLDER),
             "output_folder": os.path.exists(OUTPUT_FOLDER),
+            "template_cache": template_cache.stats(),
+            "spectrum_cache": spectrum_cache.stats(),
+            "result_cache": result_cache.stats(),
+            "job_queue": {
+                "workers": JOB_WORKERS,
+                "max_queued": MAX_QUEUED_JOBS,
+                "queued": len(queued_jobs),
+            },
         }
     )
 
 
+def save_job_metadata(job_metadata):
+    """
+    Salva metadata.json di un lavoro
+
+    Il file viene scritto accanto e poi rinominato, così chi lo legge mentre il
+    lavoro è in corso (ad esempio /process/<job_id>) non trova mai un file a metà.
+    Subito dopo viene aggiornata la riga del lavoro nell'indice usato da /jobs.
+    """
+    metadata_path = os.path.join(job_metadata["output_dir"], "metadata.json")
+    tmp_path = metadata_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(job_metadata, f, indent=2)
+    os.replace(tmp_path, metadata_path)
+    job_index.update(job_metadata)
+
+
+def enqueue_job(job_metadata):
+    """
+    Mette in coda un lavoro per l'elaborazione in background
+
+    Returns:
+        False se la coda è piena e il lavoro non è stato accettato
+    """
+    if not job_slots.acquire(blocking=False):
+        return False
+    events = job_events.create(job_metadata["job_id"])
+    with jobs_lock:
+        queued_jobs.append(job_metadata["job_id"])
+        queue_position = len(queued_jobs)
+    events.publish("queued", queue_position=queue_position)
+    job_executor.submit(run_job, job_metadata)
+    return True
+
+
+def get_queue_position(job_id):
+    """Posizione (da 1) di un lavoro in attesa nella coda, None se non è in coda"""
+    with jobs_lock:
+        if job_id in queued_jobs:
+            return queued_jobs.index(job_id) + 1
+    return None
+
+
+def run_job(job_metadata):
+    """
+    Esegue la pipeline per un lavoro in coda in un thread di job_executor
+
+    Lo stato in metadata.json passa da queued a processing e infine a completed
+    o failed; durante l'elaborazione "progress" riporta le pagine completate.
+    Ogni cambio di stato, fase e pagina completata viene pubblicato anche
+    come evento per /process/<job_id>/events.
+    """
+    job_id = job_metadata["job_id"]
+    events = job_events.get(job_id) or job_events.create(job_id)
+    with jobs_lock:
+        if job_id not in queued_jobs:
+            # Lavoro eliminato mentre era in coda: il posto è già stato liberato
+            return
+        queued_jobs.remove(job_id)
+
+    try:
+        job_metadata["status"] = "processing"
+        job_metadata["started_at"] = datetime.now().isoformat()
+        save_job_metadata(job_metadata)
+        events.publish("processing")
+
+        def report_progress(pages_done, pages_total):
+            job_metadata["progress"] = {
+                "pages_done": pages_done,
+                "pages_total": pages_total,
+                "percent": round(100 * pages_done / pages_total) if pages_total else 0,
+            }
+            save_job_metadata(job_metadata)
+
+        try:
+            result = process_file_with_details(
+                job_metadata["file_path"],
+                job_metadata["output_dir"],
+                progress=report_progress,
+                on_event=events.publish,
+                artifact_level=job_metadata.get("artifact_level", artifact_level),
+            )
+
+            # Aggiorna i metadati con il risultato
+            job_metadata["status"] = "completed"
+            job_metadata["completed_at"] = datetime.now().isoformat()
+            job_metadata["result"] = result
+
+            if "cache_key" in job_metadata:
+                result_cache.put(
+                    job_metadata["cache_key"], job_metadata["output_dir"], result
+                )
+
+        except Exception as e:
+            job_metadata["status"] = "failed"
+            job_metadata["error"] = str(e)
+            job_metadata["failed_at"] = datetime.now().isoformat()
+
+        save_job_metadata(job_metadata)
+        if job_metadata["status"] == "completed":
+            write_archive_manifest(job_metadata["output_dir"])
+            events.publish(
+                "completed", staffs_detected=job_metadata["result"]["staffs_detected"]
+            )
+        else:
+            events.publish("failed", error=job_metadata["error"])
+        print(f"[INFO] Lavoro {job_id}: {job_metadata['status']}")
+
+    except Exception as e:
+        print(f"[ERRORE] Lavoro {job_id} interrotto: {e}")
+    finally:
+        job_slots.release()
+
+
+def recover_jobs():
+    """
+    Rimette in coda i lavori rimasti queued o processing dopo un riavvio del server
+
+    Un lavoro interrotto a metà viene rielaborato da capo; quelli che non trovano
+    posto in coda vengono segnati come falliti.
+    """
+    if not os.path.exists(OUTPUT_FOLDER):
+        return
+
+    pending = []
+    for job_dir in os.listdir(OUTPUT_FOLDER):
+        metadata_path = os.path.join(OUTPUT_FOLDER, job_dir, "metadata.json")
+        if not os.path.exists(metadata_path):
+            continue
+        try:
+            with open(metadata_path, "r") as f:
+                metadata = json.load(f)
+        except Exception as e:
+            print(f"Errore nel leggere i metadati per {job_dir}: {e}")
+            continue
+        if metadata.get("status") in ("queued", "processing"):
+            pending.append(metadata)
+
+    for metadata in sorted(pending, key=lambda m: m.get("uploaded_at", "")):
+        metadata["status"] = "queued"
+        metadata.pop("progress", None)
+        save_job_metadata(metadata)
+        if enqueue_job(metadata):
+            print(f"[INFO] Lavoro {metadata['job_id']} rimesso in coda")
+        else:
+            metadata["status"] = "failed"
+            metadata["error"] = "Coda piena al riavvio del server"
+            metadata["failed_at"] = datetime.now().isoformat()
+            save_job_metadata(metadata)
+
+
 @app.route("/upload", methods=["POST"])
 def upload_and_process():
     """
-    Carica un file (PDF o immagine) e avvia il processamento
+    Carica un file (PDF o immagine) e lo mette in coda per il processamento
+
+    Il file viene salvato calcolandone l'hash: se lo stesso file è già stato
+    elaborato con la stessa pipeline, il lavoro viene completato subito con gli
+    artefatti della cache dei risultati.
+
+    Il campo (o parametro) opzionale "artifacts" sceglie il livello degli
+    artefatti del lavoro: none, summary o debug (default: ARTIFACT_LEVEL).
 
     Returns:
-        JSON con job_id per tracciare il processamento
+        JSON con job_id per tracciare il processamento (202), con status
+        completed se il risultato era in cache (200), oppure 503 se la coda è piena
     """
     try:
         # Verifica che sia stato inviato un file
@@ -360,13 +621,23 @@ def upload_and_process():
                 400,
             )
 
+        level = request.form.get("artifacts") or request.args.get("artifacts") or artifact_level
+        if level not in artifact_levels:
+            return (
+                jsonify(
+                    {"error": f'Livello degli artefatti non supportato. Livelli supportati: {", ".join(artifact_levels)}'}
+                ),
+                400,
+            )
+
         # Genera un ID univoco per questo lavoro
         job_id = str(uuid.uuid4())
 
-        # Salva il file caricato
+        # Salva il file caricato calcolandone l'hash durante la scrittura
         filename = secure_filename(file.filename)
         file_path = os.path.join(UPLOAD_FOLDER, f"{job_id}_{filename}")
-        file.save(file_path)
+        file_hash, _ = save_stream(file.stream, file_path)
+        cache_key = result_cache.key(file_hash, PIPELINE_FINGERPRINT, level)
 
         # Ottieni informazioni sul file
         file_info = get_file_info(file_path)
@@ -381,80 +652,182 @@ def upload_and_process():
             "filename": filename,
             "uploaded_at": datetime.now().isoformat(),
             "file_info": file_info,
-            "status": "processing",
+            "file_hash": file_hash,
+            "cache_key": cache_key,
+            "artifact_level": level,
+            "status": "queued",
             "file_path": file_path,
             "output_dir": job_output_dir,
         }
 
-        metadata_path = os.path.join(job_output_dir, "metadata.json")
-        with open(metadata_path, "w") as f:
-            json.dump(job_metadata, f, indent=2)
-
-        # Avvia il processamento
-        try:
-            # Usa la funzione main esistente
-            result = process_file_with_details(file_path, job_output_dir)
-
-            # Aggiorna i metadati con il risultato
+        # Stesso file già elaborato con la stessa pipeline: il lavoro è completato
+        # subito collegando gli artefatti della cache
+        cached_result = result_cache.materialize(cache_key, job_output_dir)
+        if cached_result is not None:
             job_metadata["status"] = "completed"
             job_metadata["completed_at"] = datetime.now().isoformat()
-            job_metadata["result"] = result
+            job_metadata["cache_hit"] = True
+            job_metadata["result"] = cached_result
+            save_job_metadata(job_metadata)
+            write_archive_manifest(job_output_dir)
+            return jsonify(
+                {
+                    "job_id": job_id,
+                    "status": "completed",
+                    "cache_hit": True,
+                    "status_url": f"/process/{job_id}",
+                    "message": "Risultato già disponibile",
+                }
+            )
 
-        except Exception as e:
-            job_metadata["status"] = "failed"
-            job_metadata["error"] = str(e)
-            job_metadata["failed_at"] = datetime.now().isoformat()
+        save_job_metadata(job_metadata)
 
-        # Salva i metadati aggiornati
-        with open(metadata_path, "w") as f:
-            json.dump(job_metadata, f, indent=2)
+        # Il processamento avviene in background: la risposta non attende la pipeline
+        if not enqueue_job(job_metadata):
+            shutil.rmtree(job_output_dir, ignore_errors=True)
+            job_index.remove(job_id)
+            os.remove(file_path)
+            return (
+                jsonify({"error": "Troppi lavori in coda, riprova più tardi"}),
+                503,
+                {"Retry-After": "30"},
+            )
 
-        return jsonify(
-            {
-                "job_id": job_id,
-                "status": job_metadata["status"],
-                "message": (
-                    "Processamento completato"
-                    if job_metadata["status"] == "completed"
-                    else "Processamento fallito"
-                ),
-            }
+        return (
+            jsonify(
+                {
+                    "job_id": job_id,
+                    "status": "queued",
+                    "queue_position": get_queue_position(job_id),
+                    "status_url": f"/process/{job_id}",
+                    "message": "Lavoro in coda per il processamento",
+                }
+            ),
+            202,
         )
 
     except Exception as e:
         return jsonify({"error": f"Errore durante il caricamento: {str(e)}"}), 500
 
 
-def process_file_with_details(file_path, output_dir):
+def process_file_with_details(
+    file_path, output_dir, progress=None, on_event=None, artifact_level=artifact_level
+):
     """
     Processa un file e restituisce informazioni dettagliate sui risultati
 
     Args:
         file_path: Percorso del file da processare
         output_dir: Directory di output
+        progress: Funzione opzionale chiamata con (pagine completate, pagine
+            totali) all'inizio e dopo ogni pagina
+        on_event: Funzione opzionale chiamata con (tipo, **dati) per ogni fase
+            completata ("stage": render, denoise, binarize, ref_lengths,
+            staff_detection, clef_time, primitives) e ogni pagina completata
+            ("page"). Le fasi delle pagine elaborate nel pool di processi
+            arrivano dai processi del pool attraverso una coda condivisa
+        artifact_level: Livello degli artefatti: none, summary o debug (vedi
+            process_image_array_with_details)
 
     Returns:
         Dict con informazioni dettagliate sui risultati
     """
     result = {"images_processed": [], "staffs_detected": 0, "output_files": []}
 
+    # Le fasi eseguite nel processo corrente vengono riportate appena completate
+    stage_done = None
+    if on_event is not None:
+        stage_done = lambda record: on_event("stage", **record)
+
     try:
         if is_pdf(file_path):
             # Processa PDF
             print(f"[INFO] Processamento PDF: {file_path}")
-            image_paths = pdf_to_images(file_path, output_dir)
-
-            # Processa solo la prima pagina (come nel codice originale)
-            image_paths = image_paths[:1]
-
-            for img_path in image_paths:
-                img_result = process_single_image_with_details(img_path, output_dir)
+            snapshot_dir = (
+                page_snapshot_dir(file_path, output_dir) if save_page_snapshots else None
+            )
+            pages = iter_pdf_pages(file_path, snapshot_dir=snapshot_dir)
+            if stage_done is not None:
+                pages = timed_pages(pages, stage_done)
+
+            pages_total = pdf_page_count(file_path)
+            if progress is not None:
+                progress(0, pages_total)
+
+            # Con il pool di processi le fasi di una pagina vengono messe in una
+            # coda dal processo che la elabora e pubblicate appena arrivano da un
+            # thread; anche gli eventi delle pagine passano dalla coda, dopo le
+            # fasi della pagina, così restano in ordine
+            event_queue = None
+            worker_stage_done = stage_done
+            if on_event is not None and page_workers > 1:
+                event_queue = page_event_queue()
+                worker_stage_done = partial(queue_event, event_queue, "stage")
+                forwarder = threading.Thread(
+                    target=forward_events, args=(event_queue, on_event), daemon=True
+                )
+                forwarder.start()
+
+            def page_done(index, page_result):
+                if on_event is not None:
+                    page_event = {
+                        "page": page_result["page"],
+                        "staffs_count": page_result.get("staffs_count", 0),
+                        "error": page_result.get("error"),
+                        "pages_done": index + 1,
+                        "pages_total": pages_total,
+                    }
+                    if event_queue is not None:
+                        queue_event(event_queue, "page", page_event)
+                    else:
+                        on_event("page", **page_event)
+                if progress is not None:
+                    progress(index + 1, pages_total)
+
+            # Le pagine vengono renderizzate in memoria man mano che servono,
+            # elaborate su un pool di processi e i risultati raccolti nell'ordine
+            # delle pagine
+            try:
+                page_results = map_pages(
+                    partial(
+                        process_page_with_details,
+                        output_dir=output_dir,
+                        on_stage=worker_stage_done,
+                        artifact_level=artifact_level,
+                    ),
+                    pages,
+                    callback=page_done,
+                )
+            finally:
+                if event_queue is not None:
+                    event_queue.put(None)
+                    forwarder.join()
+            for img_result in page_results:
                 result["images_processed"].append(img_result)
                 result["staffs_detected"] += img_result.get("staffs_count", 0)
+
+            result["pages_failed"] = sum(1 for r in page_results if "error" in r)
+            if page_results and result["pages_failed"] == len(page_results):
+                raise Exception(page_results[0]["error"])
         else:
             # Processa singola immagine
             print(f"[INFO] Processamento immagine: {file_path}")
-            img_result = process_single_image_with_details(file_path, output_dir)
+            if progress is not None:
+                progress(0, 1)
+            img_result = process_single_image_with_details(
+                file_path, output_dir, on_stage=stage_done, artifact_level=artifact_level
+            )
+            if on_event is not None:
+                on_event(
+                    "page",
+                    page=1,
+                    staffs_count=img_result.get("staffs_count", 0),
+                    error=None,
+                    pages_done=1,
+                    pages_total=1,
+                )
+            if progress is not None:
+                progress(1, 1)
             result["images_processed"].append(img_result)
             result["staffs_detected"] = img_result.get("staffs_count", 0)
 
@@ -468,48 +841,203 @@ def process_file_with_details(file_path, output_dir):
     return result
 
 
-def process_single_image_with_details(img_file, output_dir):
+def queue_event(event_queue, event_type, data):
+    """Mette un evento (tipo, dati) nella coda letta da forward_events"""
+    event_queue.put((event_type, data))
+
+
+def forward_events(event_queue, on_event):
+    """
+    Pubblica con on_event gli eventi della coda nell'ordine in cui arrivano,
+    fino a None
+    """
+    while True:
+        item = event_queue.get()
+        if item is None:
+            return
+        event_type, data = item
+        try:
+            on_event(event_type, **data)
+        except Exception as e:
+            print(f"[ERRORE] Evento {event_type} non pubblicato: {e}")
+
+
+def timed_pages(pages, on_stage):
+    """
+    Inoltra le pagine prodotte da iter_pdf_pages riportando a on_stage la fase
+    "render" di ognuna (tempo impiegato per ottenere l'immagine della pagina)
+    """
+    while True:
+        start = time.perf_counter()
+        page = next(pages, None)
+        if page is None:
+            return
+        on_stage(
+            {
+                "stage": "render",
+                "page": page[0],
+                "duration": round(time.perf_counter() - start, 3),
+                "dpi": page[2],
+            }
+        )
+        yield page
+
+
+def process_page_with_details(page, output_dir, on_stage=None, artifact_level=artifact_level):
+    """
+    Processa una pagina di un PDF, eventualmente in un processo del pool
+
+    page è la terna (numero di pagina, immagine, dpi) prodotta da iter_pdf_pages;
+    la risoluzione usata viene riportata nel risultato della pagina.
+    Un errore su una pagina (ad esempio un frontespizio senza pentagrammi o una
+    pagina che non è stato possibile renderizzare) viene riportato nel risultato
+    della pagina senza interrompere le altre.
+    on_stage riceve le fasi completate della pagina; nel pool deve essere
+    serializzabile (ad esempio partial di queue_event).
+    """
+    page_number, page_img, dpi = page
+    if page_img is None:
+        print(f"[ERRORE] Pagina {page_number} non renderizzata, nessuna elaborazione")
+        return {
+            "page": page_number,
+            "dpi": dpi,
+            "image_path": None,
+            "staffs_count": 0,
+            "error": "Impossibile renderizzare la pagina del PDF",
+        }
+    print(f"[🤖] Elaborazione della pagina {page_number} ({dpi} dpi)")
+    stage_done = None
+    if on_stage is not None:
+        stage_done = lambda record: on_stage(dict(record, page=page_number))
+    try:
+        result = process_image_array_with_details(
+            page_img,
+            f"page_{page_number:03d}",
+            output_dir,
+            on_stage=stage_done,
+            artifact_level=artifact_level,
+        )
+    except Exception as e:
+        print(f"[ERRORE] Errore nella pagina {page_number}: {e}")
+        return {
+            "page": page_number,
+            "dpi": dpi,
+            "image_path": None,
+            "staffs_count": 0,
+            "error": str(e),
+        }
+    result["page"] = page_number
+    result["dpi"] = dpi
+    return result
+
+
+def process_single_image_with_details(
+    img_file, output_dir, on_stage=None, artifact_level=artifact_level
+):
     """
     Processa una singola immagine e restituisce informazioni dettagliate
 
     Args:
         img_file: Percorso dell'immagine
         output_dir: Directory di output
+        on_stage: Funzione opzionale chiamata con il record di ogni fase completata
+        artifact_level: Livello degli artefatti (vedi process_image_array_with_details)
 
     Returns:
         Dict con informazioni sull'elaborazione
     """
     print(f"[🤖] Elaborazione dell'immagine: {img_file}")
 
-    # Crea una directory per l'output di questa specifica immagine
-    img_basename = os.path.basename(img_file).split(".")[0]
-    img_output_dir = os.path.join(output_dir, img_basename)
-    os.makedirs(img_output_dir, exist_ok=True)
-
     # Carica l'immagine
     original_img = cv2.imread(img_file)
     if original_img is None:
         raise Exception(f"Impossibile leggere l'immagine {img_file}")
 
+    img_basename = os.path.basename(img_file).split(".")[0]
+    stage_done = None
+    if on_stage is not None:
+        stage_done = lambda record: on_stage(dict(record, page=1))
+    result = process_image_array_with_details(
+        original_img,
+        img_basename,
+        output_dir,
+        on_stage=stage_done,
+        artifact_level=artifact_level,
+    )
+    result["image_path"] = img_file
+    return result
+
+
+def process_image_array_with_details(
+    original_img, img_basename, output_dir, on_stage=None, artifact_level=artifact_level
+):
+    """
+    Processa un'immagine già caricata in memoria e restituisce informazioni dettagliate
+
+    Args:
+        original_img: Immagine a colori (BGR) o in scala di grigi; non viene modificata
+        img_basename: Nome della sottodirectory di output dell'immagine
+        output_dir: Directory di output
+        on_stage: Funzione opzionale chiamata con il record (stage, duration e
+            risultati parziali) di ogni fase appena completata
+        artifact_level: "none", "summary" (risultati del rilevamento e pagina
+            binarizzata, immagini di debug disegnate alla prima richiesta) o
+            "debug" (tutte le immagini scritte subito)
+
+    Returns:
+        Dict con informazioni sull'elaborazione; image_path è la copia
+        dell'immagine originale salvata nella directory di output (solo con
+        artifact_level "debug") e stages riporta la durata e i risultati
+        parziali di ogni fase
+    """
+    stages = []
+    stage_start = time.perf_counter()
+
+    def stage_done(stage, **partial_result):
+        nonlocal stage_start
+        now = time.perf_counter()
+        record = {"stage": stage, "duration": round(now - stage_start, 3)}
+        record.update(partial_result)
+        stages.append(record)
+        if on_stage is not None:
+            on_stage(record)
+        stage_start = now
+
+    # Crea una directory per l'output di questa specifica immagine
+    img_output_dir = os.path.join(output_dir, img_basename)
+    if artifact_level != "none":
+        os.makedirs(img_output_dir, exist_ok=True)
+
+    # Le immagini JPEG vengono codificate durante l'elaborazione solo in debug
+    debug = artifact_level == "debug"
+
     # Salva l'immagine originale
-    cv2.imwrite(os.path.join(img_output_dir, "original.jpg"), original_img)
+    original_path = None
+    if debug:
+        original_path = os.path.join(img_output_dir, "original.jpg")
+        cv2.imwrite(original_path, original_img)
 
-    # Converti in scala di grigi
+    # Converti in scala di grigi (il denoising produce comunque una nuova immagine)
     if len(original_img.shape) == 3:
         img = cv2.cvtColor(original_img, cv2.COLOR_BGR2GRAY)
     else:
-        img = original_img.copy()
+        img = original_img
 
     # Rimozione del rumore
     img = cv2.fastNlMeansDenoising(img, None, 10, 7, 21)
-    cv2.imwrite(os.path.join(img_output_dir, "denoised.jpg"), img)
+    if debug:
+        cv2.imwrite(os.path.join(img_output_dir, "denoised.jpg"), img)
+    stage_done("denoise")
 
     # Sogliatura di Otsu
     retval, img = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    cv2.imwrite(os.path.join(img_output_dir, "binarized.jpg"), img)
+    if debug:
+        cv2.imwrite(os.path.join(img_output_dir, "binarized.jpg"), img)
+    stage_done("binarize", threshold_value=retval)
 
     # Estrazione parametri di riferimento
     line_width, line_spacing = get_ref_lengths(img)
+    stage_done("ref_lengths", line_width=line_width, line_spacing=line_spacing)
 
     # Rilevamento linee del pentagramma
     all_staffline_vertical_indices = find_staffline_rows(img, line_width, line_spacing)
@@ -527,35 +1055,50 @@ def process_single_image_with_details(img_file, output_dir):
     )
 
     # Visualizzazione pentagrammi rilevati
-    staff_boxes_img = img.copy()
-    staff_boxes_img = cv2.cvtColor(staff_boxes_img, cv2.COLOR_GRAY2RGB)
-    red = (0, 0, 255)
-    box_thickness = 2
-
-    for staff in staffs:
-        box = staff.getBox()
-        box.draw(staff_boxes_img, red, box_thickness)
-        x = int(box.getCorner()[0] + (box.getWidth() // 2))
-        y = int(box.getCorner()[1] + box.getHeight() + 35)
-        cv2.putText(staff_boxes_img, "Staff", (x, y), cv2.FONT_HERSHEY_DUPLEX, 0.9, red)
-
-    cv2.imwrite(os.path.join(img_output_dir, "detected_staffs.jpg"), staff_boxes_img)
+    if debug:
+        staff_boxes_img = draw_detected_staffs(img, [staff.getBox() for staff in staffs])
+        cv2.imwrite(os.path.join(img_output_dir, "detected_staffs.jpg"), staff_boxes_img)
+    stage_done("staff_detection", staffs_count=len(staffs))
 
     # Rilevamento chiavi e segni di tempo
-    staffs, staff_imgs_color = find_clef_time_signature(staffs)
+    staffs = find_clef_time_signature(staffs)
+    stage_done(
+        "clef_time",
+        clefs=[staff.getClef() for staff in staffs],
+        time_signatures=[staff.getTimeSignature() for staff in staffs],
+    )
 
     # Rilevamento primitive musicali
-    staffs, staff_imgs_color = find_primitive(staffs, staff_imgs_color)
+    staffs = find_primitive(staffs)
+    stage_done(
+        "primitives",
+        primitives_count=sum(
+            len(bar.getPrimitives()) for staff in staffs for bar in staff.getBars()
+        ),
+    )
+
+    # Disegna e salva le immagini con le primitive (il rilevamento non disegna)
+    if debug:
+        for i in range(len(staffs)):
+            staff_img_color = draw_staff_annotations(staffs[i])
+            cv2.imwrite(
+                os.path.join(img_output_dir, f"staff_{i+1}_primitives.jpg"), staff_img_color
+            )
 
-    # Salva immagini con primitive
-    for i in range(len(staffs)):
-        staff_img_color = staff_imgs_color[i]
-        cv2.imwrite(
-            os.path.join(img_output_dir, f"staff_{i+1}_primitives.jpg"), staff_img_color
+    # Risultati del rilevamento e pagina binarizzata (senza codifica JPEG): le
+    # immagini di debug mancanti vengono disegnate da questi alla prima richiesta
+    if artifact_level != "none":
+        save_detections(
+            img_output_dir,
+            img,
+            staffs,
+            line_width=line_width,
+            line_spacing=line_spacing,
+            threshold_value=retval,
         )
 
     return {
-        "image_path": img_file,
+        "image_path": original_path,
         "output_dir": img_output_dir,
         "staffs_count": len(staffs),
         "line_width": line_width,
@@ -568,6 +1111,7 @@ def process_single_image_with_details(img_file, output_dir):
             "clef_time_signature_detection",
             "primitive_detection",
         ],
+        "stages": stages,
     }
 
 
@@ -576,7 +1120,10 @@ def collect_output_files(output_dir):
     output_files = []
 
     for root, dirs, files in os.walk(output_dir):
-        for file in files:
+        # Ordine stabile: le pagine e i pentagrammi compaiono in sequenza (le
+        # directory nascoste, come quella delle miniature, non sono risultati)
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for file in sorted(files):
             if file.endswith((".jpg", ".jpeg", ".png", ".json")):
                 file_path = os.path.join(root, file)
                 rel_path = os.path.relpath(file_path, output_dir)
@@ -599,13 +1146,14 @@ def collect_output_files(output_dir):
 @app.route("/process/<job_id>", methods=["GET"])
 def get_process_result(job_id):
     """
-    Ottieni il risultato di un processamento
+    Ottieni lo stato o il risultato di un processamento
 
     Args:
         job_id: ID del lavoro di processamento
 
     Returns:
-        JSON con i risultati del processamento
+        JSON con i metadati del lavoro: status (queued, processing, completed o
+        failed), progress durante l'elaborazione e result al termine
     """
     try:
         job_output_dir = os.path.join(OUTPUT_FOLDER, job_id)
@@ -617,23 +1165,18 @@ def get_process_result(job_id):
         with open(metadata_path, "r") as f:
             metadata = json.load(f)
 
-        # Se richiesto, includi le immagini codificate in base64
+        # Per i lavori in attesa riporta la posizione in coda
+        if metadata["status"] == "queued":
+            metadata["queue_position"] = get_queue_position(job_id)
+
+        # Se richiesto, includi l'elenco degli artefatti: URL, dimensioni e
+        # miniature, non il contenuto (che si scarica da /jobs/<job_id>/artifacts)
         include_images = request.args.get("include_images", "false").lower() == "true"
 
         if include_images and metadata["status"] == "completed":
-            # Aggiungi le immagini principali codificate in base64
-            images = {}
-
-            for root, dirs, files in os.walk(job_output_dir):
-                for file in files:
-                    if file.endswith((".jpg", ".jpeg", ".png")):
-                        file_path = os.path.join(root, file)
-                        rel_path = os.path.relpath(file_path, job_output_dir)
-                        encoded_img = encode_image_to_base64(file_path)
-                        if encoded_img:
-                            images[rel_path] = encoded_img
-
-            metadata["images"] = images
+            metadata["artifacts"] = list_artifacts(
+                job_output_dir, f"/jobs/{job_id}/artifacts"
+            )
 
         return jsonify(metadata)
 
@@ -641,48 +1184,152 @@ def get_process_result(job_id):
         return jsonify({"error": f"Errore nel recupero del risultato: {str(e)}"}), 500
 
 
+@app.route("/process/<job_id>/events", methods=["GET"])
+def stream_process_events(job_id):
+    """
+    Stream degli eventi di avanzamento di un lavoro
+
+    Gli eventi vengono inviati appena pubblicati: queued, processing, stage
+    (fase completata di una pagina con durata e risultati parziali), page
+    (pagina completata) e infine completed, failed o cancelled, dopo cui lo
+    stream si chiude. Ogni evento riporta id ed elapsed (secondi dall'inizio
+    dell'elaborazione). Per un lavoro già terminato di cui non restano eventi
+    in memoria viene inviato solo lo stato finale.
+
+    Query string:
+        format: sse (default, text/event-stream) o ndjson (un oggetto JSON per riga)
+        after: Invia solo gli eventi con id maggiore (per SSE anche l'header
+            Last-Event-ID, inviato dal browser quando si ricollega)
+    """
+    job_output_dir = os.path.join(OUTPUT_FOLDER, job_id)
+    metadata_path = os.path.join(job_output_dir, "metadata.json")
+    if not os.path.exists(metadata_path):
+        return jsonify({"error": "Lavoro non trovato"}), 404
+
+    stream_format = request.args.get("format", "sse").lower()
+    if stream_format not in ("sse", "ndjson"):
+        return jsonify({"error": "format deve essere sse o ndjson"}), 400
+    try:
+        after = int(request.headers.get("Last-Event-ID") or request.args.get("after", 0))
+    except ValueError:
+        return jsonify({"error": "after deve essere un numero intero"}), 400
+
+    events = job_events.get(job_id)
+    if events is not None:
+        source = events.iterEvents(after)
+    else:
+        with open(metadata_path, "r") as f:
+            metadata = json.load(f)
+        final = {"id": 1, "event": metadata["status"], "job_id": job_id, "elapsed": 0.0}
+        if metadata["status"] == "completed":
+            final["staffs_detected"] = metadata.get("result", {}).get("staffs_detected", 0)
+        elif metadata["status"] == "failed":
+            final["error"] = metadata.get("error")
+        source = iter([final] if after < 1 else [])
+
+    def generate():
+        for event in source:
+            if stream_format == "ndjson":
+                if event is None:
+                    event = {"event": "heartbeat", "job_id": job_id}
+                yield json.dumps(event) + "\n"
+            elif event is None:
+                yield ": heartbeat\n\n"
+            else:
+                yield f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+    mimetype = "application/x-ndjson" if stream_format == "ndjson" else "text/event-stream"
+    return Response(
+        generate(),
+        mimetype=mimetype,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/jobs", methods=["GET"])
 def list_jobs():
-    """Lista tutti i lavori di processamento"""
+    """
+    Lista i lavori di processamento dall'indice dei lavori
+
+    Query string:
+        status: Stati ammessi separati da virgole (ad esempio queued,processing)
+        uploaded_after, uploaded_before: Limiti ISO 8601 (inclusi) sulla data di caricamento
+        sort: uploaded_at (default), completed_at, filename o staffs_detected
+        order: desc (default) o asc
+        limit: Lavori per pagina (default 50, massimo 500)
+        cursor: Valore di next_cursor della pagina precedente
+    """
     try:
-        jobs = []
-
-        if os.path.exists(OUTPUT_FOLDER):
-            for job_dir in os.listdir(OUTPUT_FOLDER):
-                job_path = os.path.join(OUTPUT_FOLDER, job_dir)
-                metadata_path = os.path.join(job_path, "metadata.json")
-
-                if os.path.isdir(job_path) and os.path.exists(metadata_path):
-                    try:
-                        with open(metadata_path, "r") as f:
-                            metadata = json.load(f)
-
-                        # Includi solo informazioni di base
-                        job_summary = {
-                            "job_id": metadata.get("job_id"),
-                            "filename": metadata.get("filename"),
-                            "status": metadata.get("status"),
-                            "uploaded_at": metadata.get("uploaded_at"),
-                            "completed_at": metadata.get("completed_at"),
-                            "staffs_detected": metadata.get("result", {}).get(
-                                "staffs_detected", 0
-                            ),
-                        }
-                        jobs.append(job_summary)
-                    except Exception as e:
-                        print(f"Errore nel leggere i metadati per {job_dir}: {e}")
+        statuses = [s for s in request.args.get("status", "").split(",") if s]
+        sort = request.args.get("sort", "uploaded_at")
+        order = request.args.get("order", "desc").lower()
+        if sort not in sort_expressions:
+            return jsonify({"error": f"Ordinamento non supportato: {sort}"}), 400
+        if order not in ("asc", "desc"):
+            return jsonify({"error": "order deve essere asc o desc"}), 400
+        try:
+            limit = int(request.args.get("limit", jobs_page_size))
+        except ValueError:
+            return jsonify({"error": "limit deve essere un numero intero"}), 400
+
+        try:
+            jobs, total, next_cursor = job_index.query(
+                statuses=statuses,
+                uploaded_after=request.args.get("uploaded_after"),
+                uploaded_before=request.args.get("uploaded_before"),
+                sort=sort,
+                descending=order == "desc",
+                limit=limit,
+                cursor=request.args.get("cursor"),
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-        return jsonify({"jobs": jobs, "total": len(jobs)})
+        return jsonify({"jobs": jobs, "total": total, "next_cursor": next_cursor})
 
     except Exception as e:
         return jsonify({"error": f"Errore nel recupero dei lavori: {str(e)}"}), 500
 
 
+def archive_files(job_output_dir):
+    """
+    File dell'archivio di un lavoro: tutti i file della directory di output in
+    ordine stabile, senza file e directory nascosti (miniature, manifest)
+    """
+    files = []
+    for root, dirs, filenames in os.walk(job_output_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for filename in sorted(filenames):
+            if filename.startswith("."):
+                continue
+            file_path = os.path.join(root, filename)
+            files.append((os.path.relpath(file_path, job_output_dir), file_path))
+    return files
+
+
+def write_archive_manifest(job_output_dir):
+    """
+    Calcola CRC e dimensioni dei file di un lavoro completato e li salva nel
+    manifest, così /jobs/<job_id>/download non deve leggere i file prima di
+    iniziare a trasmettere
+    """
+    try:
+        write_manifest(job_output_dir, archive_files(job_output_dir))
+    except OSError as e:
+        print(f"[ERRORE] Impossibile salvare il manifest dell'archivio: {e}")
+
+
 @app.route("/jobs/<job_id>/download", methods=["GET"])
 def download_job_results(job_id):
     """
     Scarica tutti i risultati di un lavoro come file ZIP
 
+    L'archivio viene generato al volo durante la trasmissione, senza file
+    temporanei: le immagini (già compresse) vengono memorizzate così come sono,
+    gli altri file compressi. La dimensione è nota in anticipo, quindi la
+    risposta supporta le richieste Range (con If-Range) per riprendere un
+    download interrotto.
+
     Args:
         job_id: ID del lavoro
 
@@ -702,31 +1349,137 @@ def download_job_results(job_id):
         if metadata["status"] != "completed":
             return jsonify({"error": "Il lavoro non è ancora completato"}), 400
 
-        # Crea un file ZIP temporaneo
-        temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix=".zip")
-        temp_zip.close()
-
-        with zipfile.ZipFile(temp_zip.name, "w", zipfile.ZIP_DEFLATED) as zipf:
-            # Aggiungi tutti i file della directory di output
-            for root, dirs, files in os.walk(job_output_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, job_output_dir)
-                    zipf.write(file_path, arcname)
+        # Le immagini di debug non ancora prodotte vengono disegnate prima di
+        # preparare l'archivio (solo al primo download)
+        render_missing_images(job_output_dir)
+
+        # CRC e dimensioni vengono dal manifest scritto al termine del lavoro:
+        # vanno calcolati solo per i file nuovi o cambiati (ad esempio le
+        # immagini appena disegnate), poi il manifest viene aggiornato
+        manifest = ZipManifest(job_output_dir)
+        archive = ZipStream(archive_files(job_output_dir), manifest)
+        manifest.save()
+
+        # L'ETag cambia se cambia uno qualsiasi dei file: un download ripreso con
+        # If-Range su un archivio diverso riceve l'archivio intero
+        signature = hashlib.sha256()
+        for entry in archive.entries:
+            signature.update(entry.name)
+            signature.update(f":{entry.size}:{entry.mtime}\n".encode())
+        etag = f'"{signature.hexdigest()[:32]}"'
 
         filename = f"music_processing_results_{job_id}.zip"
+        headers = {
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Accept-Ranges": "bytes",
+            "ETag": etag,
+        }
 
-        return send_file(
-            temp_zip.name,
-            as_attachment=True,
-            download_name=filename,
+        size = archive.getSize()
+        start, stop, status = 0, size, 200
+        byte_range = request.range
+        if_range = request.headers.get("If-Range")
+        if byte_range is not None and len(byte_range.ranges) == 1 and if_range in (None, etag):
+            bounds = byte_range.range_for_length(size)
+            if bounds is None:
+                headers["Content-Range"] = f"bytes */{size}"
+                return Response(status=416, headers=headers)
+            start, stop = bounds
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        headers["Content-Length"] = str(stop - start)
+
+        return Response(
+            archive.iterBytes(start, stop),
+            status=status,
+            headers=headers,
             mimetype="application/zip",
+            direct_passthrough=True,
         )
 
     except Exception as e:
         return jsonify({"error": f"Errore nel download: {str(e)}"}), 500
 
 
+@app.route("/jobs/<job_id>/artifacts", methods=["GET"])
+def list_job_artifacts(job_id):
+    """
+    Elenca gli artefatti di un lavoro completato
+
+    Args:
+        job_id: ID del lavoro
+
+    Returns:
+        JSON con URL, dimensioni e miniature di ogni artefatto
+    """
+    try:
+        job_output_dir = os.path.join(OUTPUT_FOLDER, job_id)
+        metadata_path = os.path.join(job_output_dir, "metadata.json")
+
+        if not os.path.exists(metadata_path):
+            return jsonify({"error": "Lavoro non trovato"}), 404
+
+        with open(metadata_path, "r") as f:
+            metadata = json.load(f)
+
+        if metadata["status"] != "completed":
+            return jsonify({"error": "Il lavoro non è ancora completato"}), 400
+
+        artifacts = list_artifacts(job_output_dir, f"/jobs/{job_id}/artifacts")
+        return jsonify({"job_id": job_id, "artifacts": artifacts, "total": len(artifacts)})
+
+    except Exception as e:
+        return jsonify({"error": f"Errore nel recupero degli artefatti: {str(e)}"}), 500
+
+
+@app.route("/jobs/<job_id>/artifacts/<path:artifact>", methods=["GET"])
+def get_job_artifact(job_id, artifact):
+    """
+    Restituisce un artefatto di un lavoro come file binario
+
+    La risposta riporta ETag e Last-Modified e risponde 304 alle richieste
+    condizionali (If-None-Match, If-Modified-Since) se il file non è cambiato.
+
+    Args:
+        job_id: ID del lavoro
+        artifact: Percorso dell'artefatto nella directory del lavoro
+
+    Le immagini di debug non ancora prodotte (livello summary) vengono
+    disegnate dai risultati del rilevamento alla prima richiesta.
+
+    Query string:
+        size: Miniatura al posto dell'originale (thumb o preview), generata
+            alla prima richiesta
+    """
+    try:
+        job_output_dir = safe_join(OUTPUT_FOLDER, job_id)
+        file_path = safe_join(job_output_dir, artifact) if job_output_dir else None
+        if file_path is None or any(part.startswith(".") for part in artifact.split("/")):
+            return jsonify({"error": "Artefatto non trovato"}), 404
+        if not os.path.isfile(file_path):
+            file_path = render_image(os.path.dirname(file_path), os.path.basename(file_path))
+            if file_path is None:
+                return jsonify({"error": "Artefatto non trovato"}), 404
+
+        size = request.args.get("size")
+        if size is not None:
+            if size not in thumbnail_sizes:
+                return jsonify({"error": f"Formato di miniatura non supportato: {size}"}), 400
+            if not artifact.lower().endswith((".jpg", ".jpeg", ".png")):
+                return jsonify({"error": "Le miniature sono disponibili solo per le immagini"}), 400
+            file_path = get_thumbnail(job_output_dir, os.path.relpath(file_path, job_output_dir), size)
+
+        return send_file(
+            os.path.abspath(file_path),
+            conditional=True,
+            etag=True,
+            max_age=ARTIFACT_MAX_AGE,
+        )
+
+    except Exception as e:
+        return jsonify({"error": f"Errore nel recupero dell'artefatto: {str(e)}"}), 500
+
+
 @app.route("/jobs/<job_id>/delete", methods=["DELETE"])
 def delete_job(job_id):
     """
@@ -741,8 +1494,29 @@ def delete_job(job_id):
         if not os.path.exists(job_output_dir):
             return jsonify({"error": "Lavoro non trovato"}), 404
 
+        # Un lavoro in coda viene tolto dalla coda; uno in elaborazione non può
+        # essere eliminato finché la pipeline sta scrivendo i suoi file
+        with jobs_lock:
+            if job_id in queued_jobs:
+                queued_jobs.remove(job_id)
+                job_slots.release()
+                events = job_events.get(job_id)
+                if events is not None:
+                    events.publish("cancelled")
+            else:
+                metadata_path = os.path.join(job_output_dir, "metadata.json")
+                if os.path.exists(metadata_path):
+                    with open(metadata_path, "r") as f:
+                        if json.load(f).get("status") == "processing":
+                            return (
+                                jsonify({"error": "Il lavoro è in elaborazione"}),
+                                409,
+                            )
+
         # Elimina la directory e tutti i suoi contenuti
         shutil.rmtree(job_output_dir)
+        job_index.remove(job_id)
+        job_events.remove(job_id)
 
         # Elimina anche il file caricato se esiste
         for filename in os.listdir(UPLOAD_FOLDER):
@@ -784,35 +1558,73 @@ def api_docs():
                 },
                 "/upload": {
                     "method": "POST",
-                    "description": "Carica un file (PDF o immagine) e avvia il processamento",
-                    "parameters": {"file": "File da caricare (multipart/form-data)"},
+                    "description": "Carica un file (PDF o immagine) e lo mette in coda per il processamento in background",
+                    "parameters": {
+                        "file": "File da caricare (multipart/form-data)",
+                        "artifacts": f"none, summary o debug - livello degli artefatti (form o query parameter, default {artifact_level})",
+                    },
                     "accepted_formats": list(ALLOWED_EXTENSIONS),
                     "max_file_size": f"{MAX_FILE_SIZE // (1024*1024)}MB",
-                    "returns": "JSON con job_id per tracciare il processamento",
+                    "returns": "202 con job_id, status 'queued' e status_url; 200 con status 'completed' e cache_hit se lo stesso file è già stato elaborato; 503 se la coda è piena",
                 },
                 "/process/<job_id>": {
                     "method": "GET",
-                    "description": "Ottiene i risultati di un processamento specifico",
+                    "description": "Ottiene lo stato (queued, processing, completed, failed), l'avanzamento (progress) o i risultati di un processamento",
                     "parameters": {
                         "job_id": "ID del lavoro (path parameter)",
-                        "include_images": "true/false - include immagini in base64 (query parameter)",
+                        "include_images": "true/false - include l'elenco degli artefatti con URL, dimensioni e miniature (query parameter)",
                     },
                     "returns": "JSON con metadati e risultati del processamento",
                 },
+                "/process/<job_id>/events": {
+                    "method": "GET",
+                    "description": "Stream degli eventi di avanzamento (queued, processing, stage, page, completed/failed/cancelled) con tempo trascorso e risultati parziali",
+                    "parameters": {
+                        "job_id": "ID del lavoro (path parameter)",
+                        "format": "sse (default) o ndjson (query parameter)",
+                        "after": "Invia solo gli eventi con id maggiore; in SSE anche l'header Last-Event-ID (query parameter)",
+                    },
+                    "returns": "text/event-stream o application/x-ndjson, chiuso al termine del lavoro",
+                },
                 "/jobs": {
                     "method": "GET",
-                    "description": "Lista tutti i lavori di processamento",
-                    "returns": "JSON con array di tutti i lavori e contatore totale",
+                    "description": "Lista i lavori di processamento dall'indice dei lavori, con filtri, ordinamento e paginazione a cursore",
+                    "parameters": {
+                        "status": "Stati ammessi separati da virgole (query parameter)",
+                        "uploaded_after": "Data ISO 8601 minima di caricamento (query parameter)",
+                        "uploaded_before": "Data ISO 8601 massima di caricamento (query parameter)",
+                        "sort": "uploaded_at, completed_at, filename o staffs_detected (query parameter)",
+                        "order": "asc/desc (query parameter, default desc)",
+                        "limit": "Lavori per pagina, massimo 500 (query parameter, default 50)",
+                        "cursor": "next_cursor della pagina precedente (query parameter)",
+                    },
+                    "returns": "JSON con la pagina di lavori, il totale dei lavori filtrati e next_cursor (null sull'ultima pagina)",
                 },
                 "/jobs/<job_id>/download": {
                     "method": "GET",
-                    "description": "Scarica tutti i risultati di un lavoro come file ZIP",
+                    "description": "Scarica tutti i risultati di un lavoro come file ZIP generato al volo (supporta Range e If-Range per riprendere il download)",
                     "parameters": {"job_id": "ID del lavoro (path parameter)"},
                     "returns": "File ZIP con tutti i file generati",
                 },
+                "/jobs/<job_id>/artifacts": {
+                    "method": "GET",
+                    "description": "Elenca gli artefatti di un lavoro completato",
+                    "parameters": {"job_id": "ID del lavoro (path parameter)"},
+                    "returns": "JSON con URL, dimensioni in pixel, byte e miniature di ogni artefatto",
+                },
+                "/jobs/<job_id>/artifacts/<path>": {
+                    "method": "GET",
+                    "description": "Scarica un artefatto come file binario, con ETag/Last-Modified e richieste condizionali (304)",
+                    "parameters": {
+                        "job_id": "ID del lavoro (path parameter)",
+                        "path": "Percorso dell'artefatto (path parameter)",
+                        "size": "thumb (256 px) o preview (1024 px) - miniatura JPEG generata dal server (query parameter)",
+                    },
+                    "returns": "Il file dell'artefatto o la sua miniatura",
+                },
                 "/jobs/<job_id>/delete": {
                     "method": "DELETE",
-                    "description": "Elimina un lavoro e tutti i suoi file",
+                    "description": "Elimina un lavoro e tutti i suoi file (un lavoro in coda viene annullato, uno in elaborazione restituisce 409)",
                     "parameters": {"job_id": "ID del lavoro (path parameter)"},
                     "returns": "JSON con messaggio di conferma",
                 },
@@ -890,4 +1702,9 @@ if __name__ == "__main__":
     print("  - Download risultati in formato ZIP")
     print("  - Gestione lavori multipli")
 
+    # Con il reloader di Flask il modulo viene eseguito due volte: i lavori
+    # vengono ripresi solo nel processo che serve le richieste
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        recover_jobs()
+
     app.run(debug=debug, host="0.0.0.0", port=port)
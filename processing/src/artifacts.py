@@ -0,0 +1,156 @@
+"""
+Artefatti dei lavori del server: elenco con dimensioni e miniature.
+
+Le immagini prodotte dalla pipeline vengono servite come file binari; il
+client riceve solo il loro elenco (percorso, dimensioni in pixel, byte) e
+scarica le immagini, o le miniature generate dal server, che mostra davvero.
+"""
+import os
+import threading
+
+import cv2
+from PIL import Image
+
+from src.overlays import lazy_images
+
+# Formati delle miniature: lato maggiore in pixel (le immagini più piccole non
+# vengono ingrandite)
+thumbnail_sizes = {"thumb": 256, "preview": 1024}
+thumbnail_quality = 80
+
+# Directory (dentro la directory del lavoro) delle miniature generate; come
+# tutte le directory nascoste non compare tra gli artefatti
+thumbnails_dirname = ".thumbnails"
+
+image_extensions = (".jpg", ".jpeg", ".png")
+artifact_extensions = image_extensions + (".json",)
+
+# File del lavoro che non sono risultati della pipeline
+excluded_artifacts = ("metadata.json",)
+
+# Fattori di riduzione applicati durante la decodifica JPEG (scalatura DCT)
+reduced_read_flags = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def iter_artifacts(job_output_dir):
+    """Percorsi relativi degli artefatti di un lavoro, in ordine stabile"""
+    for root, dirs, files in os.walk(job_output_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for filename in sorted(files):
+            if root == job_output_dir and filename in excluded_artifacts:
+                continue
+            if filename.lower().endswith(artifact_extensions):
+                yield os.path.relpath(os.path.join(root, filename), job_output_dir)
+
+
+def image_dimensions(path):
+    """Larghezza e altezza di un'immagine, lette dalla sola intestazione del file"""
+    with Image.open(path) as img:
+        return img.size
+
+
+def thumbnail_dimensions(width, height, max_side):
+    scale = min(1.0, max_side / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def list_artifacts(job_output_dir, base_url):
+    """
+    Elenco degli artefatti di un lavoro
+
+    Args:
+        job_output_dir: Directory del lavoro
+        base_url: URL sotto cui vengono serviti gli artefatti del lavoro
+
+    Returns:
+        Lista di dict con path, url, size e type; le immagini riportano anche
+        width, height e le miniature disponibili (url e dimensioni). Le
+        immagini di debug non ancora disegnate (livello summary) compaiono con
+        size None e vengono prodotte alla prima richiesta
+    """
+    # Percorso relativo -> dimensioni (None = da leggere dal file)
+    entries = {rel_path: None for rel_path in iter_artifacts(job_output_dir)}
+    for root, dirs, files in os.walk(job_output_dir):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name, dimensions in lazy_images(root).items():
+            entries[os.path.relpath(os.path.join(root, name), job_output_dir)] = dimensions
+
+    artifacts = []
+    for rel_path in sorted(entries):
+        file_path = os.path.join(job_output_dir, rel_path)
+        url_path = rel_path.replace(os.sep, "/")
+        artifact = {
+            "path": url_path,
+            "url": f"{base_url}/{url_path}",
+            "size": os.path.getsize(file_path) if os.path.exists(file_path) else None,
+            "type": "image" if rel_path.lower().endswith(image_extensions) else "data",
+        }
+        if artifact["type"] == "image":
+            try:
+                width, height = entries[rel_path] or image_dimensions(file_path)
+            except Exception as e:
+                print(f"[ERRORE] Impossibile leggere le dimensioni di {file_path}: {e}")
+            else:
+                artifact["width"] = width
+                artifact["height"] = height
+                artifact["thumbnails"] = {}
+                for name, max_side in thumbnail_sizes.items():
+                    thumb_width, thumb_height = thumbnail_dimensions(width, height, max_side)
+                    artifact["thumbnails"][name] = {
+                        "url": f"{artifact['url']}?size={name}",
+                        "width": thumb_width,
+                        "height": thumb_height,
+                    }
+        artifacts.append(artifact)
+    return artifacts
+
+
+def render_thumbnail(src_path, dst_path, max_side):
+    """
+    Salva in dst_path una miniatura JPEG di src_path con lato maggiore max_side
+
+    I JPEG vengono decodificati direttamente a 1/2, 1/4 o 1/8 della risoluzione
+    quando la miniatura è abbastanza piccola, senza decodificare l'immagine intera.
+    """
+    width, height = image_dimensions(src_path)
+    target = thumbnail_dimensions(width, height, max_side)
+
+    flag = cv2.IMREAD_COLOR
+    if src_path.lower().endswith((".jpg", ".jpeg")):
+        for factor in sorted(reduced_read_flags, reverse=True):
+            if max(width, height) // factor >= max_side:
+                flag = reduced_read_flags[factor]
+                break
+    img = cv2.imread(src_path, flag)
+    if img is None:
+        raise IOError(f"Impossibile leggere l'immagine {src_path}")
+    if (img.shape[1], img.shape[0]) != target:
+        img = cv2.resize(img, target, interpolation=cv2.INTER_AREA)
+
+    # Scrittura atomica: richieste concorrenti della stessa miniatura non
+    # leggono mai un file a metà
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    tmp_path = f"{dst_path}.tmp-{threading.get_ident()}.jpg"
+    cv2.imwrite(tmp_path, img, [cv2.IMWRITE_JPEG_QUALITY, thumbnail_quality])
+    os.replace(tmp_path, dst_path)
+
+
+def get_thumbnail(job_output_dir, rel_path, size):
+    """
+    Percorso della miniatura size dell'artefatto rel_path, generata alla prima
+    richiesta (o quando l'artefatto è più recente della miniatura)
+    """
+    src_path = os.path.join(job_output_dir, rel_path)
+    dst_path = os.path.join(
+        job_output_dir, thumbnails_dirname, size, os.path.splitext(rel_path)[0] + ".jpg"
+    )
+    if (
+        not os.path.exists(dst_path)
+        or os.path.getmtime(dst_path) < os.path.getmtime(src_path)
+    ):
+        render_thumbnail(src_path, dst_path, thumbnail_sizes[size])
+    return dst_path
@@ -1,9 +1,21 @@
 """
 Modulo che definisce la classe BoundingBox per la gestione dei riquadri di delimitazione.
 Utilizzato per identificare e manipolare elementi nelle partiture musicali.
+
+I riquadri trovati dalla ricerca dei template sono migliaia per pentagramma:
+vengono conservati in un BoxArray (una colonna NumPy per coordinata e
+punteggio) su cui sovrapposizione e distanza sono vettoriali. Chi usa
+i singoli riquadri riceve dei BoxView, che leggono le colonne del BoxArray e
+hanno la stessa interfaccia di BoundingBox.
 """
+import bisect
 import cv2
 import math
+import numpy as np
+
+# Fino a questo numero di riquadri l'unione riordina tutta la lista a ogni passo, come
+# l'originale: il costo fisso della griglia e delle operazioni vettoriali supererebbe il risparmio
+merge_scalar_max_boxes = 64
 
 class BoundingBox(object):
     """
@@ -11,7 +23,9 @@ class BoundingBox(object):
     Utilizzata per racchiudere elementi come note, simboli musicali, o altri componenti
     della partitura.
     """
-    def __init__(self, x, y, w, h):
+    __slots__ = ("x", "y", "w", "h", "score")
+
+    def __init__(self, x, y, w, h, score=None):
         """
         Inizializza un nuovo box di delimitazione.
         
@@ -20,13 +34,23 @@ class BoundingBox(object):
             y: Coordinata y dell'angolo superiore sinistro
             w: Larghezza del box
             h: Altezza del box
+            score: Punteggio di corrispondenza del template (opzionale)
         """
         self.x = x;
         self.y = y;
         self.w = w;
         self.h = h;
-        self.middle = self.x + self.w/2, self.y + self.h/2  # Punto centrale del box
-        self.area = self.w * self.h  # Area del box
+        self.score = score
+
+    @property
+    def middle(self):
+        """Punto centrale del box"""
+        return self.x + self.w/2, self.y + self.h/2
+
+    @property
+    def area(self):
+        """Area del box"""
+        return self.w * self.h
 
     def overlap(self, other):
         """
@@ -53,8 +77,10 @@ class BoundingBox(object):
         Returns:
             Distanza euclidea tra i centri
         """
-        dx = self.middle[0] - other.middle[0]
-        dy = self.middle[1] - other.middle[1]
+        middle = self.middle
+        other_middle = other.middle
+        dx = middle[0] - other_middle[0]
+        dy = middle[1] - other_middle[1]
         return math.sqrt(dx*dx + dy*dy)
 
     def merge(self, other):
@@ -66,12 +92,14 @@ class BoundingBox(object):
             
         Returns:
             Nuovo oggetto BoundingBox che contiene entrambi i box originali
+            (con il punteggio migliore tra i due)
         """
         x = min(self.x, other.x)
         y = min(self.y, other.y)
         w = max(self.x + self.w, other.x + other.w) - x
         h = max(self.y + self.h, other.y + other.h) - y
-        return BoundingBox(x, y, w, h)
+        scores = [score for score in (self.score, other.score) if score is not None]
+        return BoundingBox(x, y, w, h, max(scores) if scores else None)
 
     def draw(self, img, color, thickness):
         """
@@ -121,3 +149,421 @@ class BoundingBox(object):
             Tupla (x, y) del centro del box
         """
         return self.middle
+
+    def getScore(self):
+        """
+        Restituisce il punteggio di corrispondenza del template.
+        
+        Returns:
+            Punteggio (None se il box non deriva da una corrispondenza)
+        """
+        return self.score
+
+
+class BoxView(BoundingBox):
+    """
+    Riquadro index di un BoxArray: legge le colonne dell'array, senza copiarle,
+    e ha la stessa interfaccia di BoundingBox
+    """
+    __slots__ = ("boxes", "index")
+
+    def __init__(self, boxes, index):
+        self.boxes = boxes
+        self.index = index
+
+    @property
+    def x(self):
+        return float(self.boxes.x[self.index])
+
+    @property
+    def y(self):
+        return float(self.boxes.y[self.index])
+
+    @property
+    def w(self):
+        return float(self.boxes.w[self.index])
+
+    @property
+    def h(self):
+        return float(self.boxes.h[self.index])
+
+    @property
+    def score(self):
+        score = float(self.boxes.score[self.index])
+        return None if math.isnan(score) else score
+
+
+def box_columns(other):
+    """
+    Colonne x, y, w, h di un riquadro (scalari) o di un BoxArray (righe), da
+    combinare con le colonne di un altro BoxArray
+    """
+    if isinstance(other, BoxArray):
+        return other.x[np.newaxis, :], other.y[np.newaxis, :], other.w[np.newaxis, :], other.h[np.newaxis, :]
+    return other.x, other.y, other.w, other.h
+
+
+class BoxArray(object):
+    """
+    Insieme di riquadri memorizzato per colonne (x, y, w, h, score), una riga
+    per riquadro; un punteggio NaN indica un riquadro senza punteggio.
+
+    overlap e distance confrontano tutti i riquadri con un riquadro (risultato
+    con una riga per riquadro) o con un altro BoxArray (matrice righe x righe).
+    """
+    __slots__ = ("x", "y", "w", "h", "score")
+
+    def __init__(self, x, y, w, h, score=None):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.w = np.asarray(w, dtype=np.float64)
+        self.h = np.asarray(h, dtype=np.float64)
+        if score is None:
+            self.score = np.full(self.x.shape, np.nan)
+        else:
+            self.score = np.asarray(score, dtype=np.float64)
+
+    @classmethod
+    def fromArray(cls, coords):
+        """BoxArray da un array (n, 4) con x, y, w, h oppure (n, 5) con anche il punteggio"""
+        coords = np.asarray(coords, dtype=np.float64)
+        if coords.ndim != 2:
+            coords = coords.reshape(-1, 4)
+        score = coords[:, 4] if coords.shape[1] == 5 else None
+        return cls(coords[:, 0], coords[:, 1], coords[:, 2], coords[:, 3], score)
+
+    @classmethod
+    def fromBoxes(cls, boxes):
+        """BoxArray da una lista di BoundingBox"""
+        return cls(
+            [box.x for box in boxes], [box.y for box in boxes],
+            [box.w for box in boxes], [box.h for box in boxes],
+            [np.nan if box.score is None else box.score for box in boxes],
+        )
+
+    @classmethod
+    def concatenate(cls, arrays):
+        """Unisce più BoxArray (nell'ordine) in uno solo"""
+        arrays = list(arrays)
+        if not arrays:
+            return cls([], [], [], [])
+        return cls(*(np.concatenate([getattr(a, column) for a in arrays]) for column in cls.__slots__))
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        """Un intero restituisce un BoxView, una slice o un array di indici un BoxArray"""
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("Indice del riquadro fuori intervallo")
+            return BoxView(self, index)
+        return BoxArray(self.x[index], self.y[index], self.w[index], self.h[index], self.score[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield BoxView(self, index)
+
+    def hasScores(self):
+        """True se tutti i riquadri hanno un punteggio"""
+        return not np.isnan(self.score).any()
+
+    def toArray(self):
+        """Array (n, 5) con x, y, w, h e punteggio, (n, 4) se mancano dei punteggi"""
+        columns = [self.x, self.y, self.w, self.h]
+        if self.hasScores():
+            columns.append(self.score)
+        return np.stack(columns, axis=1)
+
+    def getCenters(self):
+        """Array (n, 2) con i centri dei riquadri"""
+        return np.stack((self.x + self.w / 2, self.y + self.h / 2), axis=1)
+
+    def getAreas(self):
+        return self.w * self.h
+
+    def overlap(self, other):
+        """
+        Rapporto tra l'area di intersezione con other e l'area di ogni riquadro
+        (come BoundingBox.overlap)
+        """
+        x, y, w, h = box_columns(other)
+        x1, y1 = self.x[:, np.newaxis], self.y[:, np.newaxis]
+        x2, y2 = x1 + self.w[:, np.newaxis], y1 + self.h[:, np.newaxis]
+        overlap_x = np.maximum(0, np.minimum(x2, x + w) - np.maximum(x1, x))
+        overlap_y = np.maximum(0, np.minimum(y2, y + h) - np.maximum(y1, y))
+        ratio = overlap_x * overlap_y / self.getAreas()[:, np.newaxis]
+        return ratio if isinstance(other, BoxArray) else ratio[:, 0]
+
+    def distance(self, other):
+        """Distanza euclidea tra il centro di ogni riquadro e il centro di other"""
+        x, y, w, h = box_columns(other)
+        dx = (self.x + self.w / 2)[:, np.newaxis] - (x + w / 2)
+        dy = (self.y + self.h / 2)[:, np.newaxis] - (y + h / 2)
+        distance = np.sqrt(dx * dx + dy * dy)
+        return distance if isinstance(other, BoxArray) else distance[:, 0]
+
+    def merge(self, threshold):
+        """
+        Unisce i riquadri sovrapposti, con lo stesso risultato (riquadri,
+        punteggi e ordine) dell'unione originale su liste di BoundingBox.
+
+        Nell'unione originale il primo riquadro della lista diventa il riquadro
+        corrente e i restanti vengono ordinati (ordinamento stabile) per
+        distanza dal suo centro; la lista viene percorsa in quest'ordine e ogni
+        riquadro che sovrappone quello corrente oltre threshold (rispetto
+        all'area dell'uno o dell'altro) viene unito subito, così i successivi
+        vengono confrontati con il riquadro già ingrandito. La scansione si
+        ferma al primo riquadro che non si sovrappone e il cui centro dista più
+        della somma delle semilarghezze; se qualcosa è stato unito riparte
+        dall'inizio. I riquadri rimasti, nell'ordine per distanza, formano la
+        lista del passo successivo.
+
+        Oltre merge_scalar_max_boxes riquadri l'elenco completo non viene mai
+        riordinato: una griglia dei centri (CenterGrid) restituisce solo i
+        riquadri entro un raggio dal riquadro di partenza, che vengono ordinati
+        per distanza (vedi orderNeighbours). Se la scansione supera la finestra
+        viene aggiunta la corona successiva, i cui riquadri seguono comunque
+        tutti quelli già ordinati. Ricerca, distanze e ordinamenti sono
+        vettoriali; la scansione, breve, lavora su coordinate float.
+
+        I punteggi vengono mantenuti solo se tutti i riquadri ne hanno uno (il
+        riquadro unito mantiene il punteggio massimo).
+        """
+        num_boxes = len(self)
+        if num_boxes == 0:
+            return BoxArray([], [], [], [])
+        has_scores = self.hasScores()
+        windowed = num_boxes > merge_scalar_max_boxes
+
+        xs, ys, ws, hs = self.x.tolist(), self.y.tolist(), self.w.tolist(), self.h.tolist()
+        # Valori calcolati come in BoundingBox (stessi float)
+        right = [x + w for x, w in zip(xs, ws)]
+        bottom = [y + h for y, h in zip(ys, hs)]
+        centers_x = [x + w / 2 for x, w in zip(xs, ws)]
+        centers_y = [y + h / 2 for y, h in zip(ys, hs)]
+        half_widths = [w / 2 for w in ws]
+        areas = [w * h for w, h in zip(ws, hs)]
+        scores = self.score.tolist() if has_scores else None
+        empty_overlap_merges = 0 > threshold
+
+        if windowed:
+            center_x = np.array(centers_x)
+            center_y = np.array(centers_y)
+            cell_size = float(max(self.w.max(), self.h.max()))
+            if not cell_size > 0:
+                cell_size = 1.0
+            grid = CenterGrid(center_x, center_y, cell_size)
+            alive = np.ones(num_boxes, dtype=bool)
+            # Centri dei riquadri di partenza già elaborati, dal primo all'ultimo
+            seeds_x, seeds_y = [], []
+        else:
+            remaining = list(range(1, num_boxes))
+
+        merged = []
+        seed = 0
+        num_alive = num_boxes
+        while seed is not None:
+            rx, ry, rw, rh = xs[seed], ys[seed], ws[seed], hs[seed]
+            score = scores[seed] if has_scores else None
+            seed_x, seed_y = centers_x[seed], centers_y[seed]
+            if windowed:
+                alive[seed] = False
+                num_alive -= 1
+                radius = cell_size
+                rest = self.orderNeighbours(grid, alive, center_x, center_y, seed_x, seed_y,
+                                            -1.0, radius, seeds_x, seeds_y)
+                unfetched = num_alive - len(rest)
+            else:
+                def seed_distance(m):
+                    dx = centers_x[m] - seed_x
+                    dy = centers_y[m] - seed_y
+                    return math.sqrt(dx * dx + dy * dy)
+                rest = sorted(remaining, key=seed_distance)
+                unfetched = 0
+
+            r_right, r_bottom = rx + rw, ry + rh
+            r_area, r_center_x, r_center_y, r_half_width = rw * rh, rx + rw / 2, ry + rh / 2, rw / 2
+            merged_any = True
+            while merged_any:
+                merged_any = False
+                i = 0
+                while True:
+                    if i == len(rest):
+                        if unfetched == 0:
+                            break
+                        # Fine della finestra: la corona successiva segue nell'ordinamento
+                        ring = self.orderNeighbours(grid, alive, center_x, center_y, seed_x, seed_y,
+                                                    radius, 2 * radius, seeds_x, seeds_y)
+                        radius *= 2
+                        unfetched -= len(ring)
+                        rest.extend(ring)
+                        continue
+                    m = rest[i]
+                    bx, by, b_right, b_bottom = xs[m], ys[m], right[m], bottom[m]
+                    overlap_x = (r_right if r_right < b_right else b_right) - (rx if rx > bx else bx)
+                    overlap_y = (r_bottom if r_bottom < b_bottom else b_bottom) - (ry if ry > by else by)
+                    if overlap_x > 0 and overlap_y > 0:
+                        overlap_area = overlap_x * overlap_y
+                        overlaps = overlap_area / r_area > threshold or overlap_area / areas[m] > threshold
+                    else:
+                        overlaps = empty_overlap_merges
+                    if overlaps:
+                        # Unione immediata (come BoundingBox.merge)
+                        new_x = rx if rx < bx else bx
+                        new_y = ry if ry < by else by
+                        rw = (r_right if r_right > b_right else b_right) - new_x
+                        rh = (r_bottom if r_bottom > b_bottom else b_bottom) - new_y
+                        rx, ry = new_x, new_y
+                        r_right, r_bottom = rx + rw, ry + rh
+                        r_area, r_center_x, r_center_y, r_half_width = rw * rh, rx + rw / 2, ry + rh / 2, rw / 2
+                        if has_scores:
+                            score = max(score, scores[m])
+                        del rest[i]
+                        if windowed:
+                            alive[m] = False
+                            num_alive -= 1
+                        merged_any = True
+                    else:
+                        # Il primo riquadro lontano chiude la scansione
+                        dx = centers_x[m] - r_center_x
+                        dy = centers_y[m] - r_center_y
+                        if math.sqrt(dx * dx + dy * dy) > r_half_width + half_widths[m]:
+                            break
+                        i += 1
+            merged.append((rx, ry, rw, rh))
+            if has_scores:
+                merged[-1] += (score,)
+
+            # Il riquadro di partenza successivo è il primo rimasto nell'ordinamento
+            if windowed:
+                while not rest and unfetched > 0:
+                    rest = self.orderNeighbours(grid, alive, center_x, center_y, seed_x, seed_y,
+                                                radius, 2 * radius, seeds_x, seeds_y)
+                    radius *= 2
+                    unfetched -= len(rest)
+                seeds_x.append(seed_x)
+                seeds_y.append(seed_y)
+                seed = rest[0] if rest else None
+            else:
+                seed = rest[0] if rest else None
+                remaining = rest[1:]
+        return BoxArray.fromArray(np.array(merged, dtype=np.float64))
+
+    @staticmethod
+    def orderNeighbours(grid, alive, center_x, center_y, seed_x, seed_y, inner, outer, seeds_x, seeds_y):
+        """
+        Riquadri attivi con il centro a distanza in (inner, outer] dal riquadro di
+        partenza, nell'ordine che avrebbero nella lista dell'unione originale.
+
+        La lista originale è ordinata per distanza dall'ultimo riquadro di
+        partenza, a parità per distanza dal precedente e così via fino alla
+        posizione iniziale: i riquadri alla stessa distanza vengono quindi
+        separati livello per livello, tutti i gruppi insieme. I riquadri con lo
+        stesso centro restano alla pari a ogni livello e seguono la posizione.
+        """
+        candidates = grid.query(seed_x, seed_y, outer)
+        candidates = candidates[alive[candidates]]
+        dx = center_x[candidates] - seed_x
+        dy = center_y[candidates] - seed_y
+        distance = np.sqrt(dx * dx + dy * dy)
+        keep = (distance > inner) & (distance <= outer)
+        candidates, distance = candidates[keep], distance[keep]
+        order = np.lexsort((candidates, distance))
+        candidates, distance = candidates[order], distance[order]
+
+        changes = distance[1:] != distance[:-1]
+        if not seeds_x or changes.all():
+            return candidates.tolist()
+
+        # Posizioni dei gruppi di riquadri alla stessa distanza (in ordine di posizione)
+        groups = np.cumsum(np.concatenate(([True], changes)))
+        tied = np.bincount(groups)[groups] > 1
+        positions, groups = np.flatnonzero(tied), groups[tied]
+        level = len(seeds_x) - 1
+        while positions.size > 0 and level >= 0:
+            members = candidates[positions]
+            members_x, members_y = center_x[members], center_y[members]
+            starts = np.flatnonzero(np.concatenate(([True], groups[1:] != groups[:-1])))
+            lengths = np.diff(np.append(starts, len(groups)))
+            first = np.repeat(starts, lengths)
+            differs = (members_x != members_x[first]) | (members_y != members_y[first])
+            keep = np.repeat(np.logical_or.reduceat(differs, starts), lengths)
+            positions, groups, members = positions[keep], groups[keep], members[keep]
+            if positions.size == 0:
+                break
+            dx = members_x[keep] - seeds_x[level]
+            dy = members_y[keep] - seeds_y[level]
+            distance = np.sqrt(dx * dx + dy * dy)
+            order = np.lexsort((distance, groups))
+            candidates[positions] = members[order]
+            groups, distance = groups[order], distance[order]
+            groups = np.cumsum(np.concatenate(([True], (groups[1:] != groups[:-1]) | (distance[1:] != distance[:-1]))))
+            tied = np.bincount(groups)[groups] > 1
+            positions, groups = positions[tied], groups[tied]
+            level -= 1
+        return candidates.tolist()
+
+
+class CenterGrid(object):
+    """Griglia dei centri dei riquadri per trovare quelli vicini a un punto"""
+
+    def __init__(self, center_x, center_y, cell_size):
+        self.cell_size = cell_size
+        self.min_x = float(center_x.min())
+        self.min_y = float(center_y.min())
+        cols = ((center_x - self.min_x) // cell_size).astype(np.int64)
+        rows = ((center_y - self.min_y) // cell_size).astype(np.int64)
+        self.num_cols = int(cols.max()) + 1
+        self.num_rows = int(rows.max()) + 1
+        cells = rows * self.num_cols + cols
+        self.order = np.argsort(cells, kind="stable")
+        self.cells = cells[self.order].tolist()
+
+    def query(self, x, y, radius):
+        """Indici dei riquadri con il centro nelle celle che coprono il quadrato di semilato radius"""
+        first_col = max(int((x - radius - self.min_x) // self.cell_size), 0)
+        last_col = min(int((x + radius - self.min_x) // self.cell_size), self.num_cols - 1)
+        first_row = max(int((y - radius - self.min_y) // self.cell_size), 0)
+        last_row = min(int((y + radius - self.min_y) // self.cell_size), self.num_rows - 1)
+        if first_col > last_col or first_row > last_row:
+            return self.order[:0]
+        if first_col == 0 and last_col == self.num_cols - 1:
+            # Righe intere della griglia: un solo intervallo contiguo
+            start = bisect.bisect_left(self.cells, first_row * self.num_cols)
+            stop = bisect.bisect_left(self.cells, (last_row + 1) * self.num_cols)
+            return self.order[start:stop]
+        slices = []
+        for row in range(first_row * self.num_cols, (last_row + 1) * self.num_cols, self.num_cols):
+            start = bisect.bisect_left(self.cells, row + first_col)
+            stop = bisect.bisect_right(self.cells, row + last_col)
+            if start < stop:
+                slices.append(self.order[start:stop])
+        if len(slices) == 1:
+            return slices[0]
+        return np.concatenate(slices) if slices else self.order[:0]
+
+
+def merge_box_arrays(boxes, threshold):
+    """
+    Unisce i riquadri sovrapposti di un array di coordinate (vedi BoxArray.merge).
+
+    Args:
+        boxes: Array (n, 4) con le colonne x, y, w, h, oppure (n, 5) con in più
+            il punteggio (il riquadro unito mantiene il punteggio massimo)
+        threshold: Rapporto minimo di sovrapposizione per unire due riquadri
+
+    Returns:
+        Array (m, 4) o (m, 5) con i riquadri uniti, nell'ordine dell'unione originale
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    boxes = boxes.reshape(-1, boxes.shape[-1] if boxes.ndim == 2 else 4)
+    if boxes.shape[0] == 0:
+        return boxes.copy()
+    merged = BoxArray.fromArray(boxes).merge(threshold)
+    columns = [merged.x, merged.y, merged.w, merged.h]
+    if boxes.shape[1] == 5:
+        columns.append(merged.score)
+    return np.stack(columns, axis=1)
@@ -2,7 +2,59 @@ import os
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
-from collections import Counter
+
+def _run_lengths(img):
+    """
+    Calcola la codifica run-length verticale (colonna per colonna) dell'immagine.
+
+    Le sequenze vengono restituite nello stesso ordine in cui le visiterebbe una
+    scansione colonna per colonna dall'alto verso il basso, così che le statistiche
+    costruite su di esse coincidano con quelle della scansione pixel per pixel.
+
+    Returns:
+        Tupla (lengths, values, pair_sums):
+        - lengths: lunghezza di ogni sequenza
+        - values: valore del pixel della sequenza (0 = nero)
+        - pair_sums: lunghezza della sequenza sommata a quella successiva nella
+          stessa colonna (solo la propria lunghezza per l'ultima sequenza della colonna)
+    """
+    num_rows = img.shape[0]
+    # Trasposta contigua: ogni colonna dell'immagine diventa una riga in memoria
+    flat = np.ascontiguousarray(img.T).ravel()
+
+    # Un nuovo run inizia quando il valore cambia o quando inizia una nuova colonna
+    starts = np.empty(flat.shape[0], dtype=bool)
+    starts[0] = True
+    np.not_equal(flat[1:], flat[:-1], out=starts[1:])
+    starts[::num_rows] = True
+
+    start_idx = np.flatnonzero(starts)
+    lengths = np.diff(np.append(start_idx, flat.shape[0]))
+    values = flat[start_idx]
+
+    # Somma di due sequenze consecutive solo se appartengono alla stessa colonna
+    column = start_idx // num_rows
+    pair_sums = lengths.copy()
+    same_column = column[1:] == column[:-1]
+    pair_sums[:-1] += np.where(same_column, lengths[1:], 0)
+
+    return lengths, values, pair_sums
+
+
+def _most_common(values):
+    """
+    Restituisce il valore più frequente, come Counter.most_common(1).
+
+    A parità di frequenza vince il valore incontrato per primo, in modo da
+    riprodurre esattamente l'ordine di inserimento usato da Counter.
+    """
+    counts = np.bincount(values)
+    candidates = np.flatnonzero(counts == counts.max())
+    if len(candidates) == 1:
+        return int(candidates[0])
+    first_seen = [np.argmax(values == candidate) for candidate in candidates]
+    return int(candidates[int(np.argmin(first_seen))])
+
 
 def get_ref_lengths(img):
     """
@@ -11,62 +63,18 @@ def get_ref_lengths(img):
     
     Questa funzione è cruciale per le successive elaborazioni perché fornisce parametri
     fondamentali per la segmentazione e il riconoscimento della notazione musicale.
+
+    Le sequenze sono calcolate in modo vettoriale con NumPy (confini dei run tramite
+    differenze tra pixel adiacenti, istogrammi tramite bincount).
     """
-    num_rows = img.shape[0]  # Altezza dell'immagine (numero di righe)
-    num_cols = img.shape[1]  # Larghezza dell'immagine (numero di colonne)
-    rle_image_white_runs = []  # Lista cumulativa di sequenze bianche
-    rle_image_black_runs = []  # Lista cumulativa di sequenze nere
-    sum_all_consec_runs = []  # Lista cumulativa di sequenze consecutive bianco-nero
-
-    for i in range(num_cols):
-        col = img[:, i]
-        rle_col = []
-        rle_white_runs = []
-        rle_black_runs = []
-        run_val = 0  # (Numero di pixel consecutivi dello stesso valore)
-        run_type = col[0]  # Dovrebbe essere 255 (bianco) inizialmente
-        for j in range(num_rows):
-            if (col[j] == run_type):
-                # incrementa la lunghezza della sequenza
-                run_val += 1
-            else:
-                # aggiunge la lunghezza della sequenza precedente alla codifica rle
-                rle_col.append(run_val)
-                if (run_type == 0):
-                    rle_black_runs.append(run_val)
-                else:
-                    rle_white_runs.append(run_val)
-
-                # alterna il tipo di sequenza
-                run_type = col[j]
-                # incrementa run_val per il nuovo valore
-                run_val = 1
-
-        # aggiunge la lunghezza dell'ultima sequenza alla codifica
-        rle_col.append(run_val)
-        if (run_type == 0):
-            rle_black_runs.append(run_val)
-        else:
-            rle_white_runs.append(run_val)
-
-        # Calcola la somma di sequenze verticali consecutive
-        sum_rle_col = [sum(rle_col[i: i + 2]) for i in range(len(rle_col))]
-
-        # Aggiunge alla lista di accumulo delle colonne
-        rle_image_white_runs.extend(rle_white_runs)
-        rle_image_black_runs.extend(rle_black_runs)
-        sum_all_consec_runs.extend(sum_rle_col)
-
-    # Usa Counter per trovare i valori più comuni, che rappresenteranno
-    # le dimensioni standard delle linee del pentagramma e degli spazi tra esse
-    white_runs = Counter(rle_image_white_runs)
-    black_runs = Counter(rle_image_black_runs)
-    black_white_sum = Counter(sum_all_consec_runs)
-
-    # Estrae i valori più comuni che rappresentano le caratteristiche del pentagramma
-    line_spacing = white_runs.most_common(1)[0][0]  # Spazio tra le linee del pentagramma
-    line_width = black_runs.most_common(1)[0][0]    # Spessore delle linee del pentagramma
-    width_spacing_sum = black_white_sum.most_common(1)[0][0]  # Somma dei due valori precedenti
+    lengths, values, pair_sums = _run_lengths(img)
+    is_black = values == 0
+
+    # Le dimensioni più frequenti rappresentano le dimensioni standard
+    # delle linee del pentagramma e degli spazi tra esse
+    line_spacing = _most_common(lengths[~is_black])  # Spazio tra le linee del pentagramma
+    line_width = _most_common(lengths[is_black])     # Spessore delle linee del pentagramma
+    width_spacing_sum = _most_common(pair_sums)      # Somma dei due valori precedenti
 
     assert (line_spacing + line_width == width_spacing_sum), "Lo spessore stimato della linea + lo spazio non corrisponde con la somma più comune"
 
@@ -1,8 +1,13 @@
+import io
 import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
-from src.utils import locate_templates, merge_boxes
-from src.primitive import Primitive
+from src.utils import locate_templates, locate_template_banks, merge_boxes, TemplateBank, correlation_backend
+from src.box import BoxArray
+from src.primitive import PrimitiveTable
 from src.bar import Bar
 
 # current directory
@@ -171,6 +176,124 @@ eighth_flag_lower, eighth_flag_upper, eighth_flag_thresh = 50, 150, 0.8
 # Bar line
 bar_lower, bar_upper, bar_thresh = 50, 150, 0.85
 
+# -------------------------------------------------------------------------------
+# Template Reference Spacing
+# -------------------------------------------------------------------------------
+
+# Interlinea (in pixel) dello spartito da cui è stato ritagliato ogni template,
+# nello stesso ordine dei percorsi. Misurata sulle pagine in resources/samples
+# come line_spacing / scala di massima correlazione; per i template mai trovati
+# è stimata dall'altezza del glifo rispetto a un template misurato della stessa classe.
+
+# Clefs
+clef_spacing = {"treble": [17, 18, 5], "bass": [18]}
+
+# Time
+time_spacing = {"common": [18], "44": [18], "34": [18], "24": [18], "68": [38]}
+
+# Accidentals
+sharp_spacing = [14.5, 14.5]
+flat_spacing = [18, 18]
+
+# Notes
+quarter_note_spacing = [18, 18]
+half_note_spacing = [18, 16, 18, 16]
+whole_note_spacing = [18, 15, 18, 15]
+
+# Rests
+eighth_rest_spacing = [16]
+quarter_rest_spacing = [16]
+half_rest_spacing = [18, 18]
+whole_rest_spacing = [18]
+
+# Eighth Flag
+eighth_flag_spacing = [11, 18, 18, 11, 14, 14]
+
+# Bar line
+bar_spacing = [18, 18, 18, 18]
+
+# Backend di correlazione di ogni classe di simboli (vedi src.utils.correlate):
+# "spatial" (cv2.matchTemplate), "fft" o "auto" (FFT per i template più grandi)
+template_backends = {
+    "clef": correlation_backend,
+    "time": correlation_backend,
+    "sharp": correlation_backend,
+    "flat": correlation_backend,
+    "quarter_note": correlation_backend,
+    "half_note": correlation_backend,
+    "whole_note": correlation_backend,
+    "eighth_rest": correlation_backend,
+    "quarter_rest": correlation_backend,
+    "half_rest": correlation_backend,
+    "whole_rest": correlation_backend,
+    "eighth_flag": correlation_backend,
+    "bar": correlation_backend,
+}
+
+# Se True i template vengono cercati solo alle scale previste dall'interlinea
+# del pentagramma (vedi predict_scales) invece dell'intero intervallo di scale.
+# Disattivato di default: le interlinee di riferimento dei template sono stimate
+# a mano e su alcune pagine (drum, fire) cambiano i simboli trovati
+predict_template_scale = False
+
+# Se True la corrispondenza mantiene solo i massimi locali della correlazione
+# (entro circa metà template, vedi find_peaks) invece di tutte le posizioni
+extract_peaks = False
+
+# Se True i template vengono cercati prima su un'immagine ridotta e confermati a
+# piena risoluzione solo attorno ai candidati (vedi correlate_coarse_to_fine)
+coarse_to_fine = False
+
+# Numero massimo di pentagrammi elaborati in parallelo (1 = in sequenza)
+staff_workers = int(os.environ.get("STAFF_WORKERS", os.cpu_count() or 1))
+
+# Classi di primitive cercate da find_primitive con un'unica scansione del
+# pentagramma, nell'ordine in cui vengono aggiunte: (banco di template,
+# etichetta disegnata, primitiva, durata)
+primitive_classes = [
+    (TemplateBank("sharp", sharp_imgs, sharp_lower, sharp_upper, sharp_thresh, sharp_spacing,
+                  template_backends["sharp"]),
+     "sharp", "sharp", 0),
+    (TemplateBank("flat", flat_imgs, flat_lower, flat_upper, flat_thresh, flat_spacing,
+                  template_backends["flat"]),
+     "flat", "flat", 0),
+    (TemplateBank("quarter_note", quarter_note_imgs, quarter_note_lower, quarter_note_upper,
+                  quarter_note_thresh, quarter_note_spacing,
+                  template_backends["quarter_note"]),
+     "1/4 note", "note", 1),
+    (TemplateBank("half_note", half_note_imgs, half_note_lower, half_note_upper,
+                  half_note_thresh, half_note_spacing,
+                  template_backends["half_note"]),
+     "1/2 note", "note", 2),
+    (TemplateBank("whole_note", whole_note_imgs, whole_note_lower, whole_note_upper,
+                  whole_note_thresh, whole_note_spacing,
+                  template_backends["whole_note"]),
+     "1 note", "note", 4),
+    (TemplateBank("eighth_rest", eighth_rest_imgs, eighth_rest_lower, eighth_rest_upper,
+                  eighth_rest_thresh, eighth_rest_spacing,
+                  template_backends["eighth_rest"]),
+     "1/8 rest", "rest", 0.5),
+    (TemplateBank("quarter_rest", quarter_rest_imgs, quarter_rest_lower, quarter_rest_upper,
+                  quarter_rest_thresh, quarter_rest_spacing,
+                  template_backends["quarter_rest"]),
+     "1/4 rest", "rest", 1),
+    (TemplateBank("half_rest", half_rest_imgs, half_rest_lower, half_rest_upper,
+                  half_rest_thresh, half_rest_spacing,
+                  template_backends["half_rest"]),
+     "1/2 rest", "rest", 2),
+    (TemplateBank("whole_rest", whole_rest_imgs, whole_rest_lower, whole_rest_upper,
+                  whole_rest_thresh, whole_rest_spacing,
+                  template_backends["whole_rest"]),
+     "1 rest", "rest", 4),
+    (TemplateBank("eighth_flag", eighth_flag_imgs, eighth_flag_lower, eighth_flag_upper,
+                  eighth_flag_thresh, eighth_flag_spacing,
+                  template_backends["eighth_flag"]),
+     "1/8 flag", "eighth_flag", 0),
+    (TemplateBank("bar", bar_imgs, bar_lower, bar_upper, bar_thresh, bar_spacing,
+                  template_backends["bar"]),
+     "line", "line", 0),
+]
+
 key_signature_changes = {
     "sharp": ["", "F", "FC", "FCG", "FCGD", "FCGDA", "FCGDAE", "FCGDAEB"],
     "flat": ["", "B", "BE", "BEA", "BEAD", "BEADG", "BEADGC", "BEADGCF"],
@@ -187,668 +310,477 @@ key_signature_changes = {
 # Find all primitives on each stave first
 # then move from left to right and create structure
 
+class StaffOutput(object):
+    """
+    Flusso che sostituisce sys.stdout mentre map_staffs elabora più pentagrammi
+    in parallelo: un thread con un buffer assegnato scrive nel buffer, tutti gli
+    altri nel flusso originale
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def setBuffer(self, buffer):
+        self.local.buffer = buffer
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        return (self.stream if buffer is None else buffer).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+staff_output_lock = threading.Lock()
+staff_output = None
+staff_output_users = 0
+
+
+def acquire_staff_output():
+    """Installa (o riusa, se già attivo) lo StaffOutput su sys.stdout"""
+    global staff_output, staff_output_users
+    with staff_output_lock:
+        if staff_output_users == 0:
+            staff_output = StaffOutput(sys.stdout)
+            sys.stdout = staff_output
+        staff_output_users += 1
+        return staff_output
+
+
+def release_staff_output():
+    """Ripristina sys.stdout quando nessuna map_staffs usa più lo StaffOutput"""
+    global staff_output, staff_output_users
+    with staff_output_lock:
+        staff_output_users -= 1
+        if staff_output_users == 0:
+            if sys.stdout is staff_output:
+                sys.stdout = staff_output.stream
+            staff_output = None
+
+
+def map_staffs(func, num_staffs, workers=None):
+    """
+    Applica func all'indice di ogni pentagramma e restituisce i risultati in
+    ordine. Con workers > 1 i pentagrammi vengono elaborati su un pool di al
+    più workers thread: il lavoro è quasi tutto in OpenCV, che rilascia il GIL.
+    Il log di ogni pentagramma viene raccolto a parte e stampato, nell'ordine
+    dei pentagrammi, al termine dell'elaborazione, come in sequenza.
+    Se workers è None viene usato staff_workers.
+    """
+    if workers is None:
+        workers = staff_workers
+    if workers <= 1 or num_staffs <= 1:
+        return [func(i) for i in range(num_staffs)]
+
+    output = acquire_staff_output()
+
+    def run(i):
+        buffer = io.StringIO()
+        output.setBuffer(buffer)
+        try:
+            return func(i), None, buffer.getvalue()
+        except Exception as e:
+            return None, e, buffer.getvalue()
+        finally:
+            output.setBuffer(None)
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(workers, num_staffs)) as pool:
+            outcomes = list(pool.map(run, range(num_staffs)))
+    finally:
+        release_staff_output()
+
+    results = []
+    for result, error, log in outcomes:
+        sys.stdout.write(log)
+        if error is not None:
+            raise error
+        results.append(result)
+    return results
+
+
 # ============ Determine Clef, Time Signature ============
 
 
-def find_clef_time_signature(staffs):
+def find_staff_clef_time_signature(staffs, i, predict_scale=predict_template_scale,
+                                   peaks=extract_peaks, pyramid=coarse_to_fine):
     """
-    Trova la chiave e la misura in un pentagramma.
+    Trova la chiave e la misura del pentagramma i.
 
-    Args:
-        staffs: Lista di oggetti Staff che rappresentano i pentagrammi
+    Legge e modifica solo staffs[i], quindi più pentagrammi possono essere
+    elaborati in parallelo. Se la misura va ereditata dal pentagramma
+    precedente non viene assegnata qui ma da find_clef_time_signature.
+
+    Non disegna nulla: i simboli trovati vengono registrati come annotazioni
+    del pentagramma (vedi src.overlays per le immagini di debug).
 
     Returns:
-        Tuple contenente la chiave e la misura trovate
+        True se la misura va presa dal pentagramma precedente
     """
-    # Implementa il rilevamento della chiave e della misura qui
-    # Restituisce una tupla (clef, time_signature)
-    staff_imgs_color = []
-
-    for i in range(len(staffs)):
-        red = (0, 0, 255)
-        box_thickness = 2
-        staff_img = staffs[i].getImage()
-        staff_img_color = staff_img.copy()
-        staff_img_color = cv2.cvtColor(staff_img_color, cv2.COLOR_GRAY2RGB)
-
-        # ------- Clef -------
-        for clef in clef_imgs:
-            # show the clef template
-            print("[INFO] Matching {} clef template on staff".format(clef), i + 1)
-            clef_boxes = locate_templates(
-                staff_img, clef_imgs[clef], clef_lower, clef_upper, clef_thresh
-            )
-            clef_boxes = merge_boxes([j for i in clef_boxes for j in i], 0.5)
-
-            if len(clef_boxes) == 1:
-                print("[INFO] Clef Found: ", clef)
-                staffs[i].setClef(clef)
-
-                # print("[INFO] Displaying Matching Results on staff", i + 1)
-                clef_boxes_img = staffs[i].getImage()
-                clef_boxes_img = clef_boxes_img.copy()
-
-                for boxes in clef_boxes:
-                    boxes.draw(staff_img_color, red, box_thickness)
-                    x = int(boxes.getCorner()[0] + (boxes.getWidth() // 2))
-                    y = int(boxes.getCorner()[1] + boxes.getHeight() + 10)
-                    cv2.putText(
-                        staff_img_color,
-                        "{} clef".format(clef),
-                        (x, y),
-                        cv2.FONT_HERSHEY_DUPLEX,
-                        0.9,
-                        red,
-                    )
-                break
+    staff_img = staffs[i].getImage()
+    line_spacing = staffs[i].getLineSpacing() if predict_scale else None
+    inherit_time = False
+
+    # ------- Clef -------
+    for clef in clef_imgs:
+        # show the clef template
+        print("[INFO] Matching {} clef template on staff".format(clef), i + 1)
+        clef_boxes = locate_templates(
+            staff_img, clef_imgs[clef], clef_lower, clef_upper, clef_thresh,
+            line_spacing, clef_spacing[clef],
+            peaks=peaks, backend=template_backends["clef"], pyramid=pyramid,
+        )
+        clef_boxes = merge_boxes(BoxArray.concatenate(clef_boxes), 0.5)
 
-        else:
-            # A clef should always be found
-            print("[INFO] No clef found on staff", i + 1)
+        if len(clef_boxes) == 1:
+            print("[INFO] Clef Found: ", clef)
+            staffs[i].setClef(clef)
 
-        # # ------- Time -------
-        for time in time_imgs:
-            print(
-                "[INFO] Matching {} time signature template on staff".format(time),
-                i + 1,
-            )
-            time_boxes = locate_templates(
-                staff_img, time_imgs[time], time_lower, time_upper, time_thresh
-            )
-            time_boxes = merge_boxes([j for i in time_boxes for j in i], 0.5)
-
-            if len(time_boxes) == 1:
-                print("[INFO] Time Signature Found: ", time)
-                staffs[i].setTimeSignature(time)
-
-                # print("[INFO] Displaying Matching Results on staff", i + 1)
-
-                for boxes in time_boxes:
-                    boxes.draw(staff_img_color, red, box_thickness)
-                    x = int(boxes.getCorner()[0] - (boxes.getWidth() // 2))
-                    y = int(boxes.getCorner()[1] + boxes.getHeight() + 20)
-                    cv2.putText(
-                        staff_img_color,
-                        "{} time".format(time),
-                        (x, y),
-                        cv2.FONT_HERSHEY_DUPLEX,
-                        0.9,
-                        red,
-                    )
-                break
+            for boxes in clef_boxes:
+                staffs[i].addAnnotation("clef", boxes, "{} clef".format(clef))
+            break
 
-            elif len(time_boxes) == 0 and i > 0:
-                # Take time signature of previous staff
-                previousTime = staffs[i - 1].getTimeSignature()
-                staffs[i].setTimeSignature(previousTime)
-                print(
-                    "[INFO] No time signature found on staff",
-                    i + 1,
-                    ". Using time signature from previous staff line: ",
-                    previousTime,
-                )
-                break
-        else:
-            print("[INFO] No time signature available for staff", i + 1)
+    else:
+        # A clef should always be found
+        print("[INFO] No clef found on staff", i + 1)
 
-        staff_imgs_color.append(staff_img_color)
+    # # ------- Time -------
+    for time in time_imgs:
+        print(
+            "[INFO] Matching {} time signature template on staff".format(time),
+            i + 1,
+        )
+        time_boxes = locate_templates(
+            staff_img, time_imgs[time], time_lower, time_upper, time_thresh,
+            line_spacing, time_spacing[time],
+            peaks=peaks, backend=template_backends["time"], pyramid=pyramid,
+        )
+        time_boxes = merge_boxes(BoxArray.concatenate(time_boxes), 0.5)
+
+        if len(time_boxes) == 1:
+            print("[INFO] Time Signature Found: ", time)
+            staffs[i].setTimeSignature(time)
+
+            for boxes in time_boxes:
+                staffs[i].addAnnotation("time", boxes, "{} time".format(time))
+            break
 
-    return staffs, staff_imgs_color
+        elif len(time_boxes) == 0 and i > 0:
+            # Take time signature of previous staff
+            # (assegnata da find_clef_time_signature, nell'ordine dei pentagrammi)
+            inherit_time = True
+            break
+    else:
+        print("[INFO] No time signature available for staff", i + 1)
 
+    return inherit_time
 
-def find_primitive(staffs, staff_imgs_color):
+
+def find_clef_time_signature(staffs, predict_scale=predict_template_scale, peaks=extract_peaks,
+                             pyramid=coarse_to_fine, workers=None):
     """
-    Trova le primitive musicali in un pentagramma.
+    Trova la chiave e la misura in un pentagramma.
 
     Args:
         staffs: Lista di oggetti Staff che rappresentano i pentagrammi
-        staff_imgs_color: Lista di immagini dei pentagrammi con le primitive trovate
+        predict_scale: Se True limita la ricerca alle scale previste dall'interlinea
+        peaks: Se True mantiene solo i massimi locali della correlazione
+        pyramid: Se True usa la ricerca coarse-to-fine
+        workers: Numero massimo di pentagrammi elaborati in parallelo
+            (None = staff_workers)
 
     Returns:
-        Tuple contenente la chiave e la misura trovate
+        La lista staffs, con chiave, misura e annotazioni di ogni pentagramma
     """
-    # Implementa il rilevamento delle primitive qui
-    # Restituisce una tupla (clef, time_signature)
-    for i in range(len(staffs)):
-        print("[INFO] Finding Primitives on Staff ", i + 1)
-        staff_primitives = []
-        staff_img = staffs[i].getImage()
-        staff_img_color = staff_imgs_color[i]
-        red = (0, 0, 255)
-        box_thickness = 2
-
-        # ------- Find primitives on staff -------
-        print("[INFO] Matching sharp accidental template...")
-        sharp_boxes = locate_templates(
-            staff_img, sharp_imgs, sharp_lower, sharp_upper, sharp_thresh
-        )
-        sharp_boxes = merge_boxes([j for i in sharp_boxes for j in i], 0.5)
-
-        print("[INFO] Displaying Matching Results on staff", i + 1)
-        for box in sharp_boxes:
-            box.draw(staff_img_color, red, box_thickness)
-            text = "sharp"
-            font = cv2.FONT_HERSHEY_DUPLEX
-            textsize = cv2.getTextSize(text, font, fontScale=0.7, thickness=1)[0]
-            x = int(box.getCorner()[0] - (textsize[0] // 2))
-            y = int(box.getCorner()[1] + box.getHeight() + 20)
-            cv2.putText(
-                staff_img_color,
-                text,
-                (x, y),
-                font,
-                fontScale=0.7,
-                color=red,
-                thickness=1,
+    results = map_staffs(
+        lambda i: find_staff_clef_time_signature(staffs, i, predict_scale, peaks, pyramid),
+        len(staffs), workers,
+    )
+
+    # La misura ereditata dipende da quella già risolta del pentagramma precedente
+    for i, inherit_time in enumerate(results):
+        if inherit_time:
+            previousTime = staffs[i - 1].getTimeSignature()
+            staffs[i].setTimeSignature(previousTime)
+            print(
+                "[INFO] No time signature found on staff",
+                i + 1,
+                ". Using time signature from previous staff line: ",
+                previousTime,
             )
-            sharp = Primitive("sharp", 0, box)
-            staff_primitives.append(sharp)
 
-        print("[INFO] Matching flat accidental template...")
-        flat_boxes = locate_templates(
-            staff_img, flat_imgs, flat_lower, flat_upper, flat_thresh
-        )
-        flat_boxes = merge_boxes([j for i in flat_boxes for j in i], 0.5)
-
-        print("[INFO] Displaying Matching Results on staff", i + 1)
-        for box in flat_boxes:
-            box.draw(staff_img_color, red, box_thickness)
-            text = "flat"
-            font = cv2.FONT_HERSHEY_DUPLEX
-            textsize = cv2.getTextSize(text, font, fontScale=0.7, thickness=1)[0]
-            x = int(box.getCorner()[0] - (textsize[0] // 2))
-            y = int(box.getCorner()[1] + box.getHeight() + 20)
-            cv2.putText(
-                staff_img_color,
-                text,
-                (x, y),
-                font,
-                fontScale=0.7,
-                color=red,
-                thickness=1,
-            )
-            flat = Primitive("flat", 0, box)
-            staff_primitives.append(flat)
-
-        print("[INFO] Matching quarter note template...")
-        quarter_boxes = locate_templates(
-            staff_img,
-            quarter_note_imgs,
-            quarter_note_lower,
-            quarter_note_upper,
-            quarter_note_thresh,
-        )
-        quarter_boxes = merge_boxes([j for i in quarter_boxes for j in i], 0.5)
-
-        print("[INFO] Displaying Matching Results on staff", i + 1)
-        for box in quarter_boxes:
-            box.draw(staff_img_color, red, box_thickness)
-            text = "1/4 note"
-            font = cv2.FONT_HERSHEY_DUPLEX
-            textsize = cv2.getTextSize(text, font, fontScale=0.7, thickness=1)[0]
-            x = int(box.getCorner()[0] - (textsize[0] // 2))
-            y = int(box.getCorner()[1] + box.getHeight() + 20)
-            cv2.putText(
-                staff_img_color,
-                text,
-                (x, y),
-                font,
-                fontScale=0.7,
-                color=red,
-                thickness=1,
-            )
-            pitch = staffs[i].getPitch(round(box.getCenter()[1]))
-            quarter = Primitive("note", 1, box, pitch)
-            staff_primitives.append(quarter)
-
-        print("[INFO] Matching half note template...")
-        half_boxes = locate_templates(
-            staff_img,
-            half_note_imgs,
-            half_note_lower,
-            half_note_upper,
-            half_note_thresh,
-        )
-        half_boxes = merge_boxes([j for i in half_boxes for j in i], 0.5)
-
-        print("[INFO] Displaying Matching Results on staff", i + 1)
-        for box in half_boxes:
-            box.draw(staff_img_color, red, box_thickness)
-            text = "1/2 note"
-            font = cv2.FONT_HERSHEY_DUPLEX
-            textsize = cv2.getTextSize(text, font, fontScale=0.7, thickness=1)[0]
-            x = int(box.getCorner()[0] - (textsize[0] // 2))
-            y = int(box.getCorner()[1] + box.getHeight() + 20)
-            cv2.putText(
-                staff_img_color,
-                text,
-                (x, y),
-                font,
-                fontScale=0.7,
-                color=red,
-                thickness=1,
-            )
-            pitch = staffs[i].getPitch(round(box.getCenter()[1]))
-            half = Primitive("note", 2, box, pitch)
-            staff_primitives.append(half)
-
-        print("[INFO] Matching whole note template...")
-        whole_boxes = locate_templates(
-            staff_img,
-            whole_note_imgs,
-            whole_note_lower,
-            whole_note_upper,
-            whole_note_thresh,
-        )
-        whole_boxes = merge_boxes([j for i in whole_boxes for j in i], 0.5)
-
-        print("[INFO] Displaying Matching Results on staff", i + 1)
-        for box in whole_boxes:
-            box.draw(staff_img_color, red, box_thickness)
-            text = "1 note"
-            font = cv2.FONT_HERSHEY_DUPLEX
-            textsize = cv2.getTextSize(text, font, fontScale=0.7, thickness=1)[0]
-            x = int(box.getCorner()[0] - (textsize[0] // 2))
-            y = int(box.getCorner()[1] + box.getHeight() + 20)
-            cv2.putText(
-                staff_img_color,
-                text,
-                (x, y),
-                font,
-                fontScale=0.7,
-                color=red,
-                thickness=1,
-            )
-            pitch = staffs[i].getPitch(round(box.getCenter()[1]))
-            whole = Primitive("note", 4, box, pitch)
-            staff_primitives.append(whole)
-
-        print("[INFO] Matching eighth rest template...")
-        eighth_boxes = locate_templates(
-            staff_img,
-            eighth_rest_imgs,
-            eighth_rest_lower,
-            eighth_rest_upper,
-            eighth_rest_thresh,
-        )
-        eighth_boxes = merge_boxes([j for i in eighth_boxes for j in i], 0.5)
-
-        print("[INFO] Displaying Matching Results on staff", i + 1)
-        for box in eighth_boxes:
-            box.draw(staff_img_color, red, box_thickness)
-            text = "1/8 rest"
-            font = cv2.FONT_HERSHEY_DUPLEX
-            textsize = cv2.getTextSize(text, font, fontScale=0.7, thickness=1)[0]
-            x = int(box.getCorner()[0] - (textsize[0] // 2))
-            y = int(box.getCorner()[1] + box.getHeight() + 20)
-            cv2.putText(
-                staff_img_color,
-                text,
-                (x, y),
-                font,
-                fontScale=0.7,
-                color=red,
-                thickness=1,
-            )
-            eighth = Primitive("rest", 0.5, box)
-            staff_primitives.append(eighth)
-
-        print("[INFO] Matching quarter rest template...")
-        quarter_boxes = locate_templates(
-            staff_img,
-            quarter_rest_imgs,
-            quarter_rest_lower,
-            quarter_rest_upper,
-            quarter_rest_thresh,
-        )
-        quarter_boxes = merge_boxes([j for i in quarter_boxes for j in i], 0.5)
-
-        print("[INFO] Displaying Matching Results on staff", i + 1)
-        for box in quarter_boxes:
-            box.draw(staff_img_color, red, box_thickness)
-            text = "1/4 rest"
-            font = cv2.FONT_HERSHEY_DUPLEX
-            textsize = cv2.getTextSize(text, font, fontScale=0.7, thickness=1)[0]
-            x = int(box.getCorner()[0] - (textsize[0] // 2))
-            y = int(box.getCorner()[1] + box.getHeight() + 20)
-            cv2.putText(
-                staff_img_color,
-                text,
-                (x, y),
-                font,
-                fontScale=0.7,
-                color=red,
-                thickness=1,
-            )
-            quarter = Primitive("rest", 1, box)
-            staff_primitives.append(quarter)
-
-        print("[INFO] Matching half rest template...")
-        half_boxes = locate_templates(
-            staff_img,
-            half_rest_imgs,
-            half_rest_lower,
-            half_rest_upper,
-            half_rest_thresh,
-        )
-        half_boxes = merge_boxes([j for i in half_boxes for j in i], 0.5)
-
-        print("[INFO] Displaying Matching Results on staff", i + 1)
-        for box in half_boxes:
-            box.draw(staff_img_color, red, box_thickness)
-            text = "1/2 rest"
-            font = cv2.FONT_HERSHEY_DUPLEX
-            textsize = cv2.getTextSize(text, font, fontScale=0.7, thickness=1)[0]
-            x = int(box.getCorner()[0] - (textsize[0] // 2))
-            y = int(box.getCorner()[1] + box.getHeight() + 20)
-            cv2.putText(
-                staff_img_color,
-                text,
-                (x, y),
-                font,
-                fontScale=0.7,
-                color=red,
-                thickness=1,
-            )
-            half = Primitive("rest", 2, box)
-            staff_primitives.append(half)
-
-        print("[INFO] Matching whole rest template...")
-        whole_boxes = locate_templates(
-            staff_img,
-            whole_rest_imgs,
-            whole_rest_lower,
-            whole_rest_upper,
-            whole_rest_thresh,
-        )
-        whole_boxes = merge_boxes([j for i in whole_boxes for j in i], 0.5)
-
-        print("[INFO] Displaying Matching Results on staff", i + 1)
-        for box in whole_boxes:
-            box.draw(staff_img_color, red, box_thickness)
-            text = "1 rest"
-            font = cv2.FONT_HERSHEY_DUPLEX
-            textsize = cv2.getTextSize(text, font, fontScale=0.7, thickness=1)[0]
-            x = int(box.getCorner()[0] - (textsize[0] // 2))
-            y = int(box.getCorner()[1] + box.getHeight() + 20)
-            cv2.putText(
-                staff_img_color,
-                text,
-                (x, y),
-                font,
-                fontScale=0.7,
-                color=red,
-                thickness=1,
-            )
-            whole = Primitive("rest", 4, box)
-            staff_primitives.append(whole)
-
-        print("[INFO] Matching eighth flag template...")
-        flag_boxes = locate_templates(
-            staff_img,
-            eighth_flag_imgs,
-            eighth_flag_lower,
-            eighth_flag_upper,
-            eighth_flag_thresh,
-        )
-        flag_boxes = merge_boxes([j for i in flag_boxes for j in i], 0.5)
-
-        print("[INFO] Displaying Matching Results on staff", i + 1)
-
-        for box in flag_boxes:
-            box.draw(staff_img_color, red, box_thickness)
-            text = "1/8 flag"
-            font = cv2.FONT_HERSHEY_DUPLEX
-            textsize = cv2.getTextSize(text, font, fontScale=0.7, thickness=1)[0]
-            x = int(box.getCorner()[0] - (textsize[0] // 2))
-            y = int(box.getCorner()[1] + box.getHeight() + 20)
-            cv2.putText(
-                staff_img_color,
-                text,
-                (x, y),
-                font,
-                fontScale=0.7,
-                color=red,
-                thickness=1,
-            )
-            flag = Primitive("eighth_flag", 0, box)
-            staff_primitives.append(flag)
+    return staffs
 
-        print("[INFO] Matching bar line template...")
-        bar_boxes = locate_templates(
-            staff_img, bar_imgs, bar_lower, bar_upper, bar_thresh
-        )
-        bar_boxes = merge_boxes([j for i in bar_boxes for j in i], 0.5)
-
-        print("[INFO] Displaying Matching Results on staff", i + 1)
-        for box in bar_boxes:
-            box.draw(staff_img_color, red, box_thickness)
-            text = "line"
-            font = cv2.FONT_HERSHEY_DUPLEX
-            textsize = cv2.getTextSize(text, font, fontScale=0.7, thickness=1)[0]
-            x = int(box.getCorner()[0] - (textsize[0] // 2))
-            y = int(box.getCorner()[1] + box.getHeight() + 20)
-            cv2.putText(
-                staff_img_color,
-                text,
-                (x, y),
-                font,
-                fontScale=0.7,
-                color=red,
-                thickness=1,
-            )
-            line = Primitive("line", 0, box)
-            staff_primitives.append(line)
 
-        # print("[INFO] Saving detected primitives in staff {} onto disk".format(i + 1))
-        # cv2.imwrite("output/staff_{}_primitives.jpg".format(i + 1), staff_img_color)
-        # open_file("output/staff_{}_primitives.jpg".format(i+1))
 
-        # ------- Sort primitives on staff from left to right -------
+def find_staff_primitives(staffs, i, predict_scale=predict_template_scale,
+                          peaks=extract_peaks, pyramid=coarse_to_fine):
+    """
+    Trova le primitive del pentagramma i e ne ricostruisce le battute.
 
-        staff_primitives.sort(key=lambda primitive: primitive.getBox().getCenter())
+    Legge e modifica solo staffs[i], quindi più pentagrammi possono essere
+    elaborati in parallelo.
+    """
+    print("[INFO] Finding Primitives on Staff ", i + 1)
+    staff_img = staffs[i].getImage()
+    line_spacing = staffs[i].getLineSpacing() if predict_scale else None
+
+    # ------- Find primitives on staff -------
+    print("[INFO] Matching primitive templates on staff", i + 1)
+    primitive_boxes = locate_template_banks(
+        staff_img, [bank for bank, _, _, _ in primitive_classes],
+        line_spacing, peaks=peaks, pyramid=pyramid,
+    )
+
+    # Una tabella di primitive per classe, unite in quella del pentagramma
+    tables = []
+    for bank, text, name, duration in primitive_classes:
+        boxes = merge_boxes(primitive_boxes[bank.getName()], 0.5)
+
+        for box in boxes:
+            staffs[i].addAnnotation("primitive", box, text)
+        if name == "note":
+            pitches = staffs[i].getPitches(np.round(boxes.getCenters()[:, 1]))
+        else:
+            pitches = -1
+        tables.append(PrimitiveTable(boxes, name, duration, pitches))
+    table = PrimitiveTable.concatenate(tables)
 
-        print("[INFO] Staff primitives sorted in time")
-        eighth_flag_indices = []
-        for j in range(len(staff_primitives)):
+    # ------- Sort primitives on staff from left to right -------
 
-            if staff_primitives[j].getPrimitive() == "eighth_flag":
-                # Find all eighth flags
-                eighth_flag_indices.append(j)
+    staff_primitives = [table[j] for j in table.getSortedOrder().tolist()]
 
-            if staff_primitives[j].getPrimitive() == "note":
-                print(staff_primitives[j].getPitch(), end=", ")
-            else:
-                print(staff_primitives[j].getPrimitive(), end=", ")
+    print("[INFO] Staff primitives sorted in time")
+    eighth_flag_indices = []
+    for j in range(len(staff_primitives)):
 
-        print("\n")
+        if staff_primitives[j].getPrimitive() == "eighth_flag":
+            # Find all eighth flags
+            eighth_flag_indices.append(j)
+
+        if staff_primitives[j].getPrimitive() == "note":
+            print(staff_primitives[j].getPitch(), end=", ")
+        else:
+            print(staff_primitives[j].getPrimitive(), end=", ")
+
+    print("\n")
 
-        # ------- Correct for eighth notes -------
-        print("[INFO] Correcting for misclassified eighth notes")
-        # Sort out eighth flags
-        # Assign to closest note
-        for j in eighth_flag_indices:
+    # ------- Correct for eighth notes -------
+    print("[INFO] Correcting for misclassified eighth notes")
+    # Sort out eighth flags
+    # Assign to closest note
+    for j in eighth_flag_indices:
 
-            distances = []
+        distances = []
+        distance = (
+            staff_primitives[j].getBox().distance(staff_primitives[j - 1].getBox())
+        )
+        distances.append(distance)
+        if j + 1 < len(staff_primitives):
             distance = (
-                staff_primitives[j].getBox().distance(staff_primitives[j - 1].getBox())
+                staff_primitives[j]
+                .getBox()
+                .distance(staff_primitives[j + 1].getBox())
             )
             distances.append(distance)
-            if j + 1 < len(staff_primitives):
-                distance = (
-                    staff_primitives[j]
-                    .getBox()
-                    .distance(staff_primitives[j + 1].getBox())
-                )
-                distances.append(distance)
 
-            if distances[1] and distances[0] > distances[1]:
+        if distances[1] and distances[0] > distances[1]:
+            staff_primitives[j + 1].setDuration(0.5)
+        else:
+            staff_primitives[j - 1].setDuration(0.5)
+
+        print(
+            "[INFO] Primitive {} was a eighth note misclassified as a quarter note".format(
+                j + 1
+            )
+        )
+        del staff_primitives[j]
+
+    # Correct for beamed eighth notes
+    # If number of pixels in center row of two notes
+    # greater than 5 * line_width, then notes are
+    # beamed
+    for j in range(len(staff_primitives)):
+        if (
+            j + 1 < len(staff_primitives)
+            and staff_primitives[j].getPrimitive() == "note"
+            and staff_primitives[j + 1].getPrimitive() == "note"
+            and (
+                staff_primitives[j].getDuration() == 1
+                or staff_primitives[j].getDuration() == 0.5
+            )
+            and staff_primitives[j + 1].getDuration() == 1
+        ):
+
+            # Notes of interest
+            note_1_center_x = staff_primitives[j].getBox().getCenter()[0]
+            note_2_center_x = staff_primitives[j + 1].getBox().getCenter()[0]
+
+            # Regular number of black pixels in staff column
+            num_black_pixels = 5 * staffs[i].getLineWidth()
+
+            # Actual number of black pixels in mid column
+            center_column = (note_2_center_x - note_1_center_x) // 2
+            mid_col = staff_img[:, int(note_1_center_x + center_column)]
+            num_black_pixels_mid = len(np.where(mid_col == 0)[0])
+
+            if num_black_pixels_mid > num_black_pixels:
+                # Notes beamed
+                # Make eighth note length
+                staff_primitives[j].setDuration(0.5)
                 staff_primitives[j + 1].setDuration(0.5)
-            else:
-                staff_primitives[j - 1].setDuration(0.5)
+                print(
+                    "[INFO] Primitive {} and {} were eighth notes misclassified as quarter notes".format(
+                        j + 1, j + 2
+                    )
+                )
+
+    # ------- Account for Key Signature -------
+    print("[INFO] Applying key signature note value changes")
+    num_sharps = 0
+    num_flats = 0
+    j = 0
+    while j < len(staff_primitives) and staff_primitives[j].getDuration() == 0:
+        accidental = staff_primitives[j].getPrimitive()
+        if accidental == "sharp":
+            num_sharps += 1
+            j += 1
+
+        elif accidental == "flat":
+            num_flats += 1
+            j += 1
+
+        else:
+            # Un simbolo diverso da un'alterazione chiude l'armatura di chiave
+            break
+
+    # Check if last accidental belongs to note
 
+    if j != 0 and j < len(staff_primitives):
+        # Determine if accidental coupled with first note
+        # Center of accidental should be within a note width from note
+        max_accidental_offset_x = (
+            staff_primitives[j].getBox().getCenter()[0]
+            - staff_primitives[j].getBox().getWidth()
+        )
+        accidental_center_x = staff_primitives[j - 1].getBox().getCenter()[0]
+        accidental_type = staff_primitives[j - 1].getPrimitive()
+
+        if accidental_center_x > max_accidental_offset_x:
+            print("[INFO] Last accidental belongs to first note")
+            num_sharps = (
+                num_sharps - 1 if accidental_type == "sharp" else num_sharps
+            )
+            num_flats = num_flats - 1 if accidental_type == "flat" else num_flats
+
+        # Modify notes in staff
+        # notes_to_modify = []
+        if accidental_type == "sharp":
             print(
-                "[INFO] Primitive {} was a eighth note misclassified as a quarter note".format(
-                    j + 1
-                )
+                "[INFO] Key signature has {} sharp accidentals: ".format(num_sharps)
             )
-            del staff_primitives[j]
+            # notes_to_modify = key_signature_changes[accidental_type][num_sharps]
+            # Remove accidentals from primitive list
+            staff_primitives = staff_primitives[num_sharps:]
+        else:
+            print(
+                "[INFO] Key signature has {} flat accidentals: ".format(num_flats)
+            )
+            # notes_to_modify = key_signature_changes[accidental_type][num_flats]
+            # Remove accidentals from primitive list
+            staff_primitives = staff_primitives[num_flats:]
+
+        print("[INFO] Corrected note values after key signature: ")
+        for primitive in staff_primitives:
+            # type = primitive.getPrimitive()
+            # note = primitive.getPitch()
+            # if (type == "note" and note[0] in notes_to_modify):
+            # new_note = MIDI_to_pitch[pitch_to_MIDI[note] + 1] if accidental_type == "sharp" else MIDI_to_pitch[pitch_to_MIDI[note] - 1]
+            # primitive.setPitch(new_note)
+
+            if primitive.getPrimitive() == "note":
+                print(primitive.getPitch(), end=", ")
+            else:
+                print(primitive.getPrimitive(), end=", ")
 
-        # Correct for beamed eighth notes
-        # If number of pixels in center row of two notes
-        # greater than 5 * line_width, then notes are
-        # beamed
-        for j in range(len(staff_primitives)):
-            if (
-                j + 1 < len(staff_primitives)
-                and staff_primitives[j].getPrimitive() == "note"
-                and staff_primitives[j + 1].getPrimitive() == "note"
-                and (
-                    staff_primitives[j].getDuration() == 1
-                    or staff_primitives[j].getDuration() == 0.5
-                )
-                and staff_primitives[j + 1].getDuration() == 1
-            ):
+        print("\n")
 
-                # Notes of interest
-                note_1_center_x = staff_primitives[j].getBox().getCenter()[0]
-                note_2_center_x = staff_primitives[j + 1].getBox().getCenter()[0]
-
-                # Regular number of black pixels in staff column
-                num_black_pixels = 5 * staffs[i].getLineWidth()
-
-                # Actual number of black pixels in mid column
-                center_column = (note_2_center_x - note_1_center_x) // 2
-                mid_col = staff_img[:, int(note_1_center_x + center_column)]
-                num_black_pixels_mid = len(np.where(mid_col == 0)[0])
-
-                if num_black_pixels_mid > num_black_pixels:
-                    # Notes beamed
-                    # Make eighth note length
-                    staff_primitives[j].setDuration(0.5)
-                    staff_primitives[j + 1].setDuration(0.5)
-                    print(
-                        "[INFO] Primitive {} and {} were eighth notes misclassified as quarter notes".format(
-                            j + 1, j + 2
-                        )
-                    )
+    # ------- Apply Sharps and Flats -------
+    print("[INFO] Applying any accidental to neighboring note")
+    primitive_indices_to_remove = []
+    for j in range(len(staff_primitives)):
+        accidental_type = staff_primitives[j].getPrimitive()
 
-        # ------- Account for Key Signature -------
-        print("[INFO] Applying key signature note value changes")
-        num_sharps = 0
-        num_flats = 0
-        j = 0
-        while staff_primitives[j].getDuration() == 0:
-            accidental = staff_primitives[j].getPrimitive()
-            if accidental == "sharp":
-                num_sharps += 1
-                j += 1
-
-            elif accidental == "flat":
-                num_flats += 1
-                j += 1
-
-        # Check if last accidental belongs to note
-
-        if j != 0:
-            # Determine if accidental coupled with first note
-            # Center of accidental should be within a note width from note
+        if accidental_type == "flat" or accidental_type == "sharp":
             max_accidental_offset_x = (
-                staff_primitives[j].getBox().getCenter()[0]
-                - staff_primitives[j].getBox().getWidth()
+                staff_primitives[j + 1].getBox().getCenter()[0]
+                - staff_primitives[j + 1].getBox().getWidth()
             )
-            accidental_center_x = staff_primitives[j - 1].getBox().getCenter()[0]
-            accidental_type = staff_primitives[j - 1].getPrimitive()
+            accidental_center_x = staff_primitives[j].getBox().getCenter()[0]
+            primitive_type = staff_primitives[j + 1].getPrimitive()
 
-            if accidental_center_x > max_accidental_offset_x:
-                print("[INFO] Last accidental belongs to first note")
-                num_sharps = (
-                    num_sharps - 1 if accidental_type == "sharp" else num_sharps
-                )
-                num_flats = num_flats - 1 if accidental_type == "flat" else num_flats
-
-            # Modify notes in staff
-            # notes_to_modify = []
-            if accidental_type == "sharp":
-                print(
-                    "[INFO] Key signature has {} sharp accidentals: ".format(num_sharps)
-                )
-                # notes_to_modify = key_signature_changes[accidental_type][num_sharps]
-                # Remove accidentals from primitive list
-                staff_primitives = staff_primitives[num_sharps:]
-            else:
-                print(
-                    "[INFO] Key signature has {} flat accidentals: ".format(num_flats)
-                )
-                # notes_to_modify = key_signature_changes[accidental_type][num_flats]
-                # Remove accidentals from primitive list
-                staff_primitives = staff_primitives[num_flats:]
-
-            print("[INFO] Corrected note values after key signature: ")
-            for primitive in staff_primitives:
-                # type = primitive.getPrimitive()
-                # note = primitive.getPitch()
-                # if (type == "note" and note[0] in notes_to_modify):
+            if (
+                accidental_center_x > max_accidental_offset_x
+                and primitive_type == "note"
+            ):
+                print("Primitive has accidental associated with it")
+                # note = staff_primitives[j + 1].getPitch()
                 # new_note = MIDI_to_pitch[pitch_to_MIDI[note] + 1] if accidental_type == "sharp" else MIDI_to_pitch[pitch_to_MIDI[note] - 1]
-                # primitive.setPitch(new_note)
+                # staff_primitives[j+1].setPitch(new_note)
+                primitive_indices_to_remove.append(i)
 
-                if primitive.getPrimitive() == "note":
-                    print(primitive.getPitch(), end=", ")
-                else:
-                    print(primitive.getPrimitive(), end=", ")
+    # Removed actioned accidentals
+    for j in primitive_indices_to_remove:
+        del staff_primitives[j]
 
-            print("\n")
+    print("[INFO] Corrected note values after accidentals: ")
+    for j in range(len(staff_primitives)):
+        if staff_primitives[j].getPrimitive() == "note":
+            print(staff_primitives[j].getPitch(), end=", ")
+        else:
+            print(staff_primitives[j].getPrimitive(), end=", ")
 
-        # ------- Apply Sharps and Flats -------
-        print("[INFO] Applying any accidental to neighboring note")
-        primitive_indices_to_remove = []
-        for j in range(len(staff_primitives)):
-            accidental_type = staff_primitives[j].getPrimitive()
+    print("\n")
 
-            if accidental_type == "flat" or accidental_type == "sharp":
-                max_accidental_offset_x = (
-                    staff_primitives[j + 1].getBox().getCenter()[0]
-                    - staff_primitives[j + 1].getBox().getWidth()
-                )
-                accidental_center_x = staff_primitives[j].getBox().getCenter()[0]
-                primitive_type = staff_primitives[j + 1].getPrimitive()
-
-                if (
-                    accidental_center_x > max_accidental_offset_x
-                    and primitive_type == "note"
-                ):
-                    print("Primitive has accidental associated with it")
-                    # note = staff_primitives[j + 1].getPitch()
-                    # new_note = MIDI_to_pitch[pitch_to_MIDI[note] + 1] if accidental_type == "sharp" else MIDI_to_pitch[pitch_to_MIDI[note] - 1]
-                    # staff_primitives[j+1].setPitch(new_note)
-                    primitive_indices_to_remove.append(i)
-
-        # Removed actioned accidentals
-        for j in primitive_indices_to_remove:
-            del staff_primitives[j]
-
-        print("[INFO] Corrected note values after accidentals: ")
-        for j in range(len(staff_primitives)):
-            if staff_primitives[j].getPrimitive() == "note":
-                print(staff_primitives[j].getPitch(), end=", ")
-            else:
-                print(staff_primitives[j].getPrimitive(), end=", ")
+    # ------- Assemble Staff -------
 
-        print("\n")
+    print("[INFO] Assembling current staff")
+    bar = Bar()
+    while len(staff_primitives) > 0:
+        primitive = staff_primitives.pop(0)
+
+        if primitive.getPrimitive() != "line":
+            bar.addPrimitive(primitive)
+        else:
+            staffs[i].addBar(bar)
+            bar = Bar()
+    # Add final bar in staff
+    staffs[i].addBar(bar)
 
-        # ------- Assemble Staff -------
 
-        print("[INFO] Assembling current staff")
-        bar = Bar()
-        while len(staff_primitives) > 0:
-            primitive = staff_primitives.pop(0)
+def find_primitive(staffs, predict_scale=predict_template_scale, peaks=extract_peaks,
+                   pyramid=coarse_to_fine, workers=None):
+    """
+    Trova le primitive musicali in un pentagramma.
 
-            if primitive.getPrimitive() != "line":
-                bar.addPrimitive(primitive)
-            else:
-                staffs[i].addBar(bar)
-                bar = Bar()
-        # Add final bar in staff
-        staffs[i].addBar(bar)
+    Args:
+        staffs: Lista di oggetti Staff che rappresentano i pentagrammi
+        predict_scale: Se True limita la ricerca alle scale previste dall'interlinea
+        peaks: Se True mantiene solo i massimi locali della correlazione
+        pyramid: Se True usa la ricerca coarse-to-fine
+        workers: Numero massimo di pentagrammi elaborati in parallelo
+            (None = staff_workers)
+
+    Returns:
+        La lista staffs, con le battute e le annotazioni di ogni pentagramma
+    """
+    map_staffs(
+        lambda i: find_staff_primitives(staffs, i, predict_scale, peaks, pyramid),
+        len(staffs), workers,
+    )
 
-    return staffs, staff_imgs_color
+    return staffs
@@ -0,0 +1,111 @@
+"""
+Eventi di avanzamento dei lavori del server.
+
+Ogni lavoro ha un registro in memoria degli eventi pubblicati dalla pipeline
+(cambi di stato, fasi completate di ogni pagina, pagine completate): i client
+collegati a /process/<job_id>/events li ricevono appena vengono pubblicati,
+e chi si collega o si ricollega più tardi riceve prima quelli già pubblicati.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# Registri conservati in memoria: oltre il limite vengono scartati quelli dei
+# lavori terminati da più tempo
+max_event_logs = 256
+
+# Secondi di attesa senza eventi dopo cui lo stream invia un heartbeat, così
+# proxy e client non chiudono la connessione
+event_heartbeat_interval = 15
+
+# Eventi che concludono il registro di un lavoro
+final_events = ("completed", "failed", "cancelled")
+
+
+class JobEvents(object):
+    """
+    Registro degli eventi di un lavoro.
+
+    Ogni evento ha un id progressivo (da 1), il tipo e il tempo trascorso
+    dall'inizio dell'elaborazione (elapsed, in secondi; 0 prima dell'inizio).
+    """
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.events = []
+        self.started = None
+        self.finished = False
+        self.condition = threading.Condition()
+
+    def publish(self, event_type, **data):
+        """Aggiunge un evento e risveglia i client in attesa"""
+        with self.condition:
+            now = time.monotonic()
+            if event_type == "processing":
+                self.started = now
+            event = {
+                "id": len(self.events) + 1,
+                "event": event_type,
+                "job_id": self.job_id,
+                "elapsed": round(now - self.started, 3) if self.started is not None else 0.0,
+            }
+            event.update(data)
+            self.events.append(event)
+            if event_type in final_events:
+                self.finished = True
+            self.condition.notify_all()
+        return event
+
+    def isFinished(self):
+        return self.finished
+
+    def iterEvents(self, after=0, heartbeat=event_heartbeat_interval):
+        """
+        Produce gli eventi con id maggiore di after, attendendo quelli nuovi
+        finché il lavoro non termina. Dopo heartbeat secondi senza eventi
+        produce None (il chiamante invia un heartbeat).
+        """
+        while True:
+            with self.condition:
+                if len(self.events) <= after and not self.finished:
+                    self.condition.wait(heartbeat)
+                pending = self.events[after:]
+                finished = self.finished
+            if not pending:
+                if finished:
+                    return
+                yield None
+                continue
+            for event in pending:
+                yield event
+            after += len(pending)
+
+
+class JobEventRegistry(object):
+    """Registri degli eventi dei lavori, limitati a max_logs"""
+    def __init__(self, max_logs=max_event_logs):
+        self.max_logs = max_logs
+        self.logs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def create(self, job_id):
+        """Crea (o sostituisce) il registro di un lavoro"""
+        with self.lock:
+            self.logs[job_id] = JobEvents(job_id)
+            self.logs.move_to_end(job_id)
+            # Scarta i registri più vecchi, preferendo quelli dei lavori terminati
+            while len(self.logs) > self.max_logs:
+                for key, log in self.logs.items():
+                    if log.isFinished():
+                        del self.logs[key]
+                        break
+                else:
+                    self.logs.popitem(last=False)
+            return self.logs[job_id]
+
+    def get(self, job_id):
+        with self.lock:
+            return self.logs.get(job_id)
+
+    def remove(self, job_id):
+        with self.lock:
+            return self.logs.pop(job_id, None)
@@ -0,0 +1,197 @@
+"""
+Indice persistente dei lavori del server su SQLite.
+
+metadata.json di ogni lavoro resta la fonte dei dati: l'indice ne conserva i
+campi usati per elencare, filtrare e ordinare i lavori, viene aggiornato a ogni
+salvataggio dei metadati e può essere ricostruito in qualsiasi momento
+rileggendo i file.
+"""
+import base64
+import json
+import os
+import sqlite3
+import threading
+
+# Percorso del database dell'indice (accanto ai risultati dei lavori)
+job_index_path = os.environ.get("JOB_INDEX_PATH", os.path.join("output", ".jobs.sqlite"))
+
+# Numero di lavori restituiti per pagina (predefinito e massimo)
+jobs_page_size = 50
+jobs_max_page_size = 500
+
+# Campi di ordinamento ammessi e relative espressioni SQL (senza NULL, così il
+# confronto con il cursore è sempre definito)
+sort_expressions = {
+    "uploaded_at": "uploaded_at",
+    "completed_at": "COALESCE(completed_at, '')",
+    "filename": "filename",
+    "staffs_detected": "staffs_detected",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL DEFAULT '',
+    uploaded_at TEXT NOT NULL DEFAULT '',
+    completed_at TEXT,
+    staffs_detected INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_uploaded ON jobs (uploaded_at, job_id);
+CREATE INDEX IF NOT EXISTS jobs_status_uploaded ON jobs (status, uploaded_at, job_id);
+CREATE INDEX IF NOT EXISTS jobs_completed ON jobs (COALESCE(completed_at, ''), job_id);
+"""
+
+COLUMNS = ("job_id", "filename", "status", "uploaded_at", "completed_at", "staffs_detected")
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decodifica un cursore di paginazione; ValueError se non è valido"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Cursore non valido")
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError("Cursore non valido")
+    return values
+
+
+class JobIndex(object):
+    """
+    Indice dei lavori: una riga per lavoro con stato, date, nome del file e
+    numero di pentagrammi rilevati.
+
+    La connessione è condivisa dai thread del server e protetta da un lock.
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(SCHEMA)
+
+    def rowFromMetadata(self, metadata):
+        return (
+            metadata["job_id"],
+            metadata.get("filename") or "",
+            metadata.get("status") or "",
+            metadata.get("uploaded_at") or "",
+            metadata.get("completed_at"),
+            (metadata.get("result") or {}).get("staffs_detected", 0),
+        )
+
+    def update(self, metadata):
+        """Inserisce o aggiorna la riga di un lavoro dai suoi metadati"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)",
+                self.rowFromMetadata(metadata),
+            )
+
+    def remove(self, job_id):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def rebuild(self, output_folder):
+        """
+        Ricostruisce l'indice dai metadata.json delle directory dei lavori
+
+        Returns:
+            Numero di lavori indicizzati
+        """
+        rows = []
+        if os.path.exists(output_folder):
+            for job_dir in os.listdir(output_folder):
+                metadata_path = os.path.join(output_folder, job_dir, "metadata.json")
+                if not os.path.exists(metadata_path):
+                    continue
+                try:
+                    with open(metadata_path, "r") as f:
+                        rows.append(self.rowFromMetadata(json.load(f)))
+                except Exception as e:
+                    print(f"Errore nel leggere i metadati per {job_dir}: {e}")
+
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM jobs")
+            self.connection.executemany("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def query(self, statuses=None, uploaded_after=None, uploaded_before=None,
+              sort="uploaded_at", descending=True, limit=jobs_page_size, cursor=None):
+        """
+        Restituisce una pagina di lavori filtrati e ordinati
+
+        La paginazione usa un cursore (valore del campo di ordinamento e job_id
+        dell'ultimo lavoro della pagina): le pagine successive restano corrette
+        anche se nel frattempo vengono aggiunti o eliminati lavori.
+
+        Args:
+            statuses: Stati ammessi (None = tutti)
+            uploaded_after, uploaded_before: Limiti (ISO 8601, inclusi) sulla data di caricamento
+            sort: Campo di ordinamento (chiave di sort_expressions)
+            descending: Ordine decrescente
+            limit: Lavori per pagina (al più jobs_max_page_size)
+            cursor: Cursore restituito dalla pagina precedente
+
+        Returns:
+            Tripla (lavori come dict, totale dei lavori filtrati, cursore della
+            pagina successiva o None)
+        """
+        if sort not in sort_expressions:
+            raise ValueError(f"Ordinamento non supportato: {sort}")
+        expression = sort_expressions[sort]
+        limit = max(1, min(limit, jobs_max_page_size))
+
+        conditions = []
+        params = []
+        if statuses:
+            conditions.append(f"status IN ({', '.join('?' for _ in statuses)})")
+            params.extend(statuses)
+        if uploaded_after:
+            conditions.append("uploaded_at >= ?")
+            params.append(uploaded_after)
+        if uploaded_before:
+            # Una data senza ora comprende l'intera giornata
+            if len(uploaded_before) == 10:
+                uploaded_before += "T23:59:59.999999"
+            conditions.append("uploaded_at <= ?")
+            params.append(uploaded_before)
+        filters = " AND ".join(conditions) or "1"
+
+        page_conditions = list(conditions)
+        page_params = list(params)
+        if cursor is not None:
+            page_conditions.append(f"({expression}, job_id) {'<' if descending else '>'} (?, ?)")
+            page_params.extend(decode_cursor(cursor))
+        order = "DESC" if descending else "ASC"
+
+        with self.lock:
+            total = self.connection.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE {filters}", params
+            ).fetchone()[0]
+            rows = self.connection.execute(
+                f"SELECT {', '.join(COLUMNS)}, {expression} FROM jobs "
+                f"WHERE {' AND '.join(page_conditions) or '1'} "
+                f"ORDER BY {expression} {order}, job_id {order} LIMIT ?",
+                page_params + [limit + 1],
+            ).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = encode_cursor([last[-1], last[0]])
+        jobs = [dict(zip(COLUMNS, row[:len(COLUMNS)])) for row in rows]
+        return jobs, total, next_cursor
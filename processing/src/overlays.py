@@ -0,0 +1,234 @@
+"""
+Immagini di debug dei risultati (pentagrammi, chiavi, tempi e primitive).
+
+Il rilevamento (src.detection) non disegna nulla: registra i simboli trovati
+come annotazioni dei pentagrammi (tipo, box con punteggio ed etichetta) e le
+immagini vengono disegnate qui solo quando servono, dagli oggetti Staff
+oppure dai risultati salvati.
+
+Le immagini vengono disegnate dai risultati del rilevamento salvati in
+detections.json e dalla pagina binarizzata salvata senza compressione
+(binarized.npy, un bit per pixel): per questo non devono essere codificate
+durante l'elaborazione, ma possono essere prodotte quando servono.
+
+Livelli degli artefatti:
+    none: nessun file oltre ai risultati del lavoro
+    summary: detections.json e binarized.npy; le immagini di debug vengono
+        disegnate alla prima richiesta
+    debug: tutte le immagini JPEG (originale, denoised, binarized, pentagrammi
+        e primitive) scritte durante l'elaborazione
+"""
+import json
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from src.box import BoundingBox
+
+artifact_levels = ("none", "summary", "debug")
+
+# Livello degli artefatti del server (ogni richiesta può sceglierne un altro)
+artifact_level = os.environ.get("ARTIFACT_LEVEL", "summary")
+
+detections_filename = "detections.json"
+binarized_filename = "binarized.npy"
+
+overlay_color = (0, 0, 255)
+overlay_box_thickness = 2
+overlay_font = cv2.FONT_HERSHEY_DUPLEX
+
+
+def to_number(value):
+    """Converte gli scalari numpy in numeri Python (serializzabili in JSON)"""
+    return value.item() if hasattr(value, "item") else value
+
+
+def box_to_list(box):
+    return [to_number(box.x), to_number(box.y), to_number(box.w), to_number(box.h)]
+
+
+def draw_annotation(img, kind, box, label):
+    """
+    Disegna il box di un simbolo rilevato e la sua etichetta
+
+    Args:
+        img: Immagine a colori su cui disegnare
+        kind: "staff", "clef", "time" o "primitive" (posizione dell'etichetta)
+        box: BoundingBox del simbolo
+        label: Testo dell'etichetta
+    """
+    box.draw(img, overlay_color, overlay_box_thickness)
+    corner_x, corner_y = box.getCorner()
+    if kind == "primitive":
+        textsize = cv2.getTextSize(label, overlay_font, fontScale=0.7, thickness=1)[0]
+        x = int(corner_x - (textsize[0] // 2))
+        y = int(corner_y + box.getHeight() + 20)
+        cv2.putText(img, label, (x, y), overlay_font, fontScale=0.7, color=overlay_color, thickness=1)
+        return
+    if kind == "staff":
+        x = int(corner_x + (box.getWidth() // 2))
+        y = int(corner_y + box.getHeight() + 35)
+    elif kind == "clef":
+        x = int(corner_x + (box.getWidth() // 2))
+        y = int(corner_y + box.getHeight() + 10)
+    else:
+        x = int(corner_x - (box.getWidth() // 2))
+        y = int(corner_y + box.getHeight() + 20)
+    cv2.putText(img, label, (x, y), overlay_font, 0.9, overlay_color)
+
+
+def staff_detections(staffs):
+    """Risultati del rilevamento dei pentagrammi come dati serializzabili in JSON"""
+    detections = []
+    for staff in staffs:
+        origin_x, origin_y = staff.getImageOrigin()
+        staff_img = staff.getImage()
+        detections.append(
+            {
+                "box": box_to_list(staff.getBox()),
+                "image_origin": [to_number(origin_x), to_number(origin_y)],
+                "image_size": [staff_img.shape[1], staff_img.shape[0]],
+                "clef": staff.getClef(),
+                "time_signature": staff.getTimeSignature(),
+                "annotations": [
+                    {
+                        "kind": kind,
+                        "box": box_to_list(box),
+                        "score": to_number(box.getScore()),
+                        "label": label,
+                    }
+                    for kind, box, label in staff.getAnnotations()
+                ],
+                "bars": [
+                    [
+                        {
+                            "primitive": primitive.getPrimitive(),
+                            "duration": primitive.getDuration(),
+                            "pitch": primitive.getPitch(),
+                            "box": box_to_list(primitive.getBox()),
+                            "score": to_number(primitive.getBox().getScore()),
+                        }
+                        for primitive in bar.getPrimitives()
+                    ]
+                    for bar in staff.getBars()
+                ],
+            }
+        )
+    return detections
+
+
+def save_detections(img_output_dir, binarized_img, staffs, **info):
+    """
+    Salva i risultati del rilevamento e la pagina binarizzata (un bit per
+    pixel, senza codifica) da cui disegnare le immagini di debug
+    """
+    height, width = binarized_img.shape[:2]
+    np.save(os.path.join(img_output_dir, binarized_filename), np.packbits(binarized_img > 0))
+    detections = {"width": width, "height": height}
+    detections.update({key: to_number(value) for key, value in info.items()})
+    detections["staffs"] = staff_detections(staffs)
+    with open(os.path.join(img_output_dir, detections_filename), "w") as f:
+        json.dump(detections, f)
+
+
+def load_detections(img_output_dir):
+    with open(os.path.join(img_output_dir, detections_filename), "r") as f:
+        return json.load(f)
+
+
+def load_binarized(img_output_dir, detections):
+    bits = np.load(os.path.join(img_output_dir, binarized_filename))
+    height, width = detections["height"], detections["width"]
+    return np.unpackbits(bits, count=height * width).reshape(height, width) * np.uint8(255)
+
+
+def draw_detected_staffs(binarized_img, boxes):
+    """Pagina binarizzata con i box dei pentagrammi"""
+    img = cv2.cvtColor(binarized_img, cv2.COLOR_GRAY2RGB)
+    for box in boxes:
+        draw_annotation(img, "staff", box, "Staff")
+    return img
+
+
+def draw_annotations(staff_img, annotations):
+    """Copia a colori di staff_img con le annotazioni (kind, box, label)"""
+    img = cv2.cvtColor(staff_img, cv2.COLOR_GRAY2RGB)
+    for kind, box, label in annotations:
+        draw_annotation(img, kind, box, label)
+    return img
+
+
+def draw_staff_annotations(staff):
+    """Immagine di un oggetto Staff con i simboli rilevati"""
+    return draw_annotations(staff.getImage(), staff.getAnnotations())
+
+
+def draw_staff(binarized_img, staff):
+    """Immagine di un pentagramma (dai dati di staff_detections) con i simboli rilevati"""
+    x, y = staff["image_origin"]
+    width, height = staff["image_size"]
+    return draw_annotations(
+        binarized_img[y:y + height, x:x + width],
+        [
+            (annotation["kind"], BoundingBox(*annotation["box"]), annotation["label"])
+            for annotation in staff["annotations"]
+        ],
+    )
+
+
+def lazy_images(img_output_dir):
+    """
+    Immagini che possono essere disegnate dai risultati salvati in
+    img_output_dir, con le loro dimensioni: {nome: (larghezza, altezza)}
+    """
+    if not (
+        os.path.exists(os.path.join(img_output_dir, detections_filename))
+        and os.path.exists(os.path.join(img_output_dir, binarized_filename))
+    ):
+        return {}
+    detections = load_detections(img_output_dir)
+    page_size = (detections["width"], detections["height"])
+    images = {"binarized.jpg": page_size, "detected_staffs.jpg": page_size}
+    for i, staff in enumerate(detections["staffs"]):
+        images[f"staff_{i + 1}_primitives.jpg"] = tuple(staff["image_size"])
+    return images
+
+
+def render_image(img_output_dir, name):
+    """
+    Disegna e salva l'immagine name dai risultati salvati in img_output_dir
+
+    Returns:
+        Percorso dell'immagine, None se name non si può disegnare
+    """
+    if name not in lazy_images(img_output_dir):
+        return None
+    detections = load_detections(img_output_dir)
+    binarized_img = load_binarized(img_output_dir, detections)
+    if name == "binarized.jpg":
+        img = binarized_img
+    elif name == "detected_staffs.jpg":
+        boxes = [BoundingBox(*staff["box"]) for staff in detections["staffs"]]
+        img = draw_detected_staffs(binarized_img, boxes)
+    else:
+        index = int(name[len("staff_"):-len("_primitives.jpg")]) - 1
+        img = draw_staff(binarized_img, detections["staffs"][index])
+
+    # Scrittura atomica con un nuovo file: non sovrascrive mai un file esistente,
+    # che potrebbe essere condiviso con la cache dei risultati
+    path = os.path.join(img_output_dir, name)
+    tmp_path = f"{path}.tmp-{threading.get_ident()}.jpg"
+    cv2.imwrite(tmp_path, img)
+    os.replace(tmp_path, path)
+    return path
+
+
+def render_missing_images(output_dir):
+    """Disegna tutte le immagini non ancora prodotte sotto output_dir"""
+    for root, dirs, files in os.walk(output_dir):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in lazy_images(root):
+            if name not in files:
+                render_image(root, name)
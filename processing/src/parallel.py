@@ -0,0 +1,207 @@
+"""
+Modulo per l'elaborazione in parallelo delle pagine di uno spartito.
+Le pagine vengono distribuite su un pool di processi condiviso da tutte le
+richieste: ogni processo carica i template una sola volta all'avvio e ne
+conserva le cache per tutte le pagine che elabora.
+
+I processi non vengono creati con fork: il server li avvia mentre altri thread
+(coda dei lavori, Flask) possono tenere dei lock, che il figlio erediterebbe
+bloccati. Con forkserver i processi nascono da un processo server
+senza thread che ha già caricato i template.
+"""
+import copy
+import itertools
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from src import detection
+
+# Numero massimo di pagine elaborate in parallelo (1 = in sequenza nel processo corrente)
+page_workers = int(os.environ.get("PAGE_WORKERS", os.cpu_count() or 1))
+
+# Pagine inviate al pool per ogni processo prima di attendere un risultato: limita
+# la memoria quando le pagine vengono prodotte da un generatore
+pages_in_flight_per_worker = 2
+
+# Metodo di avvio dei processi del pool ("forkserver" o "spawn"); dove forkserver
+# non è disponibile (Windows) viene usato spawn
+page_pool_start_method = os.environ.get("PAGE_POOL_START_METHOD", "forkserver")
+
+# Pool di processi creato al primo utilizzo e riutilizzato dalle richieste successive
+page_pool = None
+page_pool_workers = 0
+page_pool_lock = threading.Lock()
+# Numero di chiamate di map_pages in corso per ogni pool: un pool sostituito
+# viene chiuso solo quando l'ultima chiamata che lo usa ha terminato
+page_pool_users = {}
+
+# Processo che ospita le code tra il server e i processi del pool (vedi
+# page_event_queue), creato al primo utilizzo
+page_event_manager = None
+
+
+def init_page_worker(staff_workers):
+    """
+    Inizializza un processo del pool.
+
+    I template vengono letti all'importazione di src.detection, quindi una sola
+    volta per processo. I core vengono divisi tra le pagine: ogni processo
+    elabora i propri pentagrammi con al più staff_workers thread.
+    """
+    detection.staff_workers = staff_workers
+
+
+def page_pool_context():
+    """Contesto multiprocessing dei processi del pool (vedi page_pool_start_method)"""
+    method = page_pool_start_method
+    if method not in multiprocessing.get_all_start_methods():
+        method = "spawn"
+    context = multiprocessing.get_context(method)
+    if method == "forkserver":
+        # Il processo server importa i template una volta sola e i processi del
+        # pool li ereditano. Il modulo principale non viene precaricato: il suo
+        # codice di primo livello (ad esempio quello di server.py) verrebbe
+        # eseguito di nuovo nel processo server
+        context.set_forkserver_preload(["src.detection"])
+    return context
+
+
+def page_event_queue():
+    """
+    Nuova coda condivisa con i processi del pool, ad esempio per riportare le
+    fasi di una pagina mentre viene elaborata. La coda si può passare a func
+    di map_pages (anche dentro un functools.partial).
+    """
+    global page_event_manager
+    with page_pool_lock:
+        if page_event_manager is None:
+            page_event_manager = page_pool_context().Manager()
+        return page_event_manager.Queue()
+
+
+def retire_page_pool():
+    """Scarta il pool condiviso; va chiamata con page_pool_lock acquisito"""
+    global page_pool, page_pool_workers
+    if page_pool is not None and page_pool not in page_pool_users:
+        page_pool.shutdown(wait=False)
+    page_pool = None
+    page_pool_workers = 0
+
+
+def acquire_page_pool(workers):
+    """
+    Restituisce il pool di processi condiviso, creandolo con workers processi se
+    necessario, e lo registra come in uso fino a release_page_pool.
+
+    Se il pool esistente ha un numero diverso di processi viene sostituito: le
+    chiamate che lo stanno usando continuano a inviargli pagine e il pool viene
+    chiuso dall'ultima di esse.
+    """
+    global page_pool, page_pool_workers
+    with page_pool_lock:
+        if page_pool is None or page_pool_workers != workers:
+            retire_page_pool()
+            staff_workers = max(1, (os.cpu_count() or 1) // workers)
+            page_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=page_pool_context(),
+                initializer=init_page_worker,
+                initargs=(staff_workers,),
+            )
+            page_pool_workers = workers
+        page_pool_users[page_pool] = page_pool_users.get(page_pool, 0) + 1
+        return page_pool
+
+
+def release_page_pool(pool):
+    """Segnala che una chiamata ha finito di usare pool; chiude il pool se è stato sostituito"""
+    with page_pool_lock:
+        page_pool_users[pool] -= 1
+        if page_pool_users[pool] == 0:
+            del page_pool_users[pool]
+            if pool is not page_pool:
+                pool.shutdown(wait=False)
+
+
+def reset_page_pool(pool):
+    """
+    Scarta il pool condiviso se è ancora pool (ad esempio dopo la terminazione
+    anomala di un processo); se è già stato sostituito non fa nulla
+    """
+    with page_pool_lock:
+        if pool is page_pool:
+            retire_page_pool()
+
+
+def map_pages(func, pages, workers=None, callback=None):
+    """
+    Applica func a ogni pagina e restituisce i risultati nell'ordine delle pagine.
+
+    Le pagine vengono lette da pages solo quando servono: con un generatore
+    (ad esempio iter_pdf_pages) nel pool restano al più
+    pages_in_flight_per_worker pagine per processo in attesa di elaborazione.
+
+    Args:
+        func: Funzione di una pagina; deve essere serializzabile con pickle
+            (funzione di modulo o functools.partial di una funzione di modulo)
+        pages: Iterabile delle pagine (percorsi delle immagini o pagine già
+            renderizzate)
+        workers: Numero di processi del pool (None = page_workers); con una sola
+            pagina o un solo processo le pagine vengono elaborate nel processo corrente
+        callback: Funzione opzionale chiamata nel processo corrente con
+            (indice della pagina, risultato) appena il risultato è disponibile,
+            nell'ordine delle pagine (ad esempio per riportare l'avanzamento)
+
+    Returns:
+        Lista dei risultati di func, uno per pagina
+    """
+    if workers is None:
+        workers = page_workers
+    results = []
+
+    def collect(result):
+        if callback is not None:
+            callback(len(results), result)
+        results.append(result)
+
+    if workers <= 1:
+        for page in pages:
+            collect(func(page))
+        return results
+
+    # Il pool serializza le pagine in un thread separato, quando il generatore può
+    # già aver riutilizzato la memoria della pagina: ogni pagina viene copiata
+    # prima di passare alla successiva
+    pages = (copy.deepcopy(page) for page in pages)
+    first = next(pages, None)
+    second = next(pages, None)
+    if second is None:
+        if first is not None:
+            collect(func(first))
+        return results
+
+    # Il pool viene letto una sola volta: se nel frattempo un'altra chiamata lo
+    # sostituisce, questa continua a usare lo stesso fino alla fine
+    pool = acquire_page_pool(workers)
+    max_in_flight = workers * pages_in_flight_per_worker
+    pending = deque()
+    try:
+        for page in itertools.chain((first, second), pages):
+            if len(pending) >= max_in_flight:
+                collect(pending.popleft().result())
+            pending.append(pool.submit(func, page))
+        while pending:
+            collect(pending.popleft().result())
+    except BrokenProcessPool:
+        reset_page_pool(pool)
+        raise
+    finally:
+        # Le pagine non ancora iniziate dopo un errore non servono più
+        for future in pending:
+            future.cancel()
+        release_page_pool(pool)
+    return results
@@ -1,8 +1,43 @@
 import os
 import fitz  # PyMuPDF
-from typing import List
-import io
-from PIL import Image
+import cv2
+import numpy as np
+from typing import Iterator, List, Optional, Tuple
+from src.deskewing import get_ref_lengths
+
+# Salva su disco anche una copia JPG di ogni pagina renderizzata. Disattivato di
+# default: le pagine passano alla pipeline direttamente in memoria
+save_page_snapshots = os.environ.get("SAVE_PAGE_SNAPSHOTS", "false").lower() == "true"
+
+# Le pagine scansionate (una sola immagine che copre la pagina) vengono estratte
+# alla risoluzione nativa invece di essere renderizzate di nuovo
+extract_embedded_images = os.environ.get("EXTRACT_EMBEDDED_IMAGES", "true").lower() == "true"
+
+# Frazione minima dell'area della pagina che l'immagine incorporata deve coprire
+embedded_image_min_coverage = 0.9
+
+# Spazi colore dei JPEG decodificati direttamente in scala di grigi con OpenCV
+# (gli altri, ad esempio CMYK, vengono convertiti da MuPDF)
+jpeg_gray_colorspaces = ("DeviceGray", "DeviceRGB")
+
+# Risoluzione di rendering delle pagine vettoriali
+default_dpi = int(os.environ.get("RENDER_DPI", 300))
+
+# Sceglie la risoluzione di ogni pagina vettoriale in base all'interlinea misurata
+# su un'anteprima a bassa risoluzione, invece di usare sempre default_dpi
+adaptive_dpi = os.environ.get("ADAPTIVE_DPI", "true").lower() == "true"
+
+# Risoluzione dell'anteprima usata per stimare l'interlinea
+preview_dpi = 150
+
+# Interlinea (in pixel) per cui sono stati disegnati i template e tolleranza
+# relativa: entro l'intervallo la pagina viene renderizzata a default_dpi
+target_line_spacing = 18
+line_spacing_tolerance = 0.15
+
+# Limiti della risoluzione scelta automaticamente
+min_dpi = 150
+max_dpi = 600
 
 def is_pdf(file_path: str) -> bool:
     """Verifica se un file è un PDF basandosi sulla sua estensione
@@ -12,13 +47,285 @@ def is_pdf(file_path: str) -> bool:
     """
     return file_path.lower().endswith('.pdf')
 
+def page_snapshot_dir(pdf_path: str, output_dir: str) -> str:
+    """Restituisce la directory delle copie JPG delle pagine di un PDF ({nome}_pages)"""
+    pdf_name = os.path.basename(pdf_path).rsplit('.', 1)[0]
+    return os.path.join(output_dir, f"{pdf_name}_pages")
+
+def pdf_page_count(pdf_path: str) -> int:
+    """Restituisce il numero di pagine di un PDF senza renderizzarle (0 se non leggibile)"""
+    try:
+        with fitz.open(pdf_path) as pdf_document:
+            return pdf_document.page_count
+    except Exception as e:
+        print(f"[ERRORE] Impossibile aprire il PDF: {e}")
+        return 0
+
+def orient_image(img: np.ndarray, matrix) -> Optional[np.ndarray]:
+    """
+    Riporta un'immagine incorporata nell'orientamento con cui appare sulla pagina
+
+    matrix trasforma il quadrato unitario dell'immagine nelle coordinate della
+    pagina visualizzata (rotazione della pagina compresa). Sono gestite solo le
+    rotazioni di multipli di 90 gradi e i ribaltamenti; per gli altri
+    posizionamenti restituisce None.
+    """
+    eps = 1e-3 * max(abs(matrix.a), abs(matrix.b), abs(matrix.c), abs(matrix.d))
+    if abs(matrix.b) < eps and abs(matrix.c) < eps:
+        # Gli assi dell'immagine sono paralleli a quelli della pagina
+        if matrix.a < 0 and matrix.d < 0:
+            return cv2.flip(img, -1)
+        if matrix.a < 0:
+            return cv2.flip(img, 1)
+        if matrix.d < 0:
+            return cv2.flip(img, 0)
+        return img
+    if abs(matrix.a) < eps and abs(matrix.d) < eps:
+        # Le colonne dell'immagine diventano righe della pagina e viceversa
+        img = cv2.transpose(img)
+        if matrix.b < 0 and matrix.c < 0:
+            return cv2.flip(img, -1)
+        if matrix.b < 0:
+            return cv2.flip(img, 0)
+        if matrix.c < 0:
+            return cv2.flip(img, 1)
+        return img
+    return None
+
+def extract_page_image(pdf_document, page) -> Optional[Tuple[np.ndarray, object]]:
+    """
+    Estrae l'immagine incorporata di una pagina scansionata alla risoluzione nativa
+
+    La pagina deve contenere una sola immagine, disegnata una volta, senza
+    trasparenza né maschere, che copre quasi tutta la pagina, e nessun contenuto
+    vettoriale o testo visibile (il testo invisibile dell'OCR è ammesso). Le pagine
+    incise in formato vettoriale non soddisfano queste condizioni e vengono
+    renderizzate come di consueto.
+
+    I JPEG vengono decodificati direttamente in scala di grigi; gli altri formati
+    (CCITT, JBIG2, Flate, JPEG 2000...) con il decodificatore di MuPDF.
+
+    Returns:
+        Coppia (immagine in scala di grigi orientata come la pagina, oggetto da
+        mantenere in vita finché si usa l'immagine) oppure None se la pagina
+        va renderizzata
+    """
+    images = page.get_images(full=True)
+    if len(images) != 1:
+        return None
+    xref, smask, colorspace_name, image_filter = images[0][0], images[0][1], images[0][5], images[0][8]
+    if smask:
+        return None
+    # Le maschere e gli array Decode cambiano l'interpretazione dei pixel
+    if pdf_document.xref_get_key(xref, "ImageMask")[1] == "true":
+        return None
+    if pdf_document.xref_get_key(xref, "Decode")[0] != "null":
+        return None
+
+    # Senza xrefs=True non vengono calcolati gli hash dei pixel, che richiederebbero
+    # di decodificare l'immagine: con una sola immagine tra le risorse, l'unico
+    # posizionamento è il suo
+    placements = page.get_image_info()
+    if len(placements) != 1:
+        return None
+    if (placements[0]["width"], placements[0]["height"]) != (images[0][2], images[0][3]):
+        return None
+    matrix = fitz.Matrix(placements[0]["transform"]) * page.rotation_matrix
+    image_rect = fitz.Rect(0, 0, 1, 1) * matrix
+    page_area = page.rect.get_area()
+    if page_area <= 0 or (image_rect & page.rect).get_area() < embedded_image_min_coverage * page_area:
+        return None
+
+    # Contenuto disegnato sopra la scansione: serve il rendering completo
+    if page.get_cdrawings():
+        return None
+    if any(span["type"] != 3 for span in page.get_texttrace()):
+        return None
+
+    pix = None
+    if image_filter == "DCTDecode" and colorspace_name in jpeg_gray_colorspaces:
+        raw = np.frombuffer(pdf_document.xref_stream_raw(xref), dtype=np.uint8)
+        # Come nel rendering di fitz l'orientamento EXIF del JPEG viene ignorato:
+        # conta solo la matrice con cui l'immagine è disegnata sulla pagina
+        img = cv2.imdecode(raw, cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION)
+        if img is None:
+            return None
+    else:
+        pix = fitz.Pixmap(pdf_document, xref)
+        if pix.colorspace is None:
+            return None
+        if pix.n != 1 or pix.alpha:
+            pix = fitz.Pixmap(fitz.csGRAY, pix)
+        img = np.frombuffer(pix.samples_mv, dtype=np.uint8)
+        img = img.reshape(pix.height, pix.stride)[:, :pix.width]
+
+    img = orient_image(img, matrix)
+    if img is None:
+        return None
+    return img, pix
+
+def choose_dpi(img: np.ndarray, img_dpi: int, base_dpi: int) -> int:
+    """
+    Sceglie la risoluzione di una pagina dall'interlinea misurata su una sua immagine
+
+    img è la pagina in scala di grigi a img_dpi. L'interlinea stimata con
+    get_ref_lengths viene riportata a base_dpi: se è già nell'intervallo dei
+    template restituisce base_dpi, altrimenti la risoluzione (entro min_dpi e
+    max_dpi) che porta l'interlinea a target_line_spacing.
+    """
+    _, img = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    try:
+        _, line_spacing = get_ref_lengths(img)
+    except Exception:
+        # Pagina senza pentagrammi riconoscibili (ad esempio un frontespizio)
+        return base_dpi
+    if line_spacing <= 0:
+        return base_dpi
+
+    predicted_spacing = line_spacing * base_dpi / img_dpi
+    if abs(predicted_spacing - target_line_spacing) <= line_spacing_tolerance * target_line_spacing:
+        return base_dpi
+    dpi = int(round(base_dpi * target_line_spacing / predicted_spacing))
+    return min(max(dpi, min_dpi), max_dpi)
+
+def choose_render_dpi(page) -> int:
+    """
+    Sceglie la risoluzione di rendering di una pagina vettoriale
+
+    Renderizza la pagina a preview_dpi e sceglie la risoluzione con choose_dpi a
+    partire da default_dpi. Ogni fase successiva della pipeline scala con il
+    numero di pixel: gli spartiti a caratteri grandi vengono renderizzati più
+    piccoli, quelli in miniatura più grandi.
+    """
+    zoom = preview_dpi / 72
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    preview = np.frombuffer(pix.samples_mv, dtype=np.uint8)
+    preview = preview.reshape(pix.height, pix.stride)[:, :pix.width]
+    return choose_dpi(preview, preview_dpi, default_dpi)
+
+def resample_page_image(img: np.ndarray, native_dpi: int) -> Tuple[np.ndarray, int]:
+    """
+    Riporta l'immagine estratta di una pagina scansionata all'interlinea dei template
+
+    La risoluzione viene scelta con choose_dpi come per le pagine renderizzate,
+    partendo da quella nativa; l'interlinea è misurata direttamente sull'immagine,
+    già disponibile. Se la risoluzione cambia l'immagine viene ricampionata
+    (l'interpolazione bicubica altererebbe lo spessore delle linee dopo la
+    binarizzazione, quella lineare no).
+
+    Returns:
+        Coppia (immagine, risoluzione in dpi)
+    """
+    if native_dpi <= 0:
+        return img, native_dpi
+    dpi = choose_dpi(img, native_dpi, native_dpi)
+    if dpi == native_dpi:
+        return img, native_dpi
+    scale = dpi / native_dpi
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    return cv2.resize(img, None, fx=scale, fy=scale, interpolation=interpolation), dpi
+
+def iter_pdf_pages(pdf_path: str, dpi: Optional[int] = None,
+                   snapshot_dir: Optional[str] = None) -> Iterator[Tuple[int, np.ndarray, int]]:
+    """
+    Renderizza le pagine di un PDF una alla volta, man mano che vengono richieste
+
+    Ogni pagina viene renderizzata direttamente in scala di grigi e restituita come
+    array NumPy costruito sul buffer del pixmap di PyMuPDF, senza copie né
+    codifiche JPEG intermedie. In memoria resta una sola pagina alla volta.
+    Le pagine scansionate vengono invece estratte alla risoluzione nativa
+    dell'immagine incorporata (vedi extract_page_image), ignorando dpi; se
+    adaptive_dpi è attivo e dpi è None l'immagine viene poi ricampionata
+    all'interlinea dei template come le pagine renderizzate (vedi
+    resample_page_image).
+
+    L'array condivide la memoria del pixmap ed è valido solo fino alla richiesta
+    della pagina successiva: per conservarlo più a lungo va copiato (img.copy()).
+
+    Se una pagina non può essere renderizzata l'errore viene stampato e la pagina
+    viene restituita con immagine None; le pagine successive vengono elaborate
+    comunque.
+
+    Args:
+        pdf_path: Percorso del file PDF
+        dpi: Risoluzione per la conversione; None = scelta pagina per pagina con
+            choose_render_dpi se adaptive_dpi è attivo, altrimenti default_dpi
+        snapshot_dir: Se indicata, salva anche una copia JPG di ogni pagina
+            (page_NNN.jpg) in questa directory
+
+    Yields:
+        Terne (numero di pagina a partire da 1, immagine in scala di grigi o
+        None se la pagina non è stata renderizzata, risoluzione in dpi); per le
+        immagini estratte la risoluzione è quella effettiva dell'immagine
+        restituita sulla pagina
+    """
+    if snapshot_dir is not None:
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+    try:
+        pdf_document = fitz.open(pdf_path)
+    except Exception as e:
+        print(f"[ERRORE] Impossibile aprire il PDF: {e}")
+        print("[INFO] Installa PyMuPDF con: pip install PyMuPDF")
+        return
+
+    try:
+        for page_num in range(pdf_document.page_count):
+            page = pdf_document[page_num]
+
+            embedded = None
+            if extract_embedded_images:
+                try:
+                    embedded = extract_page_image(pdf_document, page)
+                except Exception as e:
+                    print(f"[ERRORE] Estrazione dell'immagine della pagina {page_num+1} non riuscita, "
+                          f"la pagina viene renderizzata: {e}")
+
+            if embedded is not None:
+                img, pix = embedded
+                page_dpi = int(round(img.shape[1] * 72 / page.rect.width))
+                if dpi is None and adaptive_dpi:
+                    img, page_dpi = resample_page_image(img, page_dpi)
+            else:
+                try:
+                    page_dpi = dpi
+                    if page_dpi is None:
+                        page_dpi = choose_render_dpi(page) if adaptive_dpi else default_dpi
+                    # Fattore di zoom basato sul DPI (72 DPI è la base standard per PDF)
+                    zoom = page_dpi / 72
+                    pix = page.get_pixmap(
+                        matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False
+                    )
+                except Exception as e:
+                    print(f"[ERRORE] Impossibile convertire la pagina {page_num+1} del PDF: {e}")
+                    yield page_num + 1, None, page_dpi
+                    continue
+
+                # Vista sul buffer del pixmap: le righe possono essere più lunghe della
+                # larghezza della pagina (stride), le colonne in eccesso vengono escluse
+                img = np.frombuffer(pix.samples_mv, dtype=np.uint8)
+                img = img.reshape(pix.height, pix.stride)[:, :pix.width]
+
+            if snapshot_dir is not None:
+                cv2.imwrite(os.path.join(snapshot_dir, f"page_{page_num+1:03d}.jpg"), img)
+
+            # Il pixmap resta referenziato fino alla ripresa del generatore, quindi
+            # la vista è valida finché il chiamante non richiede la pagina successiva
+            yield page_num + 1, img, page_dpi
+            del img, pix, embedded
+    finally:
+        pdf_document.close()
+
 def pdf_to_images(pdf_path: str, output_dir: str, dpi: int = 300) -> List[str]:
     """
     Converte un PDF in una serie di immagini JPG utilizzando PyMuPDF (senza dipendenze esterne)
     
     Questa funzione è essenziale per pre-elaborare spartiti musicali in formato PDF.
     La conversione in immagini permette l'applicazione di algoritmi di computer vision
-    che possono analizzare la struttura visiva dello spartito.
+    che possono analizzare la struttura visiva dello spartito. La pipeline usa
+    direttamente iter_pdf_pages; questa funzione serve quando le pagine devono
+    esistere come file.
     
     Args:
         pdf_path: Percorso del file PDF
@@ -28,45 +335,15 @@ def pdf_to_images(pdf_path: str, output_dir: str, dpi: int = 300) -> List[str]:
     Returns:
         Lista dei percorsi delle immagini generate
     """
-    # Crea la directory di output se non esiste
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Ottiene il nome del file PDF senza estensione
-    pdf_name = os.path.basename(pdf_path).rsplit('.', 1)[0]
-    
     # Crea una sottodirectory con il nome del PDF
-    pdf_output_dir = os.path.join(output_dir, f"{pdf_name}_pages")
-    os.makedirs(pdf_output_dir, exist_ok=True)
-    
-    # Converte il PDF in immagini
+    pdf_output_dir = page_snapshot_dir(pdf_path, output_dir)
+
     print(f"[INFO] Conversione del PDF in immagini (potrebbe richiedere tempo)...")
-    image_paths = []
-    
-    try:
-        # Calcola il fattore di zoom basato sul DPI (72 DPI è la base standard per PDF)
-        zoom = dpi / 72
-        
-        # Apre il documento PDF
-        pdf_document = fitz.open(pdf_path)
-        
-        # Elabora ogni pagina
-        for page_num, page in enumerate(pdf_document):
-            # Ottiene la pagina come pixmap (immagine)
-            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
-            
-            # Converte il pixmap in un'immagine PIL
-            img_data = pix.tobytes("jpeg")
-            img = Image.open(io.BytesIO(img_data))
-            
-            # Salva l'immagine con un nome sequenziale
-            image_path = os.path.join(pdf_output_dir, f"page_{page_num+1:03d}.jpg")
-            img.save(image_path, "JPEG")
-            image_paths.append(image_path)
-        
-    except Exception as e:
-        print(f"[ERRORE] Impossibile convertire il PDF: {e}")
-        print("[INFO] Installa PyMuPDF con: pip install PyMuPDF")
-        return []
-    
+    image_paths = [
+        os.path.join(pdf_output_dir, f"page_{page_number:03d}.jpg")
+        for page_number, img, _ in iter_pdf_pages(pdf_path, dpi, snapshot_dir=pdf_output_dir)
+        if img is not None
+    ]
+
     print(f"[INFO] Convertite {len(image_paths)} pagine da PDF a JPG")
     return image_paths
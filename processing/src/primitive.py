@@ -1,4 +1,11 @@
+import numpy as np
+
+from src.box import BoxArray
+
+
 class Primitive(object):
+    __slots__ = ("pitch", "duration", "primitive", "box")
+
     def __init__(self, primitive, duration, box, pitch=-1):
         self.pitch = pitch
         self.duration = duration
@@ -10,7 +17,7 @@ class Primitive(object):
 
     def setDuration(self, duration):
         self.duration = duration
-    
+
     def getPrimitive(self):
         return self.primitive
 
@@ -22,3 +29,99 @@ class Primitive(object):
 
     def getBox(self):
         return self.box
+
+
+class PrimitiveView(Primitive):
+    """
+    Primitiva index di una PrimitiveTable: legge e modifica le colonne della
+    tabella e ha la stessa interfaccia di Primitive
+    """
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def primitive(self):
+        return self.table.classes[self.index]
+
+    @property
+    def duration(self):
+        # Le durate intere erano int (1, 2, 4...) prima della colonna float64:
+        # restano int anche nei risultati serializzati
+        duration = float(self.table.durations[self.index])
+        return int(duration) if duration.is_integer() else duration
+
+    @duration.setter
+    def duration(self, duration):
+        self.table.durations[self.index] = duration
+
+    @property
+    def pitch(self):
+        return self.table.pitches[self.index]
+
+    @pitch.setter
+    def pitch(self, pitch):
+        self.table.pitches[self.index] = pitch
+
+    @property
+    def box(self):
+        return self.table.boxes[self.index]
+
+
+def object_column(values, length):
+    """Colonna di oggetti (es. stringhe) lunga length da una lista o da un singolo valore"""
+    column = np.empty(length, dtype=object)
+    column[:] = values
+    return column
+
+
+class PrimitiveTable(object):
+    """
+    Primitive di un pentagramma memorizzate per colonne: riquadri (BoxArray
+    con x, y, w, h e punteggio), classe, durata e altezza, una riga per primitiva
+    """
+    __slots__ = ("boxes", "classes", "durations", "pitches")
+
+    def __init__(self, boxes, classes, durations, pitches=-1):
+        """
+        Args:
+            boxes: BoxArray dei riquadri
+            classes, durations, pitches: Un valore per riquadro o un valore
+                comune a tutti i riquadri
+        """
+        self.boxes = boxes
+        self.classes = object_column(classes, len(boxes))
+        self.durations = np.array(np.broadcast_to(np.asarray(durations, dtype=np.float64), (len(boxes),)))
+        self.pitches = object_column(pitches, len(boxes))
+
+    @classmethod
+    def concatenate(cls, tables):
+        """Unisce più PrimitiveTable (nell'ordine) in una sola"""
+        tables = list(tables)
+        if not tables:
+            return cls(BoxArray.concatenate([]), [], [])
+        return cls(
+            BoxArray.concatenate(table.boxes for table in tables),
+            np.concatenate([table.classes for table in tables]),
+            np.concatenate([table.durations for table in tables]),
+            np.concatenate([table.pitches for table in tables]),
+        )
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError("Indice della primitiva fuori intervallo")
+        return PrimitiveView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield PrimitiveView(self, index)
+
+    def getSortedOrder(self):
+        """Indici delle primitive ordinate per centro (x, poi y), a parità nell'ordine della tabella"""
+        centers = self.boxes.getCenters()
+        return np.lexsort((centers[:, 1], centers[:, 0]))
@@ -0,0 +1,261 @@
+"""
+Cache su disco dei risultati del server, indicizzata per contenuto.
+
+La chiave di una voce è l'hash SHA-256 del file caricato unito all'impronta
+della pipeline (codice, template e impostazioni che influenzano i risultati):
+lo stesso spartito caricato di nuovo riusa gli artefatti già prodotti invece
+di essere rielaborato, finché la pipeline non cambia.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+from src import detection, pdf_utils, utils
+
+# Versione della pipeline: da incrementare quando cambia il formato dei risultati
+# senza che cambi il codice in src (ad esempio le funzioni di server.py)
+pipeline_version = "1"
+
+# Directory e dimensione massima su disco della cache dei risultati (0 = disattivata).
+# La directory deve stare sullo stesso file system dei risultati dei lavori perché
+# gli artefatti vengano collegati con hard link invece di essere copiati
+result_cache_dir = os.environ.get("RESULT_CACHE_DIR", os.path.join("output", ".result_cache"))
+result_cache_size_mb = int(os.environ.get("RESULT_CACHE_SIZE_MB", 1024))
+
+# Dimensione dei blocchi letti dal file caricato mentre viene salvato
+upload_chunk_size = 1024 * 1024
+
+# File di una voce con il risultato del processamento; gli artefatti stanno in artifacts/
+result_filename = "result.json"
+artifacts_dirname = "artifacts"
+
+
+def save_stream(stream, path):
+    """
+    Salva uno stream su disco calcolandone l'hash SHA-256 durante la scrittura
+
+    Returns:
+        Coppia (hash esadecimale, byte scritti)
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as f:
+        while True:
+            chunk = stream.read(upload_chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def pipeline_fingerprint(extra_files=()):
+    """
+    Impronta della pipeline: cambia se cambiano il codice in src, i template o
+    le impostazioni configurabili da ambiente che influenzano i risultati.
+
+    Args:
+        extra_files: Altri file da includere (ad esempio server.py)
+    """
+    digest = hashlib.sha256()
+    digest.update(pipeline_version.encode())
+
+    settings = {
+        "predict_template_scale": detection.predict_template_scale,
+        "extract_peaks": detection.extract_peaks,
+        "coarse_to_fine": detection.coarse_to_fine,
+        "template_backends": detection.template_backends,
+        "correlation_backend": utils.correlation_backend,
+        "extract_embedded_images": pdf_utils.extract_embedded_images,
+        "adaptive_dpi": pdf_utils.adaptive_dpi,
+        "default_dpi": pdf_utils.default_dpi,
+        "save_page_snapshots": pdf_utils.save_page_snapshots,
+    }
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    paths = [
+        os.path.join(src_dir, filename)
+        for filename in os.listdir(src_dir)
+        if filename.endswith(".py")
+    ]
+    for root, dirs, files in os.walk(detection.template_dir):
+        paths.extend(os.path.join(root, filename) for filename in files)
+    paths = sorted(paths) + list(extra_files)
+
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def link_tree(src_dir, dst_dir, skip=()):
+    """
+    Riproduce i file di src_dir in dst_dir con hard link (copia se il file
+    system non li supporta) e restituisce i byte dei file collegati.
+    """
+    total = 0
+    for root, dirs, files in os.walk(src_dir):
+        rel_root = os.path.relpath(root, src_dir)
+        target_root = os.path.normpath(os.path.join(dst_dir, rel_root))
+        os.makedirs(target_root, exist_ok=True)
+        for filename in files:
+            if rel_root == "." and filename in skip:
+                continue
+            src_path = os.path.join(root, filename)
+            dst_path = os.path.join(target_root, filename)
+            try:
+                os.link(src_path, dst_path)
+            except OSError:
+                shutil.copy2(src_path, dst_path)
+            total += os.path.getsize(dst_path)
+    return total
+
+
+def rewrite_paths(result, old_dir, new_dir):
+    """Sostituisce nel risultato i percorsi sotto old_dir con gli equivalenti sotto new_dir"""
+    old = json.dumps(os.path.normpath(old_dir))[1:-1]
+    new = json.dumps(os.path.normpath(new_dir))[1:-1]
+    return json.loads(json.dumps(result).replace(old, new))
+
+
+class ResultCache(object):
+    """
+    Cache LRU su disco dei risultati dei lavori.
+
+    Ogni voce è una directory con gli artefatti del lavoro che l'ha prodotta e
+    il relativo risultato. I file vengono collegati con hard link sia verso la
+    cache sia verso i lavori che la riusano, quindi una voce non duplica lo
+    spazio occupato dai lavori. Lo spazio della cache è limitato a max_bytes:
+    oltre il limite vengono eliminate le voci usate meno di recente.
+    """
+    def __init__(self, directory, max_bytes):
+        """
+        Args:
+            directory: Directory delle voci (creata se non esiste)
+            max_bytes: Spazio massimo occupato dalle voci (0 = cache disattivata)
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # chiave -> byte occupati, dalla meno recente
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if max_bytes > 0:
+            self.load()
+
+    def load(self):
+        """Ricostruisce l'indice dalle voci su disco, ordinate per ultimo utilizzo"""
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for key in os.listdir(self.directory):
+            entry_dir = os.path.join(self.directory, key)
+            result_path = os.path.join(entry_dir, result_filename)
+            if not os.path.exists(result_path):
+                # Voce incompleta (ad esempio interrotta da un riavvio)
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            size = 0
+            for root, dirs, files in os.walk(os.path.join(entry_dir, artifacts_dirname)):
+                size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+            found.append((os.path.getmtime(result_path), key, size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.current_bytes += size
+
+    def key(self, file_hash, fingerprint, variant=None):
+        """
+        Chiave di una voce: hash del file caricato, impronta della pipeline ed
+        eventuale variante dei risultati (ad esempio il livello degli artefatti)
+        """
+        key = f"{file_hash}-{fingerprint[:16]}"
+        return f"{key}-{variant}" if variant else key
+
+    def materialize(self, key, output_dir):
+        """
+        Collega gli artefatti della voce key in output_dir.
+
+        Returns:
+            Il risultato della voce con i percorsi riferiti a output_dir, oppure
+            None se la voce non è in cache
+        """
+        if self.max_bytes <= 0:
+            return None
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            entry_dir = os.path.join(self.directory, key)
+            result_path = os.path.join(entry_dir, result_filename)
+            with open(result_path, "r") as f:
+                entry = json.load(f)
+            link_tree(os.path.join(entry_dir, artifacts_dirname), output_dir)
+            # L'ultimo utilizzo sopravvive ai riavvii tramite la data di modifica
+            os.utime(result_path, (time.time(), time.time()))
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return rewrite_paths(entry["result"], entry["output_dir"], output_dir)
+
+    def put(self, key, output_dir, result, skip=("metadata.json",)):
+        """
+        Aggiunge alla cache gli artefatti di output_dir (tranne i file in skip)
+        e il risultato del lavoro che li ha prodotti.
+        """
+        if self.max_bytes <= 0:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            entry_dir = os.path.join(self.directory, key)
+            tmp_dir = f"{entry_dir}.tmp-{threading.get_ident()}"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            try:
+                size = link_tree(output_dir, os.path.join(tmp_dir, artifacts_dirname), skip)
+                with open(os.path.join(tmp_dir, result_filename), "w") as f:
+                    json.dump({"output_dir": output_dir, "result": result}, f)
+                os.rename(tmp_dir, entry_dir)
+            except OSError as e:
+                print(f"[ERRORE] Impossibile salvare il risultato in cache: {e}")
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+
+            self.entries[key] = size
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self.entries:
+                evicted_key, evicted_size = self.entries.popitem(last=False)
+                shutil.rmtree(os.path.join(self.directory, evicted_key), ignore_errors=True)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        """Elimina tutte le voci e azzera i contatori"""
+        with self.lock:
+            for key in self.entries:
+                shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            self.entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Restituisce i contatori della cache (hit, miss, voci e spazio occupato)"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -2,6 +2,7 @@
 Modulo che definisce la classe Staff (Pentagramma) per rappresentare e analizzare
 pentagrammi musicali all'interno del processo di riconoscimento della partitura.
 """
+import numpy as np
 
 class Staff(object):
     """
@@ -9,7 +10,7 @@ class Staff(object):
     Memorizza informazioni sulle linee, chiave musicale, indicazione di tempo
     e fornisce metodi per l'analisi degli elementi all'interno del pentagramma.
     """
-    def __init__(self, staff_matrix, staff_box, line_width, line_spacing, staff_img, clef="treble", time_signature="44", instrument=-1):
+    def __init__(self, staff_matrix, staff_box, line_width, line_spacing, staff_img, clef="treble", time_signature="44", instrument=-1, img_origin=(0, 0)):
         """
         Inizializza un nuovo pentagramma.
         
@@ -22,6 +23,7 @@ class Staff(object):
             clef: Chiave musicale (predefinita: "treble" - chiave di violino)
             time_signature: Indicazione di tempo (predefinita: "44" - quattro quarti)
             instrument: ID dello strumento associato (predefinito: -1, non specificato)
+            img_origin: Posizione (x, y) di staff_img nell'immagine della pagina
         """
         self.clef = clef
         self.time_signature = time_signature
@@ -33,13 +35,17 @@ class Staff(object):
         self.line_five = staff_matrix[4]   # Quinta linea (inferiore) del pentagramma
         self.staff_box = staff_box
         self.img = staff_img
+        self.img_origin = img_origin
         self.bars = []  # Misure musicali nel pentagramma
+        self.annotations = []  # Simboli rilevati da mostrare nelle immagini di debug
         self.line_width = line_width
         self.line_spacing = line_spacing
+        self.pitch_lookup = None  # Tabella y -> altezza per la chiave corrente (vedi getPitchLookup)
 
     def setClef(self, clef):
         """Imposta la chiave musicale del pentagramma"""
         self.clef = clef
+        self.pitch_lookup = None
 
     def setTimeSignature(self, time):
         """Imposta l'indicazione di tempo del pentagramma"""
@@ -53,6 +59,15 @@ class Staff(object):
         """Aggiunge una misura musicale al pentagramma"""
         self.bars.append(bar)
 
+    def addAnnotation(self, kind, box, label):
+        """
+        Registra un simbolo rilevato (chiave, tempo o primitiva) da disegnare
+        nelle immagini di debug e restituisce la terna (kind, box, label)
+        """
+        annotation = (kind, box, label)
+        self.annotations.append(annotation)
+        return annotation
+
     def getClef(self):
         """Restituisce la chiave musicale del pentagramma"""
         return self.clef
@@ -69,6 +84,14 @@ class Staff(object):
         """Restituisce l'immagine contenente il pentagramma"""
         return self.img
 
+    def getImageOrigin(self):
+        """Restituisce la posizione (x, y) dell'immagine del pentagramma nella pagina"""
+        return self.img_origin
+
+    def getAnnotations(self):
+        """Restituisce i simboli rilevati come terne (kind, box, label)"""
+        return self.annotations
+
     def getLineWidth(self):
         """Restituisce lo spessore delle linee del pentagramma"""
         return self.line_width
@@ -81,6 +104,97 @@ class Staff(object):
         """Restituisce le misure musicali nel pentagramma"""
         return self.bars
 
+    def getPitchLookup(self):
+        """
+        Tabella delle altezze del pentagramma per la chiave corrente, calcolata
+        alla prima richiesta e scartata da setClef.
+
+        Returns:
+            Coppia (nomi delle altezze, array con un indice in nomi per ogni
+            riga dell'immagine del pentagramma, -1 se la riga non corrisponde
+            a nessuna altezza)
+        """
+        if self.pitch_lookup is None:
+            self.pitch_lookup = self.buildPitchLookup()
+        return self.pitch_lookup
+
+    def buildPitchLookup(self):
+        """
+        Costruisce la tabella di getPitchLookup percorrendo una sola volta
+        linee e spazi del pentagramma e, sopra e sotto, le linee addizionali
+        """
+        # Informazioni sulle altezze delle note in base alla chiave musicale
+        clef_info = {
+            "treble": [("F5", "E5", "D5", "C5", "B4", "A4", "G4", "F4", "E4"), (5,3), (4,2)],  # Chiave di violino
+            "bass": [("A3", "G3", "F3", "E3", "D3", "C3", "B2", "A2", "G2"), (3,5), (2,4)]     # Chiave di basso
+        }
+        note_names = ["C", "D", "E", "F", "G", "A", "B"]  # Nomi delle note musicali
+        height = self.img.shape[0]
+        table = np.full(height, -1, dtype=np.int16)
+        names = []
+
+        def assign(rows, name, mask=None):
+            """Assegna name alle righe ancora libere (vince la prima regola che le copre)"""
+            rows = np.asarray(rows, dtype=np.int64)
+            rows = rows[(rows >= 0) & (rows < height)]
+            if mask is not None:
+                rows = rows[mask(rows)]
+            rows = rows[table[rows] < 0]
+            if rows.size == 0:
+                return
+            if name not in names:
+                names.append(name)
+            table[rows] = names.index(name)
+
+        # Linee e spazi del pentagramma, dalla prima alla quinta linea
+        lines = [self.line_one, self.line_two, self.line_three, self.line_four, self.line_five]
+        staff_notes = clef_info[self.clef][0]
+        for k, line in enumerate(lines):
+            assign(line, staff_notes[2 * k])
+            if k + 1 < len(lines):
+                assign(range(line[-1] + 1, lines[k + 1][0]), staff_notes[2 * k + 1])
+
+        # Sopra il pentagramma: linee addizionali e spazi verso l'alto
+        above = lambda rows: rows < self.line_one[0]
+        line_below = np.asarray(self.line_one)
+        current_line = line_below - self.line_spacing
+        octave, note_index = clef_info[self.clef][1]
+        while current_line[0] > 0:
+            line_octave = octave + 1 if (note_index + 2 >= 7) else octave
+            assign(current_line, note_names[(note_index + 2) % 7] + str(line_octave), above)
+            space_octave = octave + 1 if (note_index + 1 >= 7) else octave
+            assign(range(current_line[-1] + 1, line_below[0]),
+                   note_names[(note_index + 1) % 7] + str(space_octave), above)
+            octave, note_index = line_octave, (note_index + 2) % 7
+            line_below = current_line
+            current_line = current_line - self.line_spacing
+
+        # Sotto il pentagramma: linee addizionali e spazi verso il basso (con
+        # lo stesso calcolo dell'ottava della ricerca riga per riga originale)
+        below = lambda rows: rows > self.line_five[-1]
+        line_above = np.asarray(self.line_five)
+        current_line = line_above + self.line_spacing
+        octave, note_index = clef_info[self.clef][2]
+        while current_line[-1] < height:
+            line_octave = octave - 1 if (note_index - 2 <= 7) else octave
+            assign(current_line, note_names[(note_index - 2) % 7] + str(line_octave), below)
+            space_octave = octave - 1 if (note_index - 1 >= 7) else octave
+            assign(range(line_above[-1] + 1, current_line[0]),
+                   note_names[(note_index - 1) % 7] + str(space_octave), below)
+            octave, note_index = line_octave, (note_index - 2) % 7
+            line_above = current_line
+            current_line = current_line + self.line_spacing
+
+        return tuple(names), table
+
+    def pitchNotFound(self, note_center_y):
+        """Errore per una coordinata y che non corrisponde a nessuna altezza"""
+        if note_center_y < self.line_one[0]:
+            return AssertionError("[ERRORE] La nota è sopra il pentagramma, ma non è stata trovata")
+        if note_center_y > self.line_five[-1]:
+            return AssertionError("[ERRORE] La nota è sotto il pentagramma, ma non è stata trovata")
+        return AssertionError("[ERRORE] La nota non è né dentro, né sopra, né sotto il pentagramma")
+
     def getPitch(self, note_center_y):
         """
         Determina l'altezza (pitch) di una nota basandosi sulla sua posizione verticale nel pentagramma.
@@ -93,91 +207,31 @@ class Staff(object):
             
         Note:
             Il metodo usa informazioni sulla chiave musicale (violino o basso) per determinare
-            correttamente l'altezza in base al posizionamento verticale.
+            correttamente l'altezza in base al posizionamento verticale, tramite la
+            tabella di getPitchLookup.
         """
-        # Informazioni sulle altezze delle note in base alla chiave musicale
-        clef_info = {
-            "treble": [("F5", "E5", "D5", "C5", "B4", "A4", "G4", "F4", "E4"), (5,3), (4,2)],  # Chiave di violino
-            "bass": [("A3", "G3", "F3", "E3", "D3", "C3", "B2", "A2", "G2"), (3,5), (2,4)]     # Chiave di basso
-        }
-        note_names = ["C", "D", "E", "F", "G", "A", "B"]  # Nomi delle note musicali
+        names, table = self.getPitchLookup()
+        index = table[note_center_y] if 0 <= note_center_y < len(table) else -1
+        if index < 0:
+            raise self.pitchNotFound(note_center_y)
+        return names[index]
+
+    def getPitches(self, note_centers_y):
+        """
+        Altezze di più note in una sola ricerca nella tabella di getPitchLookup
 
-        #print("[getPitch] Using {} clef".format(self.clef))
-
-        # Controlla prima se la nota è all'interno del pentagramma
-        if (note_center_y in self.line_one):
-            return clef_info[self.clef][0][0]
-        elif (note_center_y in list(range(self.line_one[-1] + 1, self.line_two[0]))):
-            return clef_info[self.clef][0][1]
-        elif (note_center_y in self.line_two):
-            return clef_info[self.clef][0][2]
-        elif (note_center_y in list(range(self.line_two[-1] + 1, self.line_three[0]))):
-            return clef_info[self.clef][0][3]
-        elif (note_center_y in self.line_three):
-            return clef_info[self.clef][0][4]
-        elif (note_center_y in list(range(self.line_three[-1] + 1, self.line_four[0]))):
-            return clef_info[self.clef][0][5]
-        elif (note_center_y in self.line_four):
-            return clef_info[self.clef][0][6]
-        elif (note_center_y in list(range(self.line_four[-1] + 1, self.line_five[0]))):
-            return clef_info[self.clef][0][7]
-        elif (note_center_y in self.line_five):
-            return clef_info[self.clef][0][8]
-        else:
-            # print("[getPitch] Note was not within staff")
-            if (note_center_y < self.line_one[0]):
-                # print("[getPitch] Note above staff ")
-                # Controlla sopra il pentagramma
-                line_below = self.line_one
-                current_line = [pixel - self.line_spacing for pixel in self.line_one] # Va alla linea sopra
-                octave = clef_info[self.clef][1][0]  # Numero dell'ottava alla prima linea
-                note_index = clef_info[self.clef][1][1]  # La posizione della prima linea nell'array note_names
-
-                while (current_line[0] > 0):
-                    if (note_center_y in current_line):
-                        # Prende la nota due posizioni sopra
-                        octave = octave + 1 if (note_index + 2 >= 7) else octave
-                        note_index = (note_index + 2) % 7
-                        return note_names[note_index] + str(octave)
-                    elif (note_center_y in range(current_line[-1] + 1, line_below[0])):
-                        # Prende la nota una posizione sopra
-                        octave = octave + 1 if (note_index + 1 >= 7) else octave
-                        note_index = (note_index + 1) % 7
-                        return note_names[note_index] + str(octave)
-                    else:
-                        # Controlla la prossima linea sopra
-                        octave = octave + 1 if (note_index + 2 >= 7) else octave
-                        note_index = (note_index + 2) % 7
-                        line_below = current_line.copy()
-                        current_line = [pixel - self.line_spacing for pixel in current_line]
-
-                assert False, "[ERRORE] La nota è sopra il pentagramma, ma non è stata trovata"
-            elif (note_center_y > self.line_five[-1]):
-                # print("[getPitch] Note below staff ")
-                # Controlla sotto il pentagramma
-                line_above = self.line_five
-                current_line = [pixel + self.line_spacing for pixel in self.line_five]  # Va alla linea sotto
-                octave = clef_info[self.clef][2][0]  # Numero dell'ottava alla quinta linea
-                note_index = clef_info[self.clef][2][1]  # La posizione della quinta linea nell'array note_names
-
-                while (current_line[-1] < self.img.shape[0]):
-                    if (note_center_y in current_line):
-                        # Prende la nota due posizioni sotto
-                        octave = octave - 1 if (note_index - 2 <= 7) else octave
-                        note_index = (note_index - 2) % 7
-                        return note_names[note_index] + str(octave)
-                    elif (note_center_y in range(line_above[-1] + 1, current_line[0])):
-                        # Prende la nota una posizione sotto
-                        octave = octave - 1 if (note_index - 1 >= 7) else octave
-                        note_index = (note_index - 1) % 7
-                        return note_names[note_index] + str(octave)
-                    else:
-                        # Controlla la prossima linea sotto
-                        octave = octave - 1 if (note_index - 2 <= 7) else octave
-                        note_index = (note_index - 2) % 7
-                        line_above = current_line.copy()
-                        current_line = [pixel + self.line_spacing for pixel in current_line]
-                assert False, "[ERRORE] La nota è sotto il pentagramma, ma non è stata trovata"
-            else:
-                # Non dovremmo mai arrivare qui
-                assert False, "[ERRORE] La nota non è né dentro, né sopra, né sotto il pentagramma"
\ No newline at end of file
+        Args:
+            note_centers_y: Array di coordinate y intere dei centri delle note
+
+        Returns:
+            Lista di stringhe con le altezze, nell'ordine delle coordinate
+        """
+        names, table = self.getPitchLookup()
+        note_centers_y = np.asarray(note_centers_y, dtype=np.int64)
+        inside = (note_centers_y >= 0) & (note_centers_y < len(table))
+        indices = np.full(note_centers_y.shape, -1, dtype=np.int64)
+        indices[inside] = table[note_centers_y[inside]]
+        missing = np.flatnonzero(indices < 0)
+        if missing.size:
+            raise self.pitchNotFound(int(note_centers_y[missing[0]]))
+        return [names[index] for index in indices.tolist()]
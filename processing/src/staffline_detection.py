@@ -1,3 +1,4 @@
+import numpy as np
 from src.staff import Staff
 from src.box import BoundingBox
 
@@ -21,55 +22,80 @@ def find_staffline_rows(img, line_width, line_spacing):
     """
     num_rows = img.shape[0]  # Altezza dell'immagine (numero di righe)
     num_cols = img.shape[1]  # Larghezza dell'immagine (numero di colonne)
-    row_black_pixel_histogram = []
-
-    # Determina il numero di pixel neri in ogni riga dell'immagine
-    for i in range(num_rows):
-        row = img[i]
-        num_black_pixels = 0
-        for j in range(len(row)):
-            if (row[j] == 0):
-                num_black_pixels += 1
-
-        row_black_pixel_histogram.append(num_black_pixels)
-
-    # plt.bar(np.arange(num_rows), row_black_pixel_histogram)
-    # plt.show()
 
     all_staff_row_indices = []
     num_stafflines = 5  # Numero di linee in un pentagramma standard
     threshold = 0.4     # Soglia per determinare se una linea è parte del pentagramma
-    staff_length = num_stafflines * (line_width + line_spacing) - line_spacing
+    line_step = line_width + line_spacing
+    staff_length = num_stafflines * line_step - line_spacing
     iter_range = num_rows - staff_length + 1
 
-    # Trova i pentagrammi cercando gruppi di 5 righe che:
-    # - Si verificano secondo lo schema di larghezza e spaziatura previsto
-    # - Contengono un numero sufficiente di pixel neri (sopra una soglia)
-    #
-    # Filtra usando la condizione che tutte le linee del pentagramma
-    # devono avere un numero di pixel neri superiore alla soglia
+    if iter_range <= 0:
+        return all_staff_row_indices
+
+    # Proiezione orizzontale: numero di pixel neri in ogni riga dell'immagine
+    row_black_pixel_histogram = np.count_nonzero(img == 0, axis=1)
+
+    # Somme prefisse per ottenere in O(1) i pixel neri di ogni linea spessa line_width
+    prefix = np.concatenate(([0], np.cumsum(row_black_pixel_histogram)))
+    line_sums = prefix[line_width:] - prefix[:-line_width]
+    line_ok = ~(line_sums / line_width < threshold * num_cols)
+
+    # Una riga è candidata se tutte e 5 le linee che partono da essa secondo lo
+    # schema di larghezza e spaziatura previsto superano la soglia di pixel neri
+    staff_rows_mask = np.ones(iter_range, dtype=bool)
+    for k in range(num_stafflines):
+        staff_rows_mask &= line_ok[k * line_step:k * line_step + iter_range]
+
+    # Scorre le righe candidate dall'alto verso il basso: dopo aver trovato un
+    # pentagramma le righe che esso occupa non possono iniziarne un altro
     current_row = 0
-    while (current_row < iter_range):
-        staff_lines = [row_black_pixel_histogram[j: j + line_width] for j in
-                       range(current_row, current_row + (num_stafflines - 1) * (line_width + line_spacing) + 1,
-                             line_width + line_spacing)]
-        pixel_avg = sum(sum(staff_lines, [])) / (num_stafflines * line_width)
-
-        for line in staff_lines:
-            if (sum(line) / line_width < threshold * num_cols):
-                current_row += 1
-                break
-        else:
-            staff_row_indices = [list(range(j, j + line_width)) for j in
-                                 range(current_row,
-                                       current_row + (num_stafflines - 1) * (line_width + line_spacing) + 1,
-                                       line_width + line_spacing)]
-            all_staff_row_indices.append(staff_row_indices)
-            current_row = current_row + staff_length
+    for candidate_row in np.flatnonzero(staff_rows_mask):
+        if candidate_row < current_row:
+            continue
+        staff_row_indices = [list(range(j, j + line_width)) for j in
+                             range(int(candidate_row),
+                                   int(candidate_row) + (num_stafflines - 1) * line_step + 1,
+                                   line_step)]
+        all_staff_row_indices.append(staff_row_indices)
+        current_row = candidate_row + staff_length
 
     return all_staff_row_indices
 
 
+def staff_column_occupancy(img, all_staffline_vertical_indices, line_width):
+    """
+    Calcola, per ogni pentagramma, quali colonne contengono almeno un pixel nero
+    all'interno della fascia verticale occupata dalle sue linee.
+
+    Le fasce di tutti i pentagrammi vengono ridotte in un'unica passata NumPy
+    sull'immagine, invece di esaminare colonna per colonna ogni pentagramma.
+
+    Args:
+        img: Immagine binaria della partitura (0=nero, 255=bianco)
+        all_staffline_vertical_indices: Indici delle righe che compongono i pentagrammi
+        line_width: Spessore delle linee del pentagramma
+
+    Returns:
+        Matrice booleana (numero di pentagrammi x numero di colonne)
+    """
+    if len(all_staffline_vertical_indices) == 0:
+        return np.zeros((0, img.shape[1]), dtype=bool)
+
+    # Confini [inizio, fine) delle fasce: la fine esclude l'ultima riga della quinta linea
+    band_bounds = []
+    for staff_rows in all_staffline_vertical_indices:
+        band_bounds.append(staff_rows[0][0])
+        band_bounds.append(staff_rows[4][line_width - 1])
+
+    # Considera solo le righe comprese tra il primo e l'ultimo pentagramma
+    first_row = band_bounds[0]
+    black = (img[first_row:band_bounds[-1] + 1] == 0).view(np.uint8)
+    band_bounds = [bound - first_row for bound in band_bounds]
+    # reduceat riduce gli intervalli [b0, b1), [b1, b2), ...: le fasce sono quelli di indice pari
+    return np.maximum.reduceat(black, band_bounds, axis=0)[::2].astype(bool)
+
+
 def find_staffline_columns(img, all_staffline_vertical_indices, line_width, line_spacing):
     """
     Individua l'inizio e la fine di ogni pentagramma nell'immagine.
@@ -83,45 +109,27 @@ def find_staffline_columns(img, all_staffline_vertical_indices, line_width, line
     Returns:
         Lista di tuple (inizio, fine) che rappresentano gli estremi orizzontali di ogni pentagramma
     """
-    num_rows = img.shape[0]  # Altezza dell'immagine (numero di righe)
     num_cols = img.shape[1]  # Larghezza dell'immagine (numero di colonne)
-    # Crea una lista di tuple della forma (indice colonna, numero di occorrenze della somma larghezza_spaziatura)
+    half_cols = num_cols // 2
     all_staff_extremes = []
 
-    # Trova l'inizio e la fine di ogni pentagramma nell'immagine
+    # Colonne prive di pixel neri nella fascia di ogni pentagramma
+    free_columns = ~staff_column_occupancy(img, all_staffline_vertical_indices, line_width)
+    free_left = free_columns[:, :half_cols]
+    free_right = free_columns[:, half_cols:]
+
+    # Inizio: colonna massima libera nella metà sinistra
+    has_begin = free_left.any(axis=1)
+    begins = half_cols - 1 - np.argmax(free_left[:, ::-1], axis=1)
+    # Fine: colonna minima libera nella metà destra
+    has_end = free_right.any(axis=1)
+    ends = half_cols + np.argmax(free_right, axis=1)
+
     for i in range(len(all_staffline_vertical_indices)):
-        begin_list = [] # Memorizza i possibili indici di inizio del pentagramma
-        end_list = []   # Memorizza i possibili indici di fine del pentagramma
-        begin = 0
-        end = num_cols - 1
-
-        # Trova l'inizio del pentagramma
-        for j in range(num_cols // 2):
-            first_staff_rows_isolated = img[all_staffline_vertical_indices[i][0][0]:all_staffline_vertical_indices[i][4][
-                line_width - 1], j]
-            num_black_pixels = len(list(filter(lambda x: x == 0, first_staff_rows_isolated)))
-
-            if (num_black_pixels == 0):
-                begin_list.append(j)
-
-        # Trova la colonna massima che non ha pixel neri nella finestra del pentagramma
-        list.sort(begin_list, reverse=True)
-        begin = begin_list[0]
-
-        # Trova la fine del pentagramma
-        for j in range(num_cols // 2, num_cols):
-            first_staff_rows_isolated = img[all_staffline_vertical_indices[i][0][0]:all_staffline_vertical_indices[i][4][
-                line_width - 1], j]
-            num_black_pixels = len(list(filter(lambda x: x == 0, first_staff_rows_isolated)))
-
-            if (num_black_pixels == 0):
-                end_list.append(j)
-
-        # Trova la colonna minima che non ha pixel neri nella finestra del pentagramma
-        list.sort(end_list)
-        end = end_list[0]
-
-        staff_extremes = (begin, end)
+        if not has_begin[i] or not has_end[i]:
+            raise IndexError("Estremi non trovati per il pentagramma {}".format(i + 1))
+
+        staff_extremes = (int(begins[i]), int(ends[i]))
         all_staff_extremes.append(staff_extremes)
 
     return all_staff_extremes
@@ -154,7 +162,8 @@ def create_staffs(all_staffline_vertical_indices, all_staffline_horizontal_indic
         staff_box = BoundingBox(x, y, width, height)
 
         # Create Cropped Staff Image
-        staff_img = img[max(0, y - half_dist_between_staffs): min(y+ height + half_dist_between_staffs, img.shape[0] - 1), x:x+width]
+        staff_top = max(0, y - half_dist_between_staffs)
+        staff_img = img[staff_top: min(y+ height + half_dist_between_staffs, img.shape[0] - 1), x:x+width]
 
         # Normalize Staff line Numbers to Cropped Image
         pixel = half_dist_between_staffs
@@ -168,7 +177,7 @@ def create_staffs(all_staffline_vertical_indices, all_staffline_horizontal_indic
             normalized_staff_line_vertical_indices.append(line)
             pixel += line_spacing + 1
 
-        staff = Staff(normalized_staff_line_vertical_indices, staff_box, line_width, line_spacing, staff_img)
+        staff = Staff(normalized_staff_line_vertical_indices, staff_box, line_width, line_spacing, staff_img, img_origin=(x, staff_top))
         staffs.append(staff)
 
     return staffs
\ No newline at end of file
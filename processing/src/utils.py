@@ -1,9 +1,491 @@
+import os
+import threading
+from collections import OrderedDict
 import cv2
 import numpy as np
-from src.box import BoundingBox
+from src.box import BoxArray, merge_box_arrays
 
-def match(img, templates, start_percent, stop_percent, threshold):
-    img_width, img_height = img.shape[::-1]
+# Passo (in punti percentuali) della ricerca della scala dei template
+scale_step = 3
+# Numero di passi provati sopra e sotto la scala prevista dall'interlinea
+predicted_scale_steps = 2
+# Memoria massima (in MB) della cache dei template ridimensionati
+template_cache_size_mb = int(os.environ.get("TEMPLATE_CACHE_SIZE_MB", 64))
+# Backend di correlazione predefinito (vedi correlate): "spatial", "fft" o "auto"
+correlation_backend = os.environ.get("CORRELATION_BACKEND", "auto")
+# Area minima (in pixel) del template ridimensionato per cui "auto" sceglie la FFT
+fft_min_template_area = 512
+# Larghezza e passo delle strisce verticali in cui il backend "fft" divide l'immagine
+# (overlap-save): sono supportati i template larghi fino a larghezza - passo + 1
+fft_tile_width = 640
+fft_tile_stride = 512
+# Memoria massima (in MB) della cache degli spettri dei template
+spectrum_cache_size_mb = int(os.environ.get("SPECTRUM_CACHE_SIZE_MB", 256))
+# Ricerca coarse-to-fine: fattore di riduzione dell'immagine grossolana (2 o 4),
+# abbassamento della soglia al livello grossolano e lato minimo (in pixel) del
+# template ridotto sotto il quale si cerca direttamente a piena risoluzione
+pyramid_factor = 2
+pyramid_threshold_margin = 0.15
+pyramid_min_template_size = 8
+
+
+def resize_template(template, scale):
+    """Ridimensiona il template alla scala richiesta (INTER_CUBIC)"""
+    return cv2.resize(template, None,
+        fx = scale, fy = scale, interpolation = cv2.INTER_CUBIC)
+
+
+def template_spectrum(template, dft_size):
+    """
+    Spettro (formato CCS di cv2.dft) del template a media nulla, esteso con
+    zeri alla dimensione dft_size = (righe, colonne) delle strisce dell'immagine.
+    """
+    rows, cols = dft_size
+    centered = template.astype(np.float32) - np.float32(template.mean())
+    padded = cv2.copyMakeBorder(centered, 0, rows - template.shape[0], 0,
+                                cols - template.shape[1], cv2.BORDER_CONSTANT, value=0)
+    return cv2.dft(padded, nonzeroRows=template.shape[0])
+
+
+class TemplateCache(object):
+    """
+    Cache LRU dei template trasformati (ridimensionati o loro spettri),
+    condivisa da tutto il processo.
+
+    I template sono gli stessi per ogni pentagramma e ogni pagina, quindi ogni
+    coppia (template, parametro) viene trasformata una sola volta. La memoria
+    occupata è limitata a max_bytes: oltre il limite vengono scartate le voci
+    usate meno di recente.
+    """
+    def __init__(self, max_bytes, transform=resize_template):
+        """
+        Args:
+            max_bytes: Memoria massima occupata dai template trasformati
+            transform: Funzione (template, parametro) -> array da memorizzare
+        """
+        self.max_bytes = max_bytes
+        self.transform = transform
+        self.entries = OrderedDict()  # (id template, parametro) -> (template, trasformato)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, template, param):
+        """
+        Restituisce il template trasformato con il parametro richiesto
+        (per la cache predefinita: ridimensionato alla scala param).
+
+        La chiave usa l'identità del template: la voce conserva un riferimento
+        all'originale, così l'id non può essere riutilizzato da un altro array.
+        """
+        key = (id(template), param)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is template:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        transformed = self.transform(template, param)
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous[1].nbytes
+            if transformed.nbytes <= self.max_bytes:
+                self.entries[key] = (template, transformed)
+                self.current_bytes += transformed.nbytes
+                while self.current_bytes > self.max_bytes:
+                    _, (_, evicted) = self.entries.popitem(last=False)
+                    self.current_bytes -= evicted.nbytes
+                    self.evictions += 1
+        return transformed
+
+    def clear(self):
+        """Svuota la cache e azzera i contatori"""
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Restituisce i contatori della cache (hit, miss, voci e memoria occupata)"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+# Cache condivisa da find_clef_time_signature e find_primitive
+template_cache = TemplateCache(template_cache_size_mb * 1024 * 1024)
+# Spettri dei template ridimensionati per il backend "fft", per dimensione della DFT
+spectrum_cache = TemplateCache(spectrum_cache_size_mb * 1024 * 1024, template_spectrum)
+
+
+class CorrelationImage(object):
+    """
+    Immagine preparata per la ricerca dei template.
+
+    Conserva le grandezze che non dipendono dal template e che vengono quindi
+    calcolate una sola volta per tutte le classi e tutte le scale: gli spettri
+    dell'immagine per il backend "fft" e le immagini integrali per la
+    normalizzazione di TM_CCOEFF_NORMED.
+
+    Per il backend "fft" l'immagine è divisa in strisce verticali larghe
+    fft_tile_width che iniziano ogni fft_tile_stride colonne: lo spettro di un
+    template ha così la dimensione di una striscia e non dell'intero
+    pentagramma, e resta nella spectrum_cache da un pentagramma all'altro.
+    """
+    def __init__(self, img):
+        self.img = np.ascontiguousarray(img)
+        self.height, self.width = self.img.shape
+        self.dft_size = (cv2.getOptimalDFTSize(self.height), fft_tile_width)
+        self.spectra = None
+        self.integral = None
+        self.square_integral = None
+        self.binary = None
+        self.coarse = {}
+
+    def getImage(self):
+        return self.img
+
+    def getCoarse(self, factor):
+        """Immagine ridotto di factor (INTER_AREA), preparata per la ricerca grossolana"""
+        if factor not in self.coarse:
+            coarse = cv2.resize(self.img, (max(1, self.width // factor), max(1, self.height // factor)),
+                                interpolation=cv2.INTER_AREA)
+            self.coarse[factor] = CorrelationImage(coarse)
+        return self.coarse[factor]
+
+    def supports(self, template):
+        """True se il backend "fft" può correlare il template con questa immagine"""
+        h, w = template.shape
+        return h <= self.height and w <= self.width and w <= fft_tile_width - fft_tile_stride + 1
+
+    def getSpectra(self):
+        """Lista di (colonna iniziale, spettro CCS) delle strisce dell'immagine"""
+        if self.spectra is None:
+            rows, cols = self.dft_size
+            last_start = max(self.width - cols, 0)
+            starts = list(range(0, last_start, fft_tile_stride)) + [last_start]
+            self.spectra = []
+            for start in starts:
+                tile = self.img[:, start:start + cols].astype(np.float32)
+                padded = cv2.copyMakeBorder(tile, 0, rows - tile.shape[0], 0, cols - tile.shape[1],
+                                            cv2.BORDER_CONSTANT, value=0)
+                self.spectra.append((start, cv2.dft(padded)))
+        return self.spectra
+
+    def getWindowDeviations(self, h, w):
+        """
+        Restituisce sqrt(somma dei quadrati degli scarti dalla media) di ogni
+        finestra h x w dell'immagine, cioè il fattore di normalizzazione
+        dell'immagine in TM_CCOEFF_NORMED.
+
+        Per le immagini binarizzate (0/255) la somma dei quadrati è 255 volte
+        la somma, quindi basta un'unica immagine integrale intera.
+        """
+        if self.binary is None:
+            self.binary = not np.any((self.img != 0) & (self.img != 255))
+            if self.binary:
+                self.integral = cv2.integral(self.img, sdepth=cv2.CV_32S)
+            else:
+                self.integral, self.square_integral = cv2.integral2(self.img, sdepth=cv2.CV_64F)
+
+        def window_sums(integral):
+            sums = integral[h:, w:] - integral[:-h, w:]
+            sums -= integral[h:, :-w]
+            sums += integral[:-h, :-w]
+            return sums
+
+        inv_area = 1.0 / (h * w)
+        if self.binary:
+            sums = window_sums(self.integral).astype(np.float32)
+            variance = sums * (np.float32(255) - sums * np.float32(inv_area))
+        else:
+            sums = window_sums(self.integral)
+            variance = window_sums(self.square_integral) - sums * sums * inv_area
+            variance = variance.astype(np.float32)
+        np.maximum(variance, 0, out=variance)
+        return np.sqrt(variance, out=variance)
+
+    def correlate(self, template):
+        """
+        Calcola TM_CCOEFF_NORMED del template sull'immagine nel dominio della frequenza.
+
+        Gli spettri dell'immagine sono calcolati una volta sola e quello del
+        template viene dalla spectrum_cache. Ogni striscia fornisce le posizioni
+        in cui il template vi è contenuto per intero; la normalizzazione segue
+        quella di cv2.matchTemplate, comprese le finestre uniformi (risultato 0).
+        """
+        h, w = template.shape
+        centered = template.astype(np.float64) - template.mean()
+        template_norm = np.sqrt((centered * centered).sum())
+        if template_norm < np.finfo(np.float64).eps:
+            # Template uniforme: cv2.matchTemplate restituisce 1 ovunque
+            return np.ones((self.height - h + 1, self.width - w + 1), dtype=np.float32)
+
+        template_spectrum = spectrum_cache.get(template, self.dft_size)
+        result = np.empty((self.height - h + 1, self.width - w + 1), dtype=np.float32)
+        for start, spectrum in self.getSpectra():
+            product = cv2.mulSpectrums(spectrum, template_spectrum, 0, conjB=True)
+            tile = cv2.idft(product, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+            valid = min(self.dft_size[1] - w + 1, result.shape[1] - start)
+            result[:, start:start + valid] = tile[:result.shape[0], :valid]
+
+        norms = self.getWindowDeviations(h, w)
+        norms *= np.float32(template_norm)
+
+        # Come cv2.matchTemplate: oltre |1| (errori numerici) il valore diventa
+        # +-1 se entro il 12.5%, altrimenti 0 (finestre uniformi, norma nulla)
+        correlation = np.zeros_like(result)
+        np.divide(result, norms, out=correlation, where=norms > 0)
+        outside = np.flatnonzero(np.abs(correlation) >= 1)
+        if outside.size:
+            values = result.ravel()[outside]
+            limits = norms.ravel()[outside]
+            correlation.ravel()[outside] = np.where(np.abs(values) < limits * 1.125, np.sign(values), 0)
+        return correlation
+
+
+def correlate(image, template, backend=correlation_backend):
+    """
+    Mappa TM_CCOEFF_NORMED del template sull'immagine preparata.
+
+    Args:
+        image: CorrelationImage
+        template: Template già ridimensionato
+        backend: "spatial" (cv2.matchTemplate), "fft" (CorrelationImage.correlate)
+            o "auto" (FFT per i template di area almeno fft_min_template_area).
+            I template troppo larghi per le strisce usano sempre "spatial".
+    """
+    if backend == "auto":
+        backend = "fft" if template.size >= fft_min_template_area else "spatial"
+    if backend == "fft" and image.supports(template):
+        return image.correlate(template)
+    return cv2.matchTemplate(image.getImage(), template, cv2.TM_CCOEFF_NORMED)
+
+
+def correlate_coarse_to_fine(image, template, scale, threshold, backend=correlation_backend,
+                             factor=pyramid_factor):
+    """
+    Mappa TM_CCOEFF_NORMED calcolata solo attorno ai candidati di una ricerca grossolana.
+
+    Il template ridotto di factor viene cercato nell'immagine ridotta con la soglia
+    abbassata di pyramid_threshold_margin; le regioni dei candidati (componenti
+    connesse, allargate di un pixel grossolano) vengono poi correlate a piena
+    risoluzione. Le posizioni non esaminate valgono -1, quindi la mappa si usa
+    come quella di correlate.
+
+    Args:
+        image: CorrelationImage a piena risoluzione
+        template: Template originale (non ridimensionato)
+        scale: Scala del template a piena risoluzione
+        threshold: Soglia che verrà applicata alla mappa a piena risoluzione
+        backend: Backend di correlazione per la ricerca grossolana
+        factor: Fattore di riduzione dell'immagine grossolana
+
+    Returns:
+        Mappa di correlazione della stessa forma di quella di correlate
+    """
+    fine_template = template_cache.get(template, scale)
+    h, w = fine_template.shape
+    coarse_template = template_cache.get(template, round(scale / factor, 4))
+    coarse_image = image.getCoarse(factor)
+    if (min(coarse_template.shape) < pyramid_min_template_size
+            or coarse_template.shape[0] > coarse_image.height
+            or coarse_template.shape[1] > coarse_image.width):
+        return correlate(image, fine_template, backend)
+
+    coarse_result = correlate(coarse_image, coarse_template, backend)
+    candidates = (coarse_result >= threshold - pyramid_threshold_margin).astype(np.uint8)
+
+    result = np.full((image.height - h + 1, image.width - w + 1), -1, dtype=np.float32)
+    if not candidates.any():
+        return result
+
+    # Un pixel grossolano copre factor pixel: la posizione esatta può cadere
+    # nel pixel grossolano adiacente
+    candidates = cv2.dilate(candidates, np.ones((3, 3), dtype=np.uint8))
+    num_labels, _, stats, _ = cv2.connectedComponentsWithStats(candidates, connectivity=8)
+    img = image.getImage()
+    for x, y, region_w, region_h, _ in stats[1:num_labels]:
+        y0, x0 = y * factor, x * factor
+        y1 = min((y + region_h) * factor, result.shape[0])
+        x1 = min((x + region_w) * factor, result.shape[1])
+        if y0 >= y1 or x0 >= x1:
+            continue
+        window = img[y0:y1 + h - 1, x0:x1 + w - 1]
+        result[y0:y1, x0:x1] = cv2.matchTemplate(window, fine_template, cv2.TM_CCOEFF_NORMED)
+    return result
+
+
+def predict_scales(line_spacing, reference_spacings, start_percent, stop_percent,
+                   num_steps=predicted_scale_steps):
+    """
+    Prevede le scale a cui cercare i template a partire dall'interlinea del pentagramma.
+
+    Ogni template è stato ritagliato da uno spartito con un'interlinea nota
+    (reference_spacings, una per template): la scala attesa è quindi
+    line_spacing / reference_spacing. Vengono provati solo num_steps passi di
+    scale_step punti percentuali sopra e sotto la scala attesa, sempre entro
+    l'intervallo [start_percent, stop_percent].
+
+    Returns:
+        Lista di scale da provare; ogni elemento contiene una scala per template
+    """
+    lower, upper = start_percent / 100.0, stop_percent / 100.0
+    scales = []
+    for step in range(-num_steps, num_steps + 1):
+        factor = 1 + step * scale_step / 100.0
+        template_scales = [
+            round(min(max(line_spacing / reference_spacing * factor, lower), upper), 2)
+            for reference_spacing in reference_spacings
+        ]
+        # Ai bordi dell'intervallo più passi possono ridursi alla stessa scala
+        if template_scales not in scales:
+            scales.append(template_scales)
+    return scales
+
+
+def find_peaks(result, threshold, rows, cols, template_shape):
+    """
+    Riduce le posizioni sopra la soglia ai massimi locali della correlazione.
+
+    Soppressione dei non-massimi con raggio limitato: una posizione sopra la
+    soglia (rows, cols, come np.where) resta se nessun punto in un intorno di
+    circa metà template ha un punteggio più alto (result uguale alla sua
+    dilatazione con un kernel grande metà template). Glifi che si toccano (le
+    teste di un accordo, note adiacenti) hanno massimi distinti e restano
+    separati. Le posizioni con lo stesso massimo (plateau) vengono raggruppate
+    in regioni connesse (8-connessione) e di ogni regione resta la prima.
+    Dilatazione ed etichettatura lavorano solo nel rettangolo che contiene le
+    posizioni.
+
+    Args:
+        template_shape: Dimensioni (altezza, larghezza) del template alla scala
+            della corrispondenza
+
+    Returns:
+        Tupla (righe, colonne) dei picchi, nell'ordine di np.where
+    """
+    if len(rows) < 2:
+        return rows, cols
+    radius_y = max(1, template_shape[0] // 4)
+    radius_x = max(1, template_shape[1] // 4)
+
+    # Rettangolo delle posizioni allargato del raggio: i vicini fuori dalle
+    # posizioni sopra la soglia hanno punteggi più bassi ma restano nel kernel
+    top, left = max(rows.min() - radius_y, 0), max(cols.min() - radius_x, 0)
+    bottom = min(rows.max() + radius_y + 1, result.shape[0])
+    right = min(cols.max() + radius_x + 1, result.shape[1])
+    window = result[top:bottom, left:right]
+    kernel = np.ones((2 * radius_y + 1, 2 * radius_x + 1), np.uint8)
+    dilated = cv2.dilate(window, kernel)
+
+    local_rows, local_cols = rows - top, cols - left
+    keep = window[local_rows, local_cols] == dilated[local_rows, local_cols]
+    rows, cols = rows[keep], cols[keep]
+    local_rows, local_cols = local_rows[keep], local_cols[keep]
+    if len(rows) < 2:
+        return rows, cols
+
+    # Plateau: un solo punto per regione di massimi uguali e adiacenti
+    mask = np.zeros(window.shape, np.uint8)
+    mask[local_rows, local_cols] = 1
+    _, labels = cv2.connectedComponents(mask, connectivity=8)
+    _, first = np.unique(labels[local_rows, local_cols], return_index=True)
+    first = np.sort(first)
+    return rows[first], cols[first]
+
+
+def sweep_scales(start_percent, stop_percent):
+    """Scale dell'esplorazione completa dell'intervallo [start_percent, stop_percent]"""
+    return [i/100.0 for i in range(start_percent, stop_percent + 1, scale_step)]
+
+
+def match_scale(image, templates, scale, threshold, peaks=False, backend=correlation_backend,
+                pyramid=False):
+    """
+    Cerca i template nell'immagine a una singola scala.
+
+    Args:
+        image: CorrelationImage in cui cercare i template
+        templates: Lista di template (immagini in scala di grigi)
+        scale: Scala dei template, singola o con un valore per template
+        threshold: Soglia minima di TM_CCOEFF_NORMED per accettare una posizione
+        peaks: Se True mantiene solo i massimi locali (vedi find_peaks)
+        backend: Backend di correlazione (vedi correlate)
+        pyramid: Se True usa la ricerca coarse-to-fine (vedi correlate_coarse_to_fine)
+
+    Returns:
+        Tupla (posizioni per template, numero di posizioni sopra la soglia);
+        le posizioni di ogni template sono una tupla (righe, colonne, punteggi).
+        Il numero di posizioni non dipende da peaks.
+    """
+    locations = []
+    location_count = 0
+    template_scales = scale if isinstance(scale, (list, tuple)) else [scale] * len(templates)
+    img = image.getImage()
+
+    for template, template_scale in zip(templates, template_scales):
+        if (template_scale*template.shape[0] > img.shape[0] or template_scale*template.shape[1] > img.shape[1]):
+            # Mantiene l'allineamento tra posizioni e template
+            locations += [(np.array([], dtype=np.int64), np.array([], dtype=np.int64),
+                           np.array([], dtype=np.float32))]
+            continue
+
+        if pyramid:
+            result = correlate_coarse_to_fine(image, template, template_scale, threshold, backend)
+        template = template_cache.get(template, template_scale)
+        if not pyramid:
+            result = correlate(image, template, backend)
+        rows, cols = np.where(result >= threshold)
+        location_count += len(rows)
+        if peaks:
+            rows, cols = find_peaks(result, threshold, rows, cols, template.shape)
+        locations += [(rows, cols, result[rows, cols])]
+
+    return locations, location_count
+
+
+def match(img, templates, start_percent, stop_percent, threshold, scales=None, peaks=False,
+          backend=correlation_backend, pyramid=False):
+    """
+    Cerca i template nell'immagine a diverse scale e restituisce le posizioni
+    trovate alla scala con il maggior numero di corrispondenze.
+
+    Con peaks=True restano solo i massimi locali (vedi find_peaks); la
+    scala viene scelta comunque contando tutte le posizioni sopra la soglia,
+    quindi è la stessa di peaks=False.
+
+    Args:
+        img: Immagine in cui cercare i template
+        templates: Lista di template (immagini in scala di grigi)
+        start_percent, stop_percent: Intervallo di scale esplorato (in percentuale)
+        threshold: Soglia minima di TM_CCOEFF_NORMED per accettare una posizione
+        scales: Scale da provare (es. da predict_scales); ogni elemento può essere
+            una singola scala o una lista con una scala per template. Se None
+            viene esplorato l'intero intervallo con passo scale_step.
+        backend: Backend di correlazione (vedi correlate)
+        pyramid: Se True usa la ricerca coarse-to-fine (vedi correlate_coarse_to_fine)
+
+    Returns:
+        Tupla (posizioni per template, scala scelta); le posizioni di ogni
+        template sono una tupla (righe, colonne, punteggi)
+    """
     best_location_count = -1
     best_locations = []
     best_scale = 1
@@ -11,22 +493,15 @@ def match(img, templates, start_percent, stop_percent, threshold):
     # plt.axis([0, 2, 0, 1])
     # plt.show(block=False)
 
+    if scales is None:
+        scales = sweep_scales(start_percent, stop_percent)
+    image = CorrelationImage(img)
+
     x = []
     y = []
-    for scale in [i/100.0 for i in range(start_percent, stop_percent + 1, 3)]:
-        locations = []
-        location_count = 0
-
-        for template in templates:
-            if (scale*template.shape[0] > img.shape[0] or scale*template.shape[1] > img.shape[1]):
-                continue
-
-            template = cv2.resize(template, None,
-                fx = scale, fy = scale, interpolation = cv2.INTER_CUBIC)
-            result = cv2.matchTemplate(img, template, cv2.TM_CCOEFF_NORMED)
-            result = np.where(result >= threshold)
-            location_count += len(result[0])
-            locations += [result]
+    for scale in scales:
+        locations, location_count = match_scale(image, templates, scale, threshold,
+                                                peaks, backend, pyramid)
 
         # print("scale: {0}, hits: {1}".format(scale, location_count))
         x.append(location_count)
@@ -45,36 +520,137 @@ def match(img, templates, start_percent, stop_percent, threshold):
     return best_locations, best_scale
 
 
-def locate_templates(img, templates, start, stop, threshold):
-    locations, scale = match(img, templates, start, stop, threshold)
+def locations_to_boxes(templates, locations, scale):
+    """
+    Converte le posizioni restituite da match in riquadri con punteggio.
+
+    Returns:
+        Lista (una per template) di BoxArray
+    """
+    template_scales = scale if isinstance(scale, (list, tuple)) else [scale] * len(templates)
     img_locations = []
     for i in range(len(templates)):
         # cv2.imshow("Template", templates[i])
         # cv2.waitKey(0)
         w, h = templates[i].shape[::-1]
-        w *= scale
-        h *= scale
-        img_locations.append([BoundingBox(pt[0], pt[1], w, h) for pt in zip(*locations[i][::-1])])
+        w *= template_scales[i]
+        h *= template_scales[i]
+        rows, cols, scores = locations[i]
+        img_locations.append(BoxArray(cols, rows, np.full(len(rows), w), np.full(len(rows), h), scores))
+    return img_locations
+
+
+def locate_templates(img, templates, start, stop, threshold, line_spacing=None,
+                     reference_spacings=None, return_scale=False, peaks=False,
+                     backend=correlation_backend, pyramid=False):
+    """
+    Individua i template nell'immagine e restituisce un riquadro per ogni posizione trovata.
+
+    Se sono forniti line_spacing (interlinea del pentagramma) e reference_spacings
+    (interlinea di riferimento di ogni template) la ricerca è limitata alle poche
+    scale previste da predict_scales invece dell'intero intervallo [start, stop].
+    Con peaks=True si ottengono solo i massimi locali (vedi find_peaks);
+    backend sceglie come calcolare la correlazione (vedi correlate); con
+    pyramid=True la piena risoluzione viene esaminata solo attorno ai candidati
+    trovati su un'immagine ridotta (vedi correlate_coarse_to_fine).
+    Ogni riquadro riporta il punteggio di corrispondenza.
+
+    Returns:
+        Lista (una per template) di BoxArray; se return_scale è True
+        anche la scala scelta (una per template in modalità prevista)
+    """
+    scales = None
+    if line_spacing is not None and reference_spacings is not None:
+        scales = predict_scales(line_spacing, reference_spacings, start, stop)
+
+    locations, scale = match(img, templates, start, stop, threshold, scales, peaks, backend, pyramid)
+    img_locations = locations_to_boxes(templates, locations, scale)
+
+    if return_scale:
+        return img_locations, scale
     return img_locations
 
 
+class TemplateBank(object):
+    """
+    Classe di simboli cercata da locate_template_banks: i suoi template,
+    l'intervallo di scale, la soglia, l'interlinea di riferimento dei template
+    e il backend di correlazione.
+    """
+    def __init__(self, name, templates, start_percent, stop_percent, threshold,
+                 reference_spacings=None, backend=correlation_backend):
+        self.name = name
+        self.templates = templates
+        self.start_percent = start_percent
+        self.stop_percent = stop_percent
+        self.threshold = threshold
+        self.reference_spacings = reference_spacings
+        self.backend = backend
+
+    def getName(self):
+        return self.name
+
+    def getScales(self, line_spacing=None):
+        """Scale da provare: previste dall'interlinea se disponibile, altrimenti l'intero intervallo"""
+        if line_spacing is not None and self.reference_spacings is not None:
+            return predict_scales(line_spacing, self.reference_spacings,
+                                  self.start_percent, self.stop_percent)
+        return sweep_scales(self.start_percent, self.stop_percent)
+
+
+def locate_template_banks(img, banks, line_spacing=None, peaks=False, pyramid=False):
+    """
+    Individua più classi di simboli nella stessa immagine con un'unica scansione.
+
+    L'immagine viene preparata una sola volta (CorrelationImage: spettro e
+    immagini integrali condivisi da tutte le classi) e a ogni passo di scala vengono
+    valutati i template di tutte le classi; ogni classe mantiene la propria
+    soglia e sceglie la propria scala migliore con lo stesso criterio di match.
+    Il risultato di ogni classe coincide con quello di locate_templates.
+
+    Args:
+        img: Immagine in cui cercare i template
+        banks: Lista di TemplateBank
+        line_spacing: Interlinea del pentagramma; se None viene esplorato
+            l'intero intervallo di scale di ogni classe
+        peaks: Se True mantiene solo i massimi locali (vedi find_peaks)
+        pyramid: Se True usa la ricerca coarse-to-fine (vedi correlate_coarse_to_fine)
+
+    Returns:
+        Dizionario nome della classe -> BoxArray dei candidati con punteggio
+    """
+    image = CorrelationImage(img)
+    schedules = [bank.getScales(line_spacing) for bank in banks]
+    best = [(-1, [], 1) for _ in banks]  # (criterio, posizioni, scala)
+
+    for step in range(max((len(scales) for scales in schedules), default=0)):
+        for k, bank in enumerate(banks):
+            if step >= len(schedules[k]):
+                continue
+            scale = schedules[k][step]
+            locations, location_count = match_scale(
+                image, bank.templates, scale, bank.threshold, peaks, bank.backend, pyramid)
+            if location_count > best[k][0]:
+                best[k] = (location_count, locations, scale)
+
+    candidates = {}
+    for bank, (_, locations, scale) in zip(banks, best):
+        boxes = locations_to_boxes(bank.templates, locations, scale)
+        candidates[bank.getName()] = BoxArray.concatenate(boxes)
+    return candidates
+
+
 def merge_boxes(boxes, threshold):
-    filtered_boxes = []
-    while len(boxes) > 0:
-        r = boxes.pop(0)
-        boxes.sort(key=lambda box: box.distance(r))
-        merged = True
-        while (merged):
-            merged = False
-            i = 0
-            for _ in range(len(boxes)):
-                if r.overlap(boxes[i]) > threshold or boxes[i].overlap(r) > threshold:
-                    r = r.merge(boxes.pop(i))
-                    merged = True
-                elif boxes[i].distance(r) > r.w / 2 + boxes[i].w / 2:
-                    break
-                else:
-                    i += 1
-        filtered_boxes.append(r)
-    return filtered_boxes
+    """
+    Unisce i riquadri sovrapposti (vedi merge_box_arrays).
+
+    Args:
+        boxes: BoxArray o lista di BoundingBox
+        threshold: Rapporto minimo di sovrapposizione per unire due riquadri
 
+    Returns:
+        BoxArray dei riquadri uniti
+    """
+    if not isinstance(boxes, BoxArray):
+        boxes = BoxArray.fromBoxes(boxes)
+    return boxes.merge(threshold)
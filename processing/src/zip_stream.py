@@ -0,0 +1,318 @@
+"""
+Archivi ZIP generati al volo, senza file temporanei.
+
+La struttura dell'archivio (intestazioni, posizione e dimensione di ogni file)
+dipende solo da nomi e dimensioni dei file, quindi la lunghezza totale è nota
+prima di leggere i dati: la risposta può dichiarare Content-Length e servire
+intervalli di byte (Range) per riprendere un download interrotto. CRC e
+dimensioni di ogni file sono scritti nell'intestazione locale, senza data
+descriptor (che molti lettori non accettano per i file memorizzati senza
+compressione).
+
+CRC e dimensione compressa si calcolano una volta sola e si salvano in un
+manifest accanto ai file (ZipManifest, ad esempio al termine di un lavoro):
+le richieste successive costruiscono l'archivio dal manifest senza leggere i
+file, e i file compressi vengono compressi solo quando i loro byte fanno
+parte dell'intervallo richiesto.
+"""
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+# File già compressi: vengono memorizzati senza ricomprimerli
+stored_extensions = (".jpg", ".jpeg", ".png", ".gif", ".zip", ".pdf")
+
+# Gli altri file fino a questa dimensione vengono compressi in memoria; quelli
+# più grandi vengono memorizzati
+zip_deflate_max_size = 1024 * 1024
+
+# Nome del manifest con CRC e dimensioni dei file di una directory
+zip_manifest_name = ".zip_manifest.json"
+
+# Dimensione dei blocchi letti dai file durante la trasmissione
+zip_chunk_size = 64 * 1024
+
+# Limite del formato ZIP senza estensioni ZIP64
+zip_max_size = 0xFFFFFFFF
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+
+LOCAL_HEADER_SIGNATURE = 0x04034B50
+CENTRAL_HEADER_SIGNATURE = 0x02014B50
+END_RECORD_SIGNATURE = 0x06054B50
+
+VERSION = 20  # 2.0: compressione deflate
+MADE_BY_UNIX = 3 << 8
+FLAG_UTF8 = 0x800
+
+
+def file_crc(path, size):
+    """CRC dei primi size byte del file, letto una sola volta a blocchi"""
+    crc = 0
+    remaining = size
+    with open(path, "rb") as f:
+        while remaining > 0:
+            chunk = f.read(min(zip_chunk_size, remaining))
+            if not chunk:
+                raise IOError(f"File {path} modificato durante la creazione dell'archivio")
+            crc = zlib.crc32(chunk, crc)
+            remaining -= len(chunk)
+    return crc
+
+
+def dos_datetime(timestamp):
+    """Converte un timestamp nella coppia (ora, data) del formato MS-DOS usata dai ZIP"""
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+def compressible(path, size):
+    return not path.lower().endswith(stored_extensions) and size <= zip_deflate_max_size
+
+
+def deflate_file(path):
+    """Legge e comprime un file: restituisce (dati compressi, CRC, dimensione)"""
+    with open(path, "rb") as f:
+        raw = f.read()
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return compressor.compress(raw) + compressor.flush(), zlib.crc32(raw), len(raw)
+
+
+def describe_file(path, stat=None):
+    """
+    Descrizione di un file nell'archivio: dimensione, data di modifica, metodo,
+    CRC e dimensione compressa (richiede una lettura del file)
+    """
+    if stat is None:
+        stat = os.stat(path)
+    record = {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "mtime_ns": stat.st_mtime_ns,
+        "method": zlib.DEFLATED if compressible(path, stat.st_size) else 0,
+    }
+    if record["method"] == zlib.DEFLATED:
+        data, record["crc"], record["size"] = deflate_file(path)
+        record["compressed_size"] = len(data)
+    else:
+        record["crc"] = file_crc(path, stat.st_size)
+        record["compressed_size"] = stat.st_size
+    return record
+
+
+class ZipManifest(object):
+    """
+    CRC e dimensioni dei file di una directory, salvati in zip_manifest_name.
+
+    Una voce resta valida finché dimensione e data di modifica del file non
+    cambiano; il manifest vale solo per la versione di zlib che l'ha prodotto
+    (da cui dipende la dimensione compressa).
+    """
+    def __init__(self, directory):
+        self.path = os.path.join(directory, zip_manifest_name)
+        self.records = {}
+        self.seen = set()
+        self.changed = False
+        try:
+            with open(self.path, "r") as f:
+                manifest = json.load(f)
+            if manifest.get("zlib") == zlib.ZLIB_RUNTIME_VERSION:
+                self.records = manifest["files"]
+        except (OSError, ValueError, KeyError):
+            self.changed = True
+
+    def describe(self, arcname, path):
+        """Descrizione del file (vedi describe_file), ricalcolata solo se il file è cambiato"""
+        stat = os.stat(path)
+        record = self.records.get(arcname)
+        if (
+            record is None
+            or record["size"] != stat.st_size
+            or record["mtime_ns"] != stat.st_mtime_ns
+        ):
+            record = describe_file(path, stat)
+            self.records[arcname] = record
+            self.changed = True
+        self.seen.add(arcname)
+        return record
+
+    def save(self):
+        """Salva il manifest (solo le voci usate) se qualcosa è cambiato"""
+        if not self.changed and self.seen == set(self.records):
+            return
+        files = {name: self.records[name] for name in sorted(self.seen)}
+        # Scritto accanto e rinominato: più download dello stesso lavoro possono
+        # salvarlo insieme
+        tmp_path = f"{self.path}.tmp-{threading.get_ident()}"
+        with open(tmp_path, "w") as f:
+            json.dump({"zlib": zlib.ZLIB_RUNTIME_VERSION, "files": files}, f)
+        os.replace(tmp_path, self.path)
+        self.records = files
+        self.changed = False
+
+
+def write_manifest(directory, files):
+    """
+    Calcola e salva il manifest di una directory.
+
+    Args:
+        directory: Directory del manifest
+        files: Lista di coppie (nome nell'archivio, percorso del file)
+    """
+    manifest = ZipManifest(directory)
+    for arcname, path in files:
+        manifest.describe(arcname, path)
+    manifest.save()
+    return manifest
+
+
+class ZipEntry(object):
+    """Un file dell'archivio: intestazione locale e dati"""
+    def __init__(self, arcname, path, record=None):
+        """
+        Args:
+            arcname: Nome nell'archivio
+            path: Percorso del file
+            record: Descrizione del file (vedi describe_file); se manca viene
+                calcolata leggendo il file
+        """
+        self.path = path
+        self.name = arcname.replace(os.sep, "/").encode("utf-8")
+        self.flags = FLAG_UTF8 if not arcname.isascii() else 0
+
+        if record is None:
+            record = describe_file(path)
+        self.size = record["size"]
+        self.mtime = record["mtime"]
+        self.dos_time, self.dos_date = dos_datetime(record["mtime"])
+        self.method = record["method"]
+        self.crc = record["crc"]
+        self.compressed_size = record["compressed_size"]
+        self.data = None
+        self.offset = 0
+
+    def getLocalHeader(self):
+        return LOCAL_HEADER.pack(
+            LOCAL_HEADER_SIGNATURE, VERSION, self.flags, self.method,
+            self.dos_time, self.dos_date, self.crc, self.compressed_size, self.size,
+            len(self.name), 0,
+        ) + self.name
+
+    def getCentralHeader(self):
+        return CENTRAL_HEADER.pack(
+            CENTRAL_HEADER_SIGNATURE, MADE_BY_UNIX | VERSION, VERSION, self.flags,
+            self.method, self.dos_time, self.dos_date, self.crc,
+            self.compressed_size, self.size, len(self.name), 0, 0, 0, 0,
+            (0o100644 << 16), self.offset,
+        ) + self.name
+
+    def readData(self, start, stop):
+        """Restituisce a blocchi i byte [start, stop) dei dati dell'elemento"""
+        if self.method == zlib.DEFLATED:
+            if self.data is None:
+                # Compresso solo quando serve: deve coincidere con il manifest
+                data, crc, size = deflate_file(self.path)
+                if (crc, size, len(data)) != (self.crc, self.size, self.compressed_size):
+                    raise IOError(f"File {self.path} modificato durante la creazione dell'archivio")
+                self.data = data
+            yield self.data[start:stop]
+            return
+
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(zip_chunk_size, remaining))
+                if not chunk:
+                    raise IOError(f"File {self.path} modificato durante la creazione dell'archivio")
+                remaining -= len(chunk)
+                yield chunk
+
+
+class ZipStream(object):
+    """
+    Archivio ZIP di un elenco di file, prodotto a blocchi su richiesta.
+
+    La dimensione totale (getSize) è nota alla creazione; iterBytes produce
+    l'archivio intero o un suo intervallo di byte.
+    """
+    def __init__(self, files, manifest=None):
+        """
+        Args:
+            files: Lista di coppie (nome nell'archivio, percorso del file)
+            manifest: ZipManifest con CRC e dimensioni dei file; senza manifest
+                ogni file viene letto per calcolarli
+        """
+        self.entries = [
+            ZipEntry(arcname, path, manifest.describe(arcname, path) if manifest else None)
+            for arcname, path in files
+        ]
+        self.central_directory = None
+
+        # Segmenti dell'archivio: (inizio, lunghezza, tipo, elemento)
+        self.segments = []
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            header_length = LOCAL_HEADER.size + len(entry.name)
+            self.segments.append((offset, header_length, "header", entry))
+            offset += header_length
+            self.segments.append((offset, entry.compressed_size, "data", entry))
+            offset += entry.compressed_size
+
+        self.central_offset = offset
+        self.central_size = sum(CENTRAL_HEADER.size + len(e.name) for e in self.entries)
+        self.segments.append((offset, self.central_size, "central", None))
+        offset += self.central_size
+        self.segments.append((offset, END_RECORD.size, "end", None))
+        self.size = offset + END_RECORD.size
+
+        if self.size > zip_max_size or len(self.entries) > 0xFFFF:
+            raise ValueError("Archivio troppo grande per il formato ZIP senza ZIP64")
+
+    def getSize(self):
+        return self.size
+
+    def getCentralDirectory(self):
+        if self.central_directory is None:
+            self.central_directory = b"".join(e.getCentralHeader() for e in self.entries)
+        return self.central_directory
+
+    def getEndRecord(self):
+        return END_RECORD.pack(
+            END_RECORD_SIGNATURE, 0, 0, len(self.entries), len(self.entries),
+            self.central_size, self.central_offset, 0,
+        )
+
+    def segmentBytes(self, kind, entry):
+        if kind == "header":
+            return entry.getLocalHeader()
+        if kind == "central":
+            return self.getCentralDirectory()
+        return self.getEndRecord()
+
+    def iterBytes(self, start=0, stop=None):
+        """
+        Produce a blocchi i byte [start, stop) dell'archivio (per default tutto).
+        """
+        if stop is None:
+            stop = self.size
+        for seg_start, seg_length, kind, entry in self.segments:
+            seg_stop = seg_start + seg_length
+            if seg_stop <= start or seg_start >= stop:
+                continue
+            lo = max(start, seg_start) - seg_start
+            hi = min(stop, seg_stop) - seg_start
+            if kind == "data":
+                yield from entry.readData(lo, hi)
+            else:
+                yield self.segmentBytes(kind, entry)[lo:hi]
@@ -67,7 +67,7 @@ def test_jobs_endpoint():
                     status_emoji = (
                         "✅"
                         if job["status"] == "completed"
-                        else "⏳" if job["status"] == "processing" else "❌"
+                        else "⏳" if job["status"] in ("queued", "processing") else "❌"
                     )
                     print(f"   {status_emoji} {job['filename']} - {job['status']}")
             return True
@@ -94,6 +94,28 @@ def test_demo_page():
         return False
 
 
+def check_job_results(job_id):
+    """Controlla i risultati di un lavoro terminato e il download del suo ZIP"""
+    result_response = requests.get(f"{SERVER_URL}/process/{job_id}", timeout=10)
+    if result_response.status_code != 200:
+        print(f"❌ Errore stato lavoro: {result_response.status_code}")
+        return False
+    result_data = result_response.json()
+    print(f"✅ Risultati recuperati: Status {result_data.get('status')}")
+    if result_data.get("status") != "completed":
+        return False
+    if result_data.get("result"):
+        staffs = result_data["result"].get("staffs_detected", 0)
+        print(f"🎼 Pentagrammi rilevati: {staffs}")
+
+    download_response = requests.get(f"{SERVER_URL}/jobs/{job_id}/download", timeout=60)
+    if download_response.status_code != 200 or not download_response.content.startswith(b"PK"):
+        print(f"❌ Errore download ZIP: {download_response.status_code}")
+        return False
+    print(f"✅ ZIP scaricato: {len(download_response.content)} byte")
+    return True
+
+
 def test_file_upload(test_file=None):
     """Testa l'upload di un file (se fornito)"""
     if not test_file or not os.path.exists(test_file):
@@ -107,24 +129,37 @@ def test_file_upload(test_file=None):
             files = {"file": f}
             response = requests.post(f"{SERVER_URL}/upload", files=files, timeout=30)
 
-        if response.status_code == 200:
+        if response.status_code == 200 and response.json().get("cache_hit"):
+            # Risultato già in cache: il lavoro è completato subito
+            data = response.json()
+            job_id = data.get("job_id")
+            print(f"✅ Upload completato dalla cache: Job ID {job_id}")
+            return check_job_results(job_id)
+        elif response.status_code == 202:
             data = response.json()
             job_id = data.get("job_id")
-            print(f"✅ Upload completato: Job ID {job_id}")
+            print(f"✅ Upload accettato: Job ID {job_id} ({data.get('status')})")
 
-            # Test recupero risultati
+            # Il lavoro viene elaborato in background: attende che termini
             if job_id:
-                result_response = requests.get(
-                    f"{SERVER_URL}/process/{job_id}", timeout=10
-                )
-                if result_response.status_code == 200:
-                    result_data = result_response.json()
-                    print(
-                        f"✅ Risultati recuperati: Status {result_data.get('status')}"
+                while True:
+                    result_response = requests.get(
+                        f"{SERVER_URL}/process/{job_id}", timeout=10
                     )
-                    if result_data.get("result"):
-                        staffs = result_data["result"].get("staffs_detected", 0)
-                        print(f"🎼 Pentagrammi rilevati: {staffs}")
+                    if result_response.status_code != 200:
+                        print(f"❌ Errore stato lavoro: {result_response.status_code}")
+                        return False
+                    result_data = result_response.json()
+                    if result_data.get("status") in ("completed", "failed"):
+                        break
+                    progress = result_data.get("progress")
+                    if progress:
+                        print(
+                            f"⏳ {progress['pages_done']}/{progress['pages_total']} pagine"
+                        )
+                    time.sleep(1)
+
+                return check_job_results(job_id)
 
             return True
         else: